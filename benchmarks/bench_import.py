@@ -0,0 +1,73 @@
+"""
+Import-time report of Knitty CLI entry points (parsed ``python -X importtime``
+output): total import time of each entry point module and the packages that
+take most of it. Exits with code 1 if an entry point is over the budget.
+
+    python benchmarks/bench_import.py
+"""
+import re
+import sys
+import subprocess
+from collections import defaultdict
+from statistics import median
+from typing import Dict, Tuple
+
+import click
+
+# entry point: (module, budget in ms)
+ENTRY_POINTS = {
+    'knitty': ('knitty.knitty', 300),
+    'pre-knitty': ('knitty.pre_knitty', 200),
+    'pandoc-filter-arg': ('knitty.pandoc_filter_arg.cli', 200),
+    'knitty-daemon': ('knitty.daemon', 300),
+}
+LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\| ( *)(\S+)\s*$')
+
+
+def importtime(module: str) -> Tuple[float, Dict[str, float]]:
+    """
+    Import ``module`` in a new interpreter.
+
+    Returns
+    -------
+    total : float
+        cumulative import time of the module (ms)
+    packages : dict
+        self import time by top-level package (ms)
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    total, packages = 0., defaultdict(float)
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if not m:
+            continue
+        self_us, cumulative_us, indent, name = m.groups()
+        packages[name.split('.')[0]] += int(self_us) / 1000
+        if name == module and not indent:
+            total = int(cumulative_us) / 1000
+    return total, packages
+
+
+@click.command()
+@click.option('--repeat', type=int, default=5, help='Median of N runs.')
+@click.option('--top', type=int, default=5, help='Show N heaviest packages.')
+def main(repeat, top):
+    over = []
+    for entry_point, (module, budget) in ENTRY_POINTS.items():
+        importtime(module)  # warm up .pyc and disk cache
+        runs = [importtime(module) for _ in range(repeat)]
+        total = median(t for t, _ in runs)
+        packages = runs[-1][1]
+        status = 'ok' if total <= budget else 'OVER BUDGET'
+        click.echo('{:<20}{:>8.1f} ms  (budget {} ms) {}'.format(entry_point, total, budget, status))
+        for name, ms in sorted(packages.items(), key=lambda kv: -kv[1])[:top]:
+            click.echo('    {:<28}{:>8.1f} ms'.format(name, ms))
+        if total > budget:
+            over.append(entry_point)
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark of Pandoc JSON AST (de)serialization on the Knitty filter
+stdin/stdout path: the old text path (``json`` on ``str`` with default
+separators) vs. ``knitty.json_backend`` backends on bytes.
+
+    python benchmarks/bench_json.py --size 200
+"""
+import os.path as p
+import json
+import time
+
+import click
+import panflute as pf
+
+from knitty.json_backend import BACKENDS
+
+HERE = p.dirname(p.abspath(__file__))
+SOURCE = p.join(HERE, '..', 'tests', 'data', 'small.md')
+
+
+def large_ast(size_mb: float) -> bytes:
+    """
+    Pandoc JSON AST of ``tests/data/small.md`` repeated until
+    the AST is about ``size_mb`` megabytes.
+    """
+    with open(SOURCE, 'r', encoding='utf-8') as f:
+        ast = json.loads(pf.convert_text(f.read(), output_format='json', standalone=True))
+    blocks = ast['blocks']
+    repeat = max(1, int(size_mb * 2**20 / len(json.dumps(blocks))))
+    ast['blocks'] = blocks * repeat
+    return json.dumps(ast).encode('utf-8')
+
+
+def text_path(data: bytes) -> bytes:
+    ast = json.loads(data.decode('utf-8'))
+    return json.dumps(ast).encode('utf-8')
+
+
+def best(func, data: bytes, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.option('--size', type=float, default=50, help='AST size in MB.')
+@click.option('--repeat', type=int, default=3, help='Best of N runs.')
+def main(size, repeat):
+    data = large_ast(size)
+    click.echo('AST: {:.1f} MB'.format(len(data) / 2**20))
+    baseline = best(text_path, data, repeat)
+    click.echo('{:<24}{:>8.3f}s'.format('json (text, old path)', baseline))
+    for name, (loads, dumps) in sorted(BACKENDS.items()):
+        t = best(lambda d: dumps(loads(d)), data, repeat)
+        click.echo('{:<24}{:>8.3f}s  x{:.1f}'.format(name + ' (bytes)', t, baseline / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Scaling benchmark of pre-knitty on Hydrogen ``.py`` documents with
+block comments: the whole file regex substitution (old path) vs. the
+line-oriented tokenizer (in memory and streamed in blocks like from stdin).
+
+    python benchmarks/bench_preprocess.py --max-lines 1000000
+"""
+import time
+
+import click
+
+from knitty.preprocess_filter import (knitty_preprosess, knitty_preprosess_stream, regex_preprosess,
+                                      Tokenizer, BLOCK)
+
+YAML_META = '''---
+comments-map:
+  py: ['#', "'''", "'''", "\\"\\"\\"", "\\"\\"\\""]
+...
+'''
+
+CODE = ''.join('{}x_{i} = compute(x_{i}, "value")  # comment\n'.format('    ' * (i % 4), i=i) for i in range(60))
+CELLS = [
+    '# %% {echo=False}\n' + CODE + '\n\n',
+    '# %%\n"""\n# Header\n\n' + 'Some *markdown* text.\n' * 20 + '"""\n\n',
+    '# %% {r} R cell:\nx <- c(1, 2, 3)\nsummary(x)\n\n',
+    '# %%\n' + CODE + '\n' * 40,
+]
+
+
+def document(lines: int) -> str:
+    """
+    Hydrogen document of about ``lines`` lines.
+    """
+    text = ''.join(CELLS)
+    return text * max(1, lines // text.count('\n'))
+
+
+def best(func, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def stream(source: str):
+    chunks = (source[i:i + BLOCK] for i in range(0, len(source), BLOCK))
+    for _ in knitty_preprosess_stream(Tokenizer.blocks(chunks), 'py', YAML_META):
+        pass
+
+
+@click.command()
+@click.option('--max-lines', type=int, default=10**6, help='Largest document size in lines.')
+@click.option('--regex-max-lines', type=int, default=10**5, help='Largest document size for the regex path.')
+@click.option('--repeat', type=int, default=3, help='Best of N runs.')
+def main(max_lines, regex_max_lines, repeat):
+    click.echo('{:>9}{:>12}{:>12}{:>12}'.format('lines', 'regex', 'tokenizer', 'stream'))
+    lines = 1000
+    while lines <= max_lines:
+        source = document(lines)
+        assert knitty_preprosess(source, 'py', YAML_META) == ''.join(
+            knitty_preprosess_stream((source,), 'py', YAML_META))
+        if lines <= regex_max_lines:
+            assert regex_preprosess(source, 'py', YAML_META) == knitty_preprosess(source, 'py', YAML_META)
+            regex = '{:>11.3f}s'.format(best(lambda: regex_preprosess(source, 'py', YAML_META), repeat))
+        else:
+            regex = '{:>12}'.format('-')
+        click.echo('{:>9}{}{:>11.3f}s{:>11.3f}s'.format(
+            source.count('\n'), regex,
+            best(lambda: knitty_preprosess(source, 'py', YAML_META), repeat),
+            best(lambda: stream(source), repeat)))
+        lines *= 10
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
-import json
 from .stitch.stitch import Stitch
-import psutil
+from .json_stream import read_pandoc_ast, PandocASTWriter
+from . import json_backend
 import traceback
+import sys
+from itertools import chain
+from typing import Callable, TextIO, Union
 
 
 # -------------------------------------------
@@ -20,6 +23,7 @@ def safe_spawn(func):
     except Exception:
         traceback.print_exc()
 
+    import psutil
     procs = psutil.Process().children(recursive=True)
     for p in procs:
         p.terminate()
@@ -29,19 +33,83 @@ def safe_spawn(func):
         print("Killed process that was still alive after 'timeout=50' from 'terminate()' command.")
 
 
-def knitty_pandoc_filter(json_ast: str, name: str, filter_to: str, standalone: bool, self_contained: bool,
-                         pandoc_format: str, pandoc_extra_args: list) -> str:
+def knitty_pandoc_filter(json_ast: Union[str, bytes], name: str, filter_to: str, standalone: bool,
+                         self_contained: bool, pandoc_format: str, pandoc_extra_args: list,
+                         cache: bool=False, refresh_cache: bool=False) -> Union[str, bytes]:
     """
-    Changes Pandoc JSON AST string
+    Changes Pandoc JSON AST string. Returns UTF-8 bytes if ``json_ast``
+    is bytes (see ``json_backend`` for the JSON library used).
+    If ``cache`` then prints cache hits/misses to stderr.
     """
-    ast = json.loads(json_ast)
+    ast = json_backend.loads(json_ast)
     stitcher = Stitch(name=name, filter_to=filter_to, standalone=standalone, self_contained=self_contained,
-                      pandoc_format=pandoc_format, pandoc_extra_args=pandoc_extra_args)
+                      pandoc_format=pandoc_format, pandoc_extra_args=pandoc_extra_args,
+                      cache=cache, refresh_cache=refresh_cache)
 
     def work():
         nonlocal ast
         ast = stitcher.stitch_ast(ast)
 
     safe_spawn(work)
+    if stitcher.cache is not None:
+        print('knitty cache: ' + stitcher.cache.stats(), file=sys.stderr)
 
-    return json.dumps(ast)
+    out = json_backend.dumps(ast)
+    return out if isinstance(json_ast, bytes) else out.decode('utf-8')
+
+
+def knitty_plan(json_ast: Union[str, bytes], name: str, filter_to: str, standalone: bool,
+                self_contained: bool, pandoc_format: str, pandoc_extra_args: list,
+                cache: bool=False, refresh_cache: bool=False) -> dict:
+    """
+    Validates Pandoc JSON AST and predicts the render (see ``Stitch.plan``).
+    Nothing is executed.
+    """
+    stitcher = Stitch(name=name, filter_to=filter_to, standalone=standalone, self_contained=self_contained,
+                      pandoc_format=pandoc_format, pandoc_extra_args=pandoc_extra_args,
+                      cache=cache, refresh_cache=refresh_cache)
+    return stitcher.plan(json_backend.loads(json_ast))
+
+
+def knitty_pandoc_filter_stream(input_stream: TextIO, output_stream: TextIO, name: str, filter_to: str,
+                                standalone: bool, self_contained: bool, pandoc_format: str,
+                                pandoc_extra_args: list, cache: bool=False, refresh_cache: bool=False,
+                                block_filter: Callable=None):
+    """
+    Streaming version of ``knitty_pandoc_filter``: reads Pandoc JSON AST
+    from the input stream and writes each block to the output stream
+    as soon as it's ready (see ``Stitch.stitch_blocks``). If Knitty fails
+    then the rest of the blocks are written unchanged.
+
+    ``block_filter(version, meta, block)`` returns a list of blocks
+    that replace the output block.
+    """
+    version, meta, blocks = read_pandoc_ast(input_stream)
+    stitcher = Stitch(name=name, filter_to=filter_to, standalone=standalone, self_contained=self_contained,
+                      pandoc_format=pandoc_format, pandoc_extra_args=pandoc_extra_args,
+                      cache=cache, refresh_cache=refresh_cache)
+    writer = PandocASTWriter(output_stream)
+    writer.start(version, meta)
+
+    def write(block):
+        for block_ in (block_filter(version, meta, block) if block_filter else [block]):
+            writer.write(block_)
+
+    current = []  # block that is being processed
+
+    def source():
+        for block in blocks:
+            current.append(block)
+            yield block
+            current.clear()
+
+    def work():
+        for block in stitcher.stitch_blocks(version, meta, source()):
+            write(block)
+
+    safe_spawn(work)
+    for block in chain(current, blocks):
+        write(block)
+    writer.end()
+    if stitcher.cache is not None:
+        print('knitty cache: ' + stitcher.cache.stats(), file=sys.stderr)
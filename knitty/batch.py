@@ -0,0 +1,298 @@
+"""
+Parameterized batch rendering: the document is rendered once per
+parameter set (a row of a CSV file or a line of a JSON Lines file).
+The source is pre-processed and parsed by Pandoc once. Parameters are
+assigned in each kernel by a hidden chunk inserted before the document
+chunks. Renders run on a pool of worker processes, each worker keeps
+warm kernels between its renders (see ``KernelPool``).
+"""
+import os
+import os.path as p
+import csv
+import json
+import time
+import keyword
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Union
+
+import click
+
+from .tools import KnittyError, panflute
+
+
+# -------------------------------------------
+# Parameters
+# -------------------------------------------
+def read_params(path: str) -> List[dict]:
+    """
+    Read parameter sets from ``.csv`` (values are strings)
+    or ``.jsonl``/``.ndjson`` (JSON object per line) file.
+    """
+    ext = p.splitext(path)[1].lower()
+    if ext == '.csv':
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            params = [dict(row) for row in csv.DictReader(f)]
+    elif ext in ('.jsonl', '.ndjson'):
+        with open(path, 'r', encoding='utf-8') as f:
+            params = [json.loads(line) for line in f if line.strip()]
+    else:
+        raise KnittyError('Parameters file should be .csv, .jsonl or .ndjson: {}'.format(path))
+    for i, param_set in enumerate(params):
+        if not isinstance(param_set, dict):
+            raise KnittyError('Parameter set {} is not an object.'.format(i))
+        for name in param_set:
+            if not (isinstance(name, str) and name.isidentifier() and not keyword.iskeyword(name)):
+                raise KnittyError('Invalid parameter name {!r} in parameter set {}.'.format(name, i))
+    return params
+
+
+def r_literal(value) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return json.dumps(value)  # JSON escapes are valid in R strings
+    if isinstance(value, list):
+        return 'list({})'.format(', '.join(r_literal(v) for v in value))
+    return 'list({})'.format(', '.join('`{}` = {}'.format(k, r_literal(v)) for k, v in value.items()))
+
+
+# code that assigns a parameter, by kernel language:
+ASSIGN = {
+    'python': lambda name, value: '{} = {!r}'.format(name, value),
+    'r': lambda name, value: '{} <- {}'.format(name, r_literal(value)),
+}
+
+
+def parameter_blocks(ast: dict, params: dict) -> list:
+    """
+    Hidden code chunks that assign ``params`` in each kernel (and session)
+    of the document. Kernels of other languages than in ``ASSIGN`` are skipped.
+
+    Parameters
+    ----------
+    ast : dict
+        Pandoc JSON AST after pre-knitty
+    params : dict
+
+    Returns
+    -------
+    blocks : list
+    """
+    from .stitch.stitch import parse_kernel_arguments, is_code_block, is_executable
+    from .stitch.options import LangMapper
+    from .stitch.kernelspec import get_kernel_spec
+
+    lm = LangMapper(ast['meta'])
+    blocks, seen = [], set()
+    for block in ast['blocks']:
+        if not is_code_block(block):
+            continue
+        (lang, _), attrs = parse_kernel_arguments(block)
+        kernel_name = lm.map_to_kernel(lang)
+        session = attrs.get('session')
+        if not is_executable(block, kernel_name, attrs) or (kernel_name, session) in seen:
+            continue
+        seen.add((kernel_name, session))
+        # noinspection PyBroadException
+        try:
+            assign = ASSIGN.get(get_kernel_spec(kernel_name).language.lower())
+        except Exception:
+            continue
+        if assign is None:
+            continue
+        options = [['echo', 'False'], ['results', 'hide']] + ([['session', session]] if session else [])
+        code = '\n'.join(assign(name, value) for name, value in params.items())
+        blocks.append({'t': 'CodeBlock',
+                       'c': [['', [lang, 'knitty_params_{}'.format(len(blocks))], options], code]})
+    return blocks
+
+
+def output_path(template: str, index: int, params: dict) -> str:
+    """
+    Output file for the parameter set: ``template`` is formatted
+    with the parameters and ``index`` (number of the set).
+    """
+    try:
+        return template.format(index=index, **params)
+    except (KeyError, IndexError, ValueError) as e:
+        raise KnittyError('Invalid output template {!r} for parameter set {}: {!r}'.format(template, index, e))
+
+
+# -------------------------------------------
+# Rendering
+# -------------------------------------------
+class BatchRenderer:
+    """
+    Renders the parsed document with parameter sets.
+
+    Parameters
+    ----------
+    ast : dict
+        Pandoc JSON AST after pre-knitty
+    input_file : str
+    read : str
+        Pandoc reader format
+    to : str
+        Pandoc writer format
+    standalone : bool
+    self_contained : bool
+    pandoc_extra_args : list of str
+        Pandoc writer args
+    cache : bool
+        Knitty cache (per output)
+    """
+    def __init__(self, ast: dict, input_file: str, read: str="markdown", to: str=None,
+                 standalone: bool=False, self_contained: bool=False, pandoc_extra_args: list=None,
+                 cache: bool=True):
+        self.ast = ast
+        self.input_file = input_file
+        self.read = read
+        self.to = to
+        self.standalone = standalone
+        self.self_contained = self_contained
+        self.cache = cache
+        self.pandoc_extra_args = list(pandoc_extra_args) if pandoc_extra_args else []
+        if standalone:
+            self.pandoc_extra_args.append('--standalone')
+        if self_contained:
+            self.pandoc_extra_args.append('--self-contained')
+
+    def data_dir_name(self, output: str) -> str:
+        from .knitty import data_dir_name
+        from .pandoc_filter_arg import pandoc_filter_arg
+
+        return data_dir_name(pandoc_filter_arg(output, self.to), self.input_file, output)
+
+    def render(self, params: dict, output: str, kernel_pool=None):
+        """
+        Render the document with parameters to ``output``.
+        """
+        from .pandoc_filter_arg import pandoc_filter_arg
+        from .stitch.stitch import Stitch
+
+        ast = dict(self.ast, blocks=parameter_blocks(self.ast, params) + self.ast['blocks'])
+        filter_to = pandoc_filter_arg(output, self.to)
+        stitcher = Stitch(name=self.data_dir_name(output), filter_to=filter_to, standalone=self.standalone,
+                          self_contained=self.self_contained, pandoc_format=self.read,
+                          pandoc_extra_args=self.pandoc_extra_args, cache=self.cache, kernel_pool=kernel_pool)
+        try:
+            out = json.dumps(stitcher.stitch_ast(ast))
+        finally:
+            stitcher.release_kernels()
+        if p.dirname(output):
+            os.makedirs(p.dirname(output), exist_ok=True)
+        writer_args = (['-t', self.to] if self.to else []) + self.pandoc_extra_args
+        panflute().run_pandoc(out, ['-f', 'json'] + writer_args + ['-o', output])
+
+
+# Worker process state:
+_renderer = None  # type: Union[BatchRenderer, None]
+_pool = None
+
+
+def _init_worker(renderer: BatchRenderer):
+    from multiprocessing.util import Finalize
+    from .stitch.pool import KernelPool
+
+    global _renderer, _pool
+    _renderer, _pool = renderer, KernelPool()
+    # atexit handlers don't run in pool workers:
+    Finalize(_pool, _pool.shutdown, exitpriority=10)
+
+
+def _render(index: int, params: dict, output: str) -> dict:
+    start = time.perf_counter()
+    error = None
+    # noinspection PyBroadException
+    try:
+        _renderer.render(params, output, kernel_pool=_pool)
+    except Exception:
+        error = traceback.format_exc()
+    return dict(index=index, output=output, ok=error is None,
+                seconds=round(time.perf_counter() - start, 3), error=error)
+
+
+def summary_line(statuses: List[dict], seconds: float) -> str:
+    durations = [s['seconds'] for s in statuses]
+    failed = sum(1 for s in statuses if not s['ok'])
+    return 'rendered {} of {} in {:.2f}s (per render: mean {:.2f}s, max {:.2f}s){}'.format(
+        len(statuses) - failed, len(statuses), seconds,
+        sum(durations) / max(len(durations), 1), max(durations, default=0),
+        ', {} failed'.format(failed) if failed else '')
+
+
+@click.command(
+    context_settings=dict(ignore_unknown_options=True,
+                          allow_extra_args=True),
+    help=("Render INPUT_FILE once per parameter set from PARAMS_FILE (.csv or .jsonl): "
+          "pre-knitty → pandoc → knitty → pandoc. The source is parsed once, parameters are "
+          "assigned as variables in each kernel (Python and R) before the document chunks. "
+          "Renders run on a pool of worker processes with warm kernels. "
+          "Extra args are passed to Pandoc writer and to Knitty.")
+)
+@click.pass_context
+@click.argument('input_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('params_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output', 'template', type=str, required=True,
+              help='Output file template like "reports/{customer}.html" ' +
+                   '(formatted with the parameters and {index} of the parameter set).')
+@click.option('-j', '--jobs', type=int, default=0,
+              help='Number of worker processes. Default is the number of CPUs.')
+@click.option('-y', '--yaml', 'yaml_meta', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='yaml metadata file for pre-knitty and Pandoc.')
+@click.option('-f', '-r', '--from', '--read', 'read', type=str, default="markdown",
+              help='Pandoc reader option. Specify input format.')
+@click.option('-w', '-t', '--write', '--to', 'to', type=str, default=None,
+              help="Pandoc writer option. Specify output format.")
+@click.option('--standalone', is_flag=True, default=False,
+              help='Pandoc writer option. Produce a standalone document instead of fragment.')
+@click.option('--self-contained', is_flag=True, default=False,
+              help='Pandoc writer option. Store resources like images inside document instead of external files.')
+@click.option('--no-cache', 'no_cache', is_flag=True, default=False,
+              help='Turn off Knitty cache (it is per output).')
+@click.option('--summary', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='Write JSON list of render statuses to the file.')
+def main(ctx, input_file, params_file, template, jobs, yaml_meta, read, to, standalone, self_contained,
+         no_cache, summary):
+    from .pipeline import read_markdown
+
+    params = read_params(params_file)
+    outputs = [output_path(template, i, param_set) for i, param_set in enumerate(params)]
+    ast = json.loads(panflute().run_pandoc(read_markdown(input_file, yaml_meta), ['-f', read, '-t', 'json']))
+    renderer = BatchRenderer(ast, input_file, read=read, to=to, standalone=standalone,
+                             self_contained=self_contained, pandoc_extra_args=ctx.args, cache=not no_cache)
+    names = [renderer.data_dir_name(output) for output in outputs]
+    if len(set(names)) != len(names):
+        raise click.ClickException('Output files should have different names (they name Knitty data folders).')
+    if not params:
+        return
+    jobs = min(jobs if jobs > 0 else (os.cpu_count() or 1), len(params))
+
+    start = time.perf_counter()
+    statuses = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(renderer,)) as executor:
+        futures = [executor.submit(_render, i, param_set, output)
+                   for i, (param_set, output) in enumerate(zip(params, outputs))]
+        for future in as_completed(futures):
+            status = future.result()
+            statuses.append(status)
+            click.echo('[{}/{}] {} {} {:.2f}s'.format(len(statuses), len(params), 'ok' if status['ok'] else 'FAILED',
+                                                      status['output'], status['seconds']), err=True)
+            if status['error']:
+                click.echo(status['error'], err=True)
+    statuses.sort(key=lambda s: s['index'])
+    click.echo(summary_line(statuses, time.perf_counter() - start), err=True)
+    if summary:
+        with open(summary, 'w', encoding='utf-8') as f:
+            json.dump(statuses, f, indent=2)
+    if not all(s['ok'] for s in statuses):
+        ctx.exit(1)
+
+
+if __name__ == '__main__':
+    main()
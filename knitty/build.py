@@ -0,0 +1,410 @@
+"""
+Project builds: every ``.md`` and ``.py`` (with code cells) source in
+a directory is rendered next to itself (see ``discover``). Documents are parsed and
+planned on a pool of worker processes, then admitted for execution
+while the number of kernels they start fits the limit. Each worker
+keeps warm kernels between documents of the same directory (see
+``KernelPool``). Documents whose inputs didn't change since the last
+build are skipped (see ``MANIFEST``).
+"""
+import os
+import os.path as p
+import json
+import time
+import hashlib
+import traceback
+from collections import deque, namedtuple
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Iterable, List, Union
+
+import click
+
+from .batch import summary_line
+
+# build manifest in the project dir: fingerprints of the inputs of built documents
+MANIFEST = '.knitty-build.json'
+SOURCE_EXTS = ('.md', '.py')
+# longest first line of a .py file that is checked for a code cell:
+MAX_LINE = 2**16
+
+Document = namedtuple('Document', 'source output')
+
+
+# -------------------------------------------
+# Discovery
+# -------------------------------------------
+def is_source(path: str) -> bool:
+    """
+    ``.md`` files and ``.py`` files that start with a code cell
+    (like pre-knitty detects them, see ``SEARCH.HYDRO_FIRST_LINE``).
+    Only the first line of a ``.py`` file is read.
+    """
+    from .preprocess_filter import SEARCH
+
+    ext = p.splitext(path)[1].lower()
+    if ext == '.py':
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return bool(SEARCH.HYDRO_FIRST_LINE.match(f.readline(MAX_LINE)))
+    return ext in SOURCE_EXTS
+
+
+def excluded(path: str, exclude: Iterable[str]) -> bool:
+    """
+    Whether the name or the ``/`` separated path relative to the
+    project dir matches one of the ``exclude`` glob patterns.
+    """
+    return any(fnmatch(p.basename(path), pattern) or fnmatch(path, pattern) for pattern in exclude)
+
+
+def discover(root: str, ext: str, exclude: Iterable[str]=()) -> List[Document]:
+    """
+    Sources in the ``root`` dir (recursively) sorted by dir. Hidden dirs,
+    Knitty data folders, virtual environments and paths matching
+    ``exclude`` glob patterns are skipped. Output is the source with
+    ``ext`` extension.
+    """
+    docs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = p.relpath(dirpath, root).replace(os.sep, '/')
+
+        def relpath(name):
+            return name if rel == '.' else rel + '/' + name
+
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.startswith('.') and not d.endswith(('_files', '_cache')) and
+                             not p.exists(p.join(dirpath, d, 'pyvenv.cfg')) and
+                             not excluded(relpath(d), exclude))
+        for filename in sorted(filenames):
+            source = p.join(dirpath, filename)
+            if filename.startswith('.') or excluded(relpath(filename), exclude) or not is_source(source):
+                continue
+            output = p.splitext(source)[0] + '.' + ext
+            if output != source:
+                docs.append(Document(p.abspath(source), p.abspath(output)))
+    return docs
+
+
+def fingerprint(doc: Document, yaml_meta: Union[str, None], args: list) -> str:
+    """
+    Hash of the document inputs: the source, the yaml metadata file
+    and the build args.
+    """
+    h = hashlib.sha1(json.dumps(args).encode('utf-8'))
+    for path in [doc.source] + ([yaml_meta] if yaml_meta else []):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def load_manifest(root: str) -> Dict[str, str]:
+    try:
+        with open(p.join(root, MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(root: str, manifest: Dict[str, str]):
+    file = p.join(root, MANIFEST)
+    tmp = '{}.{}.tmp'.format(file, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, file)
+
+
+class Admission:
+    """
+    Admission of documents by the number of kernels they start:
+    a document is admitted if its kernels fit ``max_kernels``
+    (or if nothing else is running).
+    """
+    def __init__(self, max_kernels: int):
+        self.max_kernels = max_kernels
+        self.kernels = 0
+        self.documents = 0
+
+    def admits(self, kernels: int) -> bool:
+        return self.documents == 0 or self.kernels + kernels <= self.max_kernels
+
+    def enter(self, kernels: int):
+        self.kernels += kernels
+        self.documents += 1
+
+    def leave(self, kernels: int):
+        self.kernels -= kernels
+        self.documents -= 1
+
+
+# -------------------------------------------
+# Rendering
+# -------------------------------------------
+class ProjectBuilder:
+    """
+    Renders documents of the project. Methods are called with
+    the document dir as working dir.
+
+    Parameters
+    ----------
+    read : str
+        Pandoc reader format
+    to : str
+        Pandoc writer format
+    yaml_meta : str
+        path of yaml metadata file for pre-knitty and Pandoc
+    standalone : bool
+    self_contained : bool
+    pandoc_extra_args : list of str
+        Pandoc writer args
+    cache : bool
+        Knitty cache
+    """
+    def __init__(self, read: str="markdown", to: str=None, yaml_meta: str=None, standalone: bool=False,
+                 self_contained: bool=False, pandoc_extra_args: list=None, cache: bool=True):
+        self.read = read
+        self.to = to
+        self.yaml_meta = p.abspath(yaml_meta) if yaml_meta else None
+        self.standalone = standalone
+        self.self_contained = self_contained
+        self.cache = cache
+        self.pandoc_extra_args = list(pandoc_extra_args) if pandoc_extra_args else []
+        if standalone:
+            self.pandoc_extra_args.append('--standalone')
+        if self_contained:
+            self.pandoc_extra_args.append('--self-contained')
+
+    def stitcher(self, doc: Document, kernel_pool=None):
+        from .knitty import data_dir_name
+        from .pandoc_filter_arg import pandoc_filter_arg
+        from .stitch.stitch import Stitch
+
+        filter_to = pandoc_filter_arg(doc.output, self.to)
+        return Stitch(name=data_dir_name(filter_to, doc.source, doc.output), filter_to=filter_to,
+                      standalone=self.standalone, self_contained=self.self_contained, pandoc_format=self.read,
+                      pandoc_extra_args=self.pandoc_extra_args, cache=self.cache, kernel_pool=kernel_pool)
+
+    def parse(self, doc: Document) -> dict:
+        """
+        Pandoc JSON AST of the source after pre-knitty.
+        """
+        from .pipeline import read_markdown
+        from .tools import panflute
+
+        markdown = read_markdown(doc.source, self.yaml_meta)
+        return json.loads(panflute().run_pandoc(markdown, ['-f', self.read, '-t', 'json']))
+
+    def kernels(self, doc: Document, ast: dict) -> int:
+        """
+        Number of kernels the document starts (see ``Stitch.plan``).
+        """
+        from .tools import KnittyError
+
+        plan = self.stitcher(doc).plan(ast)
+        if not plan['ok']:
+            raise KnittyError('Invalid document (nothing was executed):\n' + '\n'.join(plan['errors']))
+        return sum(1 for kernel in plan['kernels'].values() if kernel['start'])
+
+    def render(self, doc: Document, ast: dict, kernel_pool=None):
+        from .tools import panflute
+
+        stitcher = self.stitcher(doc, kernel_pool)
+        try:
+            out = json.dumps(stitcher.stitch_ast(ast))
+        finally:
+            stitcher.release_kernels()
+        writer_args = (['-t', self.to] if self.to else []) + self.pandoc_extra_args
+        # temp output so that the previous output is kept if Pandoc fails:
+        tmp = '{0[0]}.{1}.tmp{0[1]}'.format(p.splitext(doc.output), os.getpid())  # Pandoc infers format by ext
+        panflute().run_pandoc(out, ['-f', 'json'] + writer_args + ['-o', tmp])
+        os.replace(tmp, doc.output)
+
+
+# Worker process state:
+_builder = None  # type: Union[ProjectBuilder, None]
+_pool = None
+
+
+def _init_worker(builder: ProjectBuilder):
+    from multiprocessing.util import Finalize
+    from .stitch.pool import KernelPool
+
+    global _builder, _pool
+    _builder, _pool = builder, KernelPool()
+    # atexit handlers don't run in pool workers:
+    Finalize(_pool, _pool.shutdown, exitpriority=10)
+
+
+def _chdir(doc: Document):
+    cwd = p.dirname(doc.source)
+    if cwd != os.getcwd():
+        # kernels are started in the document dir, idle ones of the other dir are not needed:
+        _pool.shutdown()
+        os.chdir(cwd)
+
+
+def _prepare(doc: Document) -> dict:
+    # noinspection PyBroadException
+    try:
+        _chdir(doc)
+        ast = _builder.parse(doc)
+        return dict(ast=ast, kernels=_builder.kernels(doc, ast), error=None)
+    except Exception:
+        return dict(ast=None, kernels=0, error=traceback.format_exc())
+
+
+def _render(doc: Document, ast: dict) -> Union[str, None]:
+    # noinspection PyBroadException
+    try:
+        _chdir(doc)
+        _builder.render(doc, ast, kernel_pool=_pool)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def build(root: str, docs: List[Document], builder: ProjectBuilder, jobs: int, max_kernels: int,
+          report=None) -> List[dict]:
+    """
+    Render the documents on ``jobs`` worker processes: at most ``jobs``
+    documents are parsed ahead, they are rendered in order when they
+    are admitted (see ``Admission``).
+
+    Parameters
+    ----------
+    root : str
+        project dir (source paths in statuses are relative to it)
+    docs : list of Document
+    builder : ProjectBuilder
+    jobs : int
+    max_kernels : int
+    report : callable, default None
+        ``report(status)`` is called when a document is done
+
+    Returns
+    -------
+    statuses : list of dict
+        in the order of ``docs``
+    """
+    admission = Admission(max_kernels)
+    pending = deque(enumerate(docs))
+    prepared = deque()
+    preparing = 0
+    futures = {}
+    statuses = []
+
+    def done(index, error, kernels, seconds):
+        status = dict(index=index, source=p.relpath(docs[index].source, root),
+                      output=p.relpath(docs[index].output, root), kernels=kernels,
+                      ok=error is None, seconds=round(seconds, 3), error=error)
+        statuses.append(status)
+        if report is not None:
+            report(status)
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(builder,)) as executor:
+        while pending or prepared or futures:
+            while prepared and admission.documents < jobs and admission.admits(prepared[0][2]):
+                index, ast, kernels, start = prepared.popleft()
+                admission.enter(kernels)
+                futures[executor.submit(_render, docs[index], ast)] = ('render', index, kernels, start)
+            while pending and preparing + len(prepared) < jobs:
+                index, doc = pending.popleft()
+                preparing += 1
+                futures[executor.submit(_prepare, doc)] = ('prepare', index, 0, time.perf_counter())
+            finished, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            for future in finished:
+                kind, index, kernels, start = futures.pop(future)
+                if kind == 'prepare':
+                    preparing -= 1
+                    result = future.result()
+                    if result['error'] is None:
+                        prepared.append((index, result['ast'], result['kernels'], start))
+                    else:
+                        done(index, result['error'], 0, time.perf_counter() - start)
+                else:
+                    admission.leave(kernels)
+                    done(index, future.result(), kernels, time.perf_counter() - start)
+    statuses.sort(key=lambda s: s['index'])
+    return statuses
+
+
+@click.command(
+    context_settings=dict(ignore_unknown_options=True,
+                          allow_extra_args=True),
+    help=("Render every .md source and .py source with code cells in DIR (recursively) next to it: "
+          "pre-knitty → pandoc → knitty → pandoc. Documents are rendered on a pool of worker processes "
+          "with warm kernels, a document starts when its kernels fit the --max-kernels limit. "
+          "Documents whose inputs didn't change since the last build are skipped. "
+          "Extra args are passed to Pandoc writer and to Knitty.")
+)
+@click.pass_context
+@click.argument('root', metavar='DIR', type=click.Path(exists=True, file_okay=False))
+@click.option('-e', '--ext', type=str, default='html',
+              help='Output files extension. Default is html.')
+@click.option('-j', '--jobs', type=int, default=0,
+              help='Number of worker processes. Default is the number of CPUs.')
+@click.option('-k', '--max-kernels', type=int, default=0,
+              help='Maximum number of kernels of the documents being rendered. Default is the number of CPUs.')
+@click.option('-y', '--yaml', 'yaml_meta', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='yaml metadata file for pre-knitty and Pandoc.')
+@click.option('-f', '-r', '--from', '--read', 'read', type=str, default="markdown",
+              help='Pandoc reader option. Specify input format.')
+@click.option('-w', '-t', '--write', '--to', 'to', type=str, default=None,
+              help="Pandoc writer option. Specify output format.")
+@click.option('--standalone', is_flag=True, default=False,
+              help='Pandoc writer option. Produce a standalone document instead of fragment.')
+@click.option('--self-contained', is_flag=True, default=False,
+              help='Pandoc writer option. Store resources like images inside document instead of external files.')
+@click.option('--no-cache', 'no_cache', is_flag=True, default=False,
+              help='Turn off Knitty cache.')
+@click.option('--force', is_flag=True, default=False,
+              help='Render all documents (even if their inputs did not change).')
+@click.option('--summary', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='Write JSON list of render statuses to the file.')
+@click.option('-x', '--exclude', type=str, multiple=True,
+              help=('Skip files and dirs whose name or path relative to DIR matches the glob pattern '
+                    '(like build or docs/drafts/*). Can be used several times.'))
+def main(ctx, root, ext, jobs, max_kernels, yaml_meta, read, to, standalone, self_contained, no_cache, force,
+         summary, exclude):
+    root = p.abspath(root)
+    docs = discover(root, ext.lstrip('.'), exclude)
+    names = [p.join(p.dirname(doc.output), p.basename(doc.output).replace('.', '_')) for doc in docs]
+    if len(set(names)) != len(names):
+        raise click.ClickException('Sources should have different names (they name outputs and Knitty data folders).')
+    builder = ProjectBuilder(read=read, to=to, yaml_meta=yaml_meta, standalone=standalone,
+                             self_contained=self_contained, pandoc_extra_args=ctx.args, cache=not no_cache)
+    args = [ext, read, to, builder.pandoc_extra_args, not no_cache]
+    manifest = load_manifest(root)
+    fingerprints = {doc.source: fingerprint(doc, builder.yaml_meta, args) for doc in docs}
+    stale = [doc for doc in docs if force or not p.exists(doc.output) or
+             manifest.get(p.relpath(doc.source, root)) != fingerprints[doc.source]]
+    up_to_date = len(docs) - len(stale)
+    reported = []
+
+    def report(status):
+        reported.append(status)
+        click.echo('[{}/{}] {} {} {:.2f}s'.format(len(reported), len(stale), 'ok' if status['ok'] else 'FAILED',
+                                                  status['output'], status['seconds']), err=True)
+        if status['error']:
+            click.echo(status['error'], err=True)
+        # the fingerprint of a failed document is removed: it's rendered next time
+        manifest.pop(status['source'], None)
+        if status['ok']:
+            manifest[status['source']] = fingerprints[stale[status['index']].source]
+        save_manifest(root, manifest)
+
+    start = time.perf_counter()
+    statuses = []
+    if stale:
+        cpus = os.cpu_count() or 1
+        statuses = build(root, stale, builder, jobs=min(jobs if jobs > 0 else cpus, len(stale)),
+                         max_kernels=max_kernels if max_kernels > 0 else cpus, report=report)
+    click.echo(summary_line(statuses, time.perf_counter() - start) + ', {} up to date'.format(up_to_date), err=True)
+    if summary:
+        with open(summary, 'w', encoding='utf-8') as f:
+            json.dump(statuses, f, indent=2)
+    if not all(s['ok'] for s in statuses):
+        ctx.exit(1)
+
+
+if __name__ == '__main__':
+    main()
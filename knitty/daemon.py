@@ -0,0 +1,261 @@
+"""
+Long-lived local daemon that owns a pool of warm kernels.
+Knitty CLI sends Pandoc JSON AST to the daemon via Unix socket
+(if the daemon is running) instead of starting new kernels.
+"""
+import os
+import io
+import sys
+import json
+import stat
+import socket
+import struct
+import tempfile
+import traceback
+import contextlib
+import socketserver
+from typing import Union, TYPE_CHECKING
+
+import click
+
+from .stitch.stitch import Stitch
+from .tools import KnittyError
+
+if TYPE_CHECKING:
+    from .stitch.pool import KernelPool  # imported by the server only (psutil)
+
+SOCKET_ENV = 'KNITTY_DAEMON_SOCKET'
+
+
+def private_dir() -> str:
+    """
+    ``XDG_RUNTIME_DIR`` or ``knitty-<uid>`` dir in the temp dir that only
+    the current user can access (it's created if needed).
+    """
+    path = os.environ.get('XDG_RUNTIME_DIR')
+    if path and os.path.isdir(path):
+        return path
+    if not hasattr(os, 'getuid'):
+        return tempfile.gettempdir()
+    path = os.path.join(tempfile.gettempdir(), 'knitty-{}'.format(os.getuid()))
+    with contextlib.suppress(FileExistsError):
+        os.mkdir(path, 0o700)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise KnittyError('{} is not a private dir of the current user'.format(path))
+    return path
+
+
+def default_socket_path() -> str:
+    """
+    ``KNITTY_DAEMON_SOCKET`` env var or per-user socket in ``private_dir``.
+    """
+    path = os.environ.get(SOCKET_ENV)
+    if path:
+        return path
+    return os.path.join(private_dir(), 'knitty-daemon.sock')
+
+
+def peer_uid(sock: socket.socket, path: str) -> Union[int, None]:
+    """
+    User id of the process on the other end of the connected Unix socket
+    (``SO_PEERCRED``) or of the socket file owner if it's not supported.
+    ``None`` if there are no user ids.
+    """
+    if not hasattr(os, 'getuid'):
+        return None
+    if hasattr(socket, 'SO_PEERCRED'):
+        _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                        struct.calcsize('3i')))
+        return uid
+    return os.stat(path).st_uid
+
+
+# -------------------------------------------
+# Protocol: 8 bytes length prefixed JSON
+# -------------------------------------------
+def send_msg(sock: socket.socket, obj: dict):
+    data = json.dumps(obj).encode('utf-8')
+    sock.sendall(struct.pack('>Q', len(data)) + data)
+
+
+def recv_msg(sock: socket.socket) -> dict:
+    def recv_exactly(n: int) -> bytes:
+        chunks = []
+        while n > 0:
+            chunk = sock.recv(min(n, 2**20))
+            if not chunk:
+                raise ConnectionError('daemon connection closed')
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b''.join(chunks)
+
+    size, = struct.unpack('>Q', recv_exactly(8))
+    return json.loads(recv_exactly(size).decode('utf-8'))
+
+
+# -------------------------------------------
+# Client
+# -------------------------------------------
+def request(obj: dict, path: str=None) -> Union[dict, None]:
+    """
+    Sends request to the daemon.
+    Returns ``None`` if the daemon is not running.
+    Raises ``KnittyError`` if the daemon is run by another user.
+    """
+    path = path if path else default_socket_path()
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        uid = peer_uid(sock, path)
+        if uid is not None and uid != os.getuid():
+            raise KnittyError('knitty daemon socket {} belongs to another user'.format(path))
+        send_msg(sock, obj)
+        return recv_msg(sock)
+
+
+def daemon_pandoc_filter(json_ast: str, path: str=None, **kwargs) -> Union[str, None]:
+    """
+    Same as ``knitty_pandoc_filter`` but runs in the daemon.
+    Returns ``None`` if the daemon is not running or the request
+    failed (the daemon died or it's not trusted).
+    Daemon's stderr output is written to stderr.
+    """
+    try:
+        response = request(dict(cmd='filter', cwd=os.getcwd(), ast=json_ast, kwargs=kwargs), path)
+    except (ConnectionError, KnittyError) as e:
+        print('knitty: daemon request failed, running without the daemon: {}'.format(e), file=sys.stderr)
+        return None
+    if response is None:
+        return None
+    sys.stderr.write(response['err'])
+    return response['out']
+
+
+# -------------------------------------------
+# Server
+# -------------------------------------------
+class KnittyDaemon(socketserver.UnixStreamServer):
+    """
+    Serves documents one at a time (it changes working dir to the client's one).
+    """
+    stopped = False
+
+    def __init__(self, path: str, pool: 'KernelPool'):
+        self.pool = pool
+        if os.path.exists(path):
+            if request(dict(cmd='status'), path) is not None:
+                raise KnittyError('knitty daemon is already running: {}'.format(path))
+            os.remove(path)
+        super().__init__(path, _Handler)
+
+    def serve(self):
+        while not self.stopped:
+            self.handle_request()
+
+    def stitch(self, req: dict) -> dict:
+        os.chdir(req['cwd'])
+        out = req['ast']
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            stitcher = Stitch(kernel_pool=self.pool, **req['kwargs'])
+            # noinspection PyBroadException
+            try:
+                out = json.dumps(stitcher.stitch_ast(json.loads(req['ast'])))
+            except Exception:
+                traceback.print_exc()
+            finally:
+                stitcher.release_kernels()
+            if stitcher.cache is not None:
+                print('knitty cache: ' + stitcher.cache.stats(), file=sys.stderr)
+        return dict(out=out, err=err.getvalue())
+
+    def server_close(self):
+        super().server_close()
+        with contextlib.suppress(OSError):
+            os.remove(self.server_address)
+        self.pool.shutdown()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        req = recv_msg(self.request)
+        cmd = req.get('cmd')
+        if cmd == 'filter':
+            send_msg(self.request, self.server.stitch(req))
+        elif cmd == 'status':
+            send_msg(self.request, dict(pid=os.getpid(), **self.server.pool.status()))
+        elif cmd == 'stop':
+            send_msg(self.request, dict(pid=os.getpid()))
+            self.server.stopped = True
+        else:
+            send_msg(self.request, dict(error='unknown command: {}'.format(cmd)))
+
+
+# -------------------------------------------
+# CLI
+# -------------------------------------------
+@click.group(help="Knitty daemon that keeps warm Jupyter kernels between documents. " +
+                  "When it's running Knitty CLI sends documents to it. Unix only.")
+@click.option('-s', '--socket', 'path', type=str, default=None,
+              help='Unix socket path. Default is $KNITTY_DAEMON_SOCKET or knitty-daemon.sock in ' +
+                   '$XDG_RUNTIME_DIR (or in private knitty-<uid> dir in temp dir).')
+@click.pass_context
+def cli(ctx, path):
+    ctx.obj = path if path else default_socket_path()
+
+
+@cli.command(help='Start the daemon in foreground.')
+@click.option('--max-documents', type=int, default=0,
+              help='Recycle a kernel after it served that many documents (0 means no limit).')
+@click.option('--max-rss', type=int, default=0,
+              help='Recycle a kernel when it uses more than that many MB of RAM (0 means no limit).')
+@click.option('--max-age', type=float, default=0,
+              help='Recycle a kernel when it is older than that many seconds (0 means no limit).')
+@click.option('-k', '--kernel', 'kernels', type=str, multiple=True,
+              help='Kernel name to start right away in the current working dir. Can be repeated.')
+@click.option('-p', '--profile', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Kernel profile YAML file: modules to import in new kernels and whether to fork ' +
+                   'Python kernels from a warm fork server. Default is $KNITTY_KERNEL_PROFILE.')
+@click.pass_obj
+def start(path, max_documents, max_rss, max_age, kernels, profile):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise KnittyError('knitty daemon needs Unix sockets')
+    from .stitch.pool import KernelPool
+    from .stitch.warmup import KernelProfile
+
+    pool = KernelPool(max_documents=max_documents, max_rss=max_rss, max_age=max_age,
+                      profile=KernelProfile.load(profile) if profile else None)
+    for kernel_name in kernels:
+        pool.prestart(kernel_name)
+    with KnittyDaemon(path, pool) as server:
+        click.echo('knitty daemon is listening on {}'.format(path), err=True)
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+
+
+@cli.command(help='Stop the daemon.')
+@click.pass_obj
+def stop(path):
+    if request(dict(cmd='stop'), path) is None:
+        raise click.ClickException('knitty daemon is not running')
+
+
+@cli.command(help='Print the daemon status as JSON.')
+@click.pass_obj
+def status(path):
+    response = request(dict(cmd='status'), path)
+    if response is None:
+        raise click.ClickException('knitty daemon is not running')
+    click.echo(json.dumps(response))
+
+
+if __name__ == '__main__':
+    cli()
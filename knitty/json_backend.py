@@ -0,0 +1,78 @@
+"""
+JSON (de)serialization of Pandoc AST on bytes with compact output.
+Uses ``orjson`` if it's installed and the standard ``json`` module otherwise.
+Backend can be set via ``KNITTY_JSON`` environment variable
+(``orjson`` or ``json``).
+
+Garbage collector is paused while parsing: JSON trees don't have
+reference cycles but millions of new containers trigger many full
+collections (they take most of the parsing time for large ASTs).
+"""
+import os
+import gc
+import json
+import contextlib
+from typing import Union
+
+from .tools import KnittyError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@contextlib.contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def json_loads(data: Union[bytes, str]):
+    with gc_paused():
+        return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode('ascii')
+
+
+def orjson_loads(data: Union[bytes, str]):
+    with gc_paused():
+        return orjson.loads(data)
+
+
+def orjson_dumps(obj) -> bytes:
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        # lone surrogates in strings or ints that don't fit 64 bits:
+        return json_dumps(obj)
+
+
+BACKENDS = {'json': (json_loads, json_dumps)}
+if orjson is not None:
+    BACKENDS['orjson'] = (orjson_loads, orjson_dumps)
+
+
+def get_backend(name: str=None) -> tuple:
+    """
+    Returns
+    -------
+    backend : tuple
+        ``(loads, dumps)`` functions where ``dumps`` returns UTF-8 bytes
+    """
+    if not name:
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in BACKENDS:
+        raise KnittyError("JSON backend '{}' is not available. Available: {}".format(
+            name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name]
+
+
+loads, dumps = get_backend(os.environ.get('KNITTY_JSON'))
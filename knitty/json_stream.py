@@ -0,0 +1,151 @@
+"""
+Incremental reading and writing of Pandoc JSON AST: ``blocks`` are parsed
+and written one at a time so memory is bounded by the largest block.
+"""
+import json
+from typing import Iterator, Tuple, TextIO
+
+from .tools import KnittyError
+
+CHUNK_SIZE = 2**16
+WHITESPACE = ' \t\n\r'
+
+
+class JSONStreamReader:
+    """
+    Reads JSON values one by one from a text stream.
+    """
+    def __init__(self, stream: TextIO, chunk_size: int=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self, size: int) -> bool:
+        """
+        Read more data. Returns ``False`` at EOF.
+        """
+        if self.eof:
+            return False
+        if self.pos > len(self.buf) // 2:
+            self.buf, self.pos = self.buf[self.pos:], 0
+        data = self.stream.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def peek(self) -> str:
+        """
+        Next non-whitespace char (empty string at EOF).
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill(self.chunk_size):
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise KnittyError('Invalid JSON: expected {!r} at {!r}'.format(
+                chars, self.buf[self.pos:self.pos + 40]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decode the next JSON value. The buffer is grown geometrically
+        until the value is complete.
+        """
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill(max(self.chunk_size, len(self.buf) - self.pos)):
+                    raise
+                continue
+            # numbers (and literals) may be cut at the buffer end:
+            if end == len(self.buf) and not isinstance(obj, (dict, list, str)) and self._fill(self.chunk_size):
+                continue
+            self.pos = end
+            return obj
+
+
+def read_pandoc_ast(stream: TextIO, chunk_size: int=CHUNK_SIZE) -> Tuple[list, dict, Iterator[dict]]:
+    """
+    Read Pandoc JSON AST from the stream. ``pandoc-api-version`` and ``meta``
+    are read right away (Pandoc writes them before ``blocks``), blocks are
+    read lazily. If ``blocks`` go first then the whole document is read.
+
+    Returns
+    -------
+    tuple
+        ``(version, meta, blocks)`` where blocks is an iterator
+    """
+    reader = JSONStreamReader(stream, chunk_size)
+    reader.expect('{')
+    doc = {}
+
+    def read_key():
+        key = reader.value()
+        reader.expect(':')
+        return key
+
+    def rest():
+        # remaining keys after blocks:
+        while reader.expect(',}') == ',':
+            key = read_key()
+            doc[key] = reader.value()
+
+    if reader.peek() != '}':
+        while True:
+            key = read_key()
+            if key == 'blocks' and 'meta' in doc and 'pandoc-api-version' in doc:
+                break
+            doc[key] = reader.value()
+            if reader.expect(',}') == '}':
+                rest = None
+                break
+
+    def iter_blocks():
+        if rest is None:
+            yield from doc.get('blocks', [])
+            return
+        reader.expect('[')
+        if reader.peek() == ']':
+            reader.pos += 1
+        else:
+            while True:
+                yield reader.value()
+                if reader.expect(',]') == ']':
+                    break
+        rest()
+
+    return doc.get('pandoc-api-version', []), doc.get('meta', {}), iter_blocks()
+
+
+class PandocASTWriter:
+    """
+    Writes Pandoc JSON AST to the stream block by block.
+    """
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.first = True
+
+    def start(self, version: list, meta: dict):
+        self.stream.write('{{"pandoc-api-version":{},"meta":{},"blocks":['.format(
+            json.dumps(version), json.dumps(meta)))
+
+    def write(self, block: dict):
+        if not self.first:
+            self.stream.write(',')
+        self.first = False
+        self.stream.write(json.dumps(block))
+
+    def end(self):
+        self.stream.write(']}')
@@ -1,12 +1,11 @@
 import sys
-from .ast_filter import knitty_pandoc_filter
+from .ast_filter import knitty_pandoc_filter, knitty_pandoc_filter_stream, knitty_plan
+from .daemon import daemon_pandoc_filter
 import click
 import os
 import os.path as p
 import re
-import panflute as pf
-import io
-from .consts import PANDOC_CODECELL_CLASSES
+import json
 from .tools import KnittyError
 
 
@@ -33,17 +32,24 @@ from .tools import KnittyError
 @click.option('--self-contained', is_flag=True, default=False,
               help='Pandoc writer option. Store resources like images inside document instead of external files. ' +
               'Affects Knitty behaviour and also is added to `pandoc_extra_args`.')
-def main(ctx, filter_to, input_file, read, output, to, standalone, self_contained):
+@click.option('--no-cache', 'no_cache', is_flag=True, default=False,
+              help='Do not use chunks execution results cache (execute all chunks).')
+@click.option('--refresh-cache', is_flag=True, default=False,
+              help='Ignore stored chunks execution results cache and overwrite it.')
+@click.option('--no-daemon', 'no_daemon', is_flag=True, default=False,
+              help='Do not send the document to the running knitty-daemon (start new kernels).')
+@click.option('--stream', is_flag=True, default=False,
+              help='Process and write blocks one at a time (bounded memory for huge documents). ' +
+              'Chunks are executed sequentially, the daemon is not used.')
+@click.option('--plan', is_flag=True, default=False,
+              help='Validate chunks and print JSON plan (kernels, cache hits, estimated duration) ' +
+              'instead of the document. Nothing is executed. Exit code is 1 if the plan failed.')
+def main(ctx, filter_to, input_file, read, output, to, standalone, self_contained, no_cache, refresh_cache,
+         no_daemon, stream, plan):
     if not filter_to:
         raise KnittyError(f"Invalid Pandoc filter arg: '{filter_to}'")
 
-    fmts = dict(commonmark='md', markdown='md', gfm='md')
-    if output and (output != '-'):
-        dir_name = p.basename(output).replace('.', '_')
-    elif input_file and (input_file != '-'):
-        dir_name = p.basename(input_file).replace('.', '_') + '_' + fmts.get(filter_to, filter_to)
-    else:
-        dir_name = 'stdout' + '_' + fmts.get(filter_to, filter_to)
+    dir_name = data_dir_name(filter_to, input_file, output)
 
     pandoc_extra_args = ctx.args
     if standalone:
@@ -51,30 +57,54 @@ def main(ctx, filter_to, input_file, read, output, to, standalone, self_containe
     if self_contained:
         pandoc_extra_args.append('--self-contained')
 
-    out = knitty_pandoc_filter(sys.stdin.read(),
-                               name=dir_name,
-                               filter_to=filter_to,
-                               standalone=standalone,
-                               self_contained=self_contained,
-                               pandoc_format=read,
-                               pandoc_extra_args=pandoc_extra_args)
-    if filter_to == 'ipynb':
-        with io.StringIO(out) as f:
-            doc = pf.load(f)
-        pf.run_filter(action, doc=doc)
-        with io.StringIO() as f:
-            pf.dump(doc, f)
-            out = f.getvalue()
-    sys.stdout.write(out)
+    kwargs = dict(name=dir_name,
+                  filter_to=filter_to,
+                  standalone=standalone,
+                  self_contained=self_contained,
+                  pandoc_format=read,
+                  pandoc_extra_args=pandoc_extra_args,
+                  cache=not no_cache,
+                  refresh_cache=refresh_cache)
+    if stream:
+        knitty_pandoc_filter_stream(sys.stdin, sys.stdout,
+                                    block_filter=ipynb_block_filter if filter_to == 'ipynb' else None, **kwargs)
+        return
+
+    json_ast = sys.stdin.buffer.read()
+    if plan:
+        result = knitty_plan(json_ast, **kwargs)
+        click.echo(json.dumps(result, indent=2))
+        sys.exit(0 if result['ok'] else 1)
+
+    out = None if no_daemon else daemon_pandoc_filter(json_ast.decode('utf-8'), **kwargs)
+    if out is None:
+        out = knitty_pandoc_filter(json_ast, **kwargs)
+    sys.stdout.flush()
+    sys.stdout.buffer.write(out.encode('utf-8') if isinstance(out, str) else out)
+    sys.stdout.buffer.flush()
+
+
+def data_dir_name(filter_to: str, input_file: str=None, output: str=None) -> str:
+    """
+    Name of the Knitty data folder (``name`` arg of ``Stitch``).
+    """
+    fmts = dict(commonmark='md', markdown='md', gfm='md')
+    if output and (output != '-'):
+        return p.basename(output).replace('.', '_')
+    elif input_file and (input_file != '-'):
+        return p.basename(input_file).replace('.', '_') + '_' + fmts.get(filter_to, filter_to)
+    else:
+        return 'stdout' + '_' + fmts.get(filter_to, filter_to)
+
 
+def ipynb_block_filter(version: list, meta: dict, block: dict) -> list:
+    """
+    Adds ``PANDOC_CODECELL_CLASSES`` to the code blocks with ``input=True``
+    in a single block (streaming mode, see ``notebook.ipynb_ast``).
+    """
+    from .stitch.notebook import codecell_classes, meta_value
 
-def action(elem, doc):
-    if isinstance(elem, pf.CodeBlock):
-        input_ = elem.attributes.get('input', doc.get_metadata('input'))
-        if str(input_).lower() == 'true':
-            for clss in PANDOC_CODECELL_CLASSES: 
-                if clss not in elem.classes:
-                    elem.classes.append(clss)
+    return [codecell_classes(block, meta_value(meta.get('input')))]
 
 
 if __name__ == '__main__':
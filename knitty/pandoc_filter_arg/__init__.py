@@ -1 +1 @@
-from .cli import cli, pandoc_filter_arg, doc  # noqa
+from .cli import cli, pandoc_filter_arg, resolve_filter_arg, doc  # noqa
@@ -1,10 +1,11 @@
 import os
 import os.path as p
+import json
 from subprocess import run, PIPE
 import re
 import sys
 import click
-from typing import Iterable
+from typing import Iterable, Union
 from shutilwhich_cwdpatch import which
 from ..tools import KnittyError
 
@@ -16,23 +17,73 @@ x
 '''.format(p.join(p.dirname(p.abspath(__file__)), 'pandoc_filter_arg', 'pandoc_filter_arg.py'))
 
 
-def pandoc_filter_arg(output: str=None, to: str=None, search_dirs: Iterable[str]=None) -> str:
+# Pandoc writers by output file extension (Pandoc's defaults that are the same in 2.x and 3.x):
+EXT_WRITERS = dict(html='html', htm='html', xhtml='html', tex='latex', latex='latex', pdf='latex',
+                   md='markdown', ipynb='ipynb', docx='docx', odt='odt', pptx='pptx', rst='rst', org='org',
+                   json='json')
+CACHE_ENV = 'KNITTY_FILTER_ARG_CACHE'
+WRITER = re.compile(r'^([a-z0-9_]+)(?:[+-][a-z0-9_]+)*$')
+
+
+def resolve_filter_arg(output: str=None, to: str=None) -> Union[str, None]:
     """
-    :param output: Pandoc writer option
-    :param to: Pandoc writer option
-    :param search_dirs: extra dirs to look for executables
-    :return: argument that is passed by Pandoc to it's filters
-        Uses Pandoc's defaults.
+    Argument that is passed by Pandoc to it's filters derived without
+    running Pandoc: the ``to`` writer without extensions or the default
+    writer for the ``output`` extension. ``None`` if it's not known
+    (custom writers, other extensions).
     """
-    if search_dirs:
-        path = os.environ.get("PATH", os.defpath)
-        kwargs = dict(path=os.pathsep.join(search_dirs) + ((os.pathsep + path) if path else ''))
-    else:
-        kwargs = {}
-    pandoc, panfl = which('pandoc', **kwargs), which('panfl', **kwargs)
-    if not (pandoc and panfl):
-        raise KnittyError("pandoc or panfl executable wasn't found")
+    if to:
+        match = WRITER.match(to)
+        return match.group(1) if match else None
+    if not output or output == '-':
+        return 'html'
+    return EXT_WRITERS.get(p.splitext(output)[1].lstrip('.').lower())
+
+
+def default_cache_path() -> str:
+    """
+    ``KNITTY_FILTER_ARG_CACHE`` env var or file in the per-user cache dir
+    (``XDG_CACHE_HOME`` or ``~/.cache``).
+    """
+    path = os.environ.get(CACHE_ENV)
+    if path:
+        return path
+    cache_home = os.environ.get('XDG_CACHE_HOME') or p.join(p.expanduser('~'), '.cache')
+    return p.join(cache_home, 'knitty', 'filter-arg.json')
+
+
+def load_cache(path: str) -> dict:
+    """
+    Cache file contents. Files of other users are ignored.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            if hasattr(os, 'getuid') and os.fstat(f.fileno()).st_uid != os.getuid():
+                return {}
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
 
+def save_cache(path: str, key: str, value: str):
+    cache = load_cache(path)
+    cache[key] = value
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        if p.dirname(path):
+            os.makedirs(p.dirname(path), mode=0o700, exist_ok=True)
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=0)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def probe_filter_arg(pandoc: str, panfl: str, output: str=None, to: str=None) -> str:
+    """
+    Run Pandoc with a filter that fails and prints the argument.
+    """
     args = [pandoc, '-f', 'markdown', '--filter', panfl, '-o', (output if output else '-')]
     if to:
         args += ['-t', to]
@@ -50,6 +101,44 @@ def pandoc_filter_arg(output: str=None, to: str=None, search_dirs: Iterable[str]
         return match
 
 
+def pandoc_filter_arg(output: str=None, to: str=None, search_dirs: Iterable[str]=None,
+                      cache_path: str=None) -> str:
+    """
+    :param output: Pandoc writer option
+    :param to: Pandoc writer option
+    :param search_dirs: extra dirs to look for executables
+    :param cache_path: probe results cache file (default is ``default_cache_path()``)
+    :return: argument that is passed by Pandoc to it's filters
+        Uses Pandoc's defaults. Common cases are resolved without running
+        Pandoc (see ``resolve_filter_arg``), otherwise Pandoc is probed and
+        the result is cached by Pandoc executable (path, size, modification
+        time), ``to`` and output extension.
+    """
+    resolved = resolve_filter_arg(output, to)
+    if resolved is not None:
+        return resolved
+
+    if search_dirs:
+        path = os.environ.get("PATH", os.defpath)
+        kwargs = dict(path=os.pathsep.join(search_dirs) + ((os.pathsep + path) if path else ''))
+    else:
+        kwargs = {}
+    pandoc, panfl = which('pandoc', **kwargs), which('panfl', **kwargs)
+    if not (pandoc and panfl):
+        raise KnittyError("pandoc or panfl executable wasn't found")
+
+    st = os.stat(pandoc)
+    ext = p.splitext(output)[1].lower() if output and output != '-' else ''
+    key = json.dumps([p.abspath(pandoc), st.st_size, st.st_mtime_ns, to, ext])
+    cache_path = cache_path if cache_path else default_cache_path()
+    cached = load_cache(cache_path).get(key)
+    if isinstance(cached, str):
+        return cached
+    arg = probe_filter_arg(pandoc, panfl, output, to)
+    save_cache(cache_path, key, arg)
+    return arg
+
+
 # noinspection PyUnusedLocal
 @click.command(
     context_settings=dict(ignore_unknown_options=True,
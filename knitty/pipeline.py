@@ -0,0 +1,322 @@
+"""
+Single-process pipeline: pre-knitty → Pandoc reader → Knitty → Pandoc
+writer. There are no extra Python interpreters and JSON AST pipes between
+the stages, Pandoc is run once for reading and once for writing and the
+filter argument is derived without running Pandoc in common cases (see
+``resolve_filter_arg``). Output of each stage is memoized by the hash of
+it's inputs (see ``StageMemo``) so unchanged stages are skipped.
+"""
+import os
+import os.path as p
+import sys
+import json
+import glob
+import time
+import hashlib
+from typing import List, Tuple, Union
+
+import click
+
+from .preprocess_filter import knitty_preprosess
+
+# bump to invalidate memoized stages:
+MEMO_VERSION = 1
+STAGES = ('pre-knitty', 'pandoc reader', 'knitty', 'pandoc writer')
+
+
+def read_markdown(input_file: str, yaml_meta: str=None) -> str:
+    """
+    Source file after pre-knitty (with yaml metadata file contents prepended).
+    """
+    with open(input_file, 'r', encoding='utf-8') as f:
+        text = f.read()
+    yaml_text = None
+    if yaml_meta:
+        with open(yaml_meta, 'r', encoding='utf-8') as f:
+            yaml_text = f.read()
+    ext = p.splitext(p.basename(input_file))[1].lstrip('.')
+    text = knitty_preprosess(text, ext, yaml_text)
+    return yaml_text + '\n\n' + text if yaml_text else text
+
+
+class StageMemo:
+    """
+    The last output of each stage keyed by the hash of the stage inputs.
+    Stored in ``path`` dir (memo is off if it's ``None``).
+
+    Parameters
+    ----------
+    path : str or None
+    """
+    def __init__(self, path: Union[str, None]):
+        self.path = path
+
+    @staticmethod
+    def key(*parts) -> str:
+        h = hashlib.sha1(str(MEMO_VERSION).encode('ascii'))
+        for part in parts:
+            h.update(part if isinstance(part, bytes) else repr(part).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def file(self, stage: str, key: str) -> str:
+        return p.join(self.path, '{}.{}'.format(stage.replace(' ', '-'), key))
+
+    def get(self, stage: str, key: str) -> Union[bytes, None]:
+        if self.path is None:
+            return None
+        try:
+            with open(self.file(stage, key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, stage: str, key: str, data: bytes):
+        """
+        Store the output of the stage (replaces the previous one).
+        """
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        file = self.file(stage, key)
+        tmp = '{}.{}.tmp'.format(file, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, file)
+        for stale in glob.glob(self.file(stage, '*')):
+            if stale != file and not stale.endswith('.tmp'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+
+def read_bytes(path: Union[str, None]) -> Union[bytes, None]:
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def file_hash(path: str) -> Union[str, None]:
+    try:
+        return hashlib.sha1(read_bytes(path)).hexdigest()
+    except OSError:
+        return None
+
+
+def pandoc_id() -> tuple:
+    """
+    Pandoc executable path, modification time and size
+    (instead of running ``pandoc --version``).
+    """
+    from shutilwhich_cwdpatch import which
+
+    pandoc = which('pandoc')
+    if pandoc is None:
+        return None,
+    st = os.stat(pandoc)
+    return pandoc, st.st_mtime_ns, st.st_size
+
+
+def render(input_file: str, output: str, read: str="markdown", to: str=None, yaml_meta: str=None,
+           standalone: bool=False, self_contained: bool=False, pandoc_extra_args: list=None,
+           cache: bool=True, refresh_cache: bool=False, memo: bool=True,
+           direct_ipynb: bool=False) -> List[Tuple[str, bool]]:
+    """
+    Render the document to ``output`` in this process.
+
+    Parameters
+    ----------
+    input_file : str
+    output : str
+    read : str
+        Pandoc reader format
+    to : str
+        Pandoc writer format
+    yaml_meta : str
+        path of yaml metadata file for pre-knitty and Pandoc
+    standalone : bool
+    self_contained : bool
+    pandoc_extra_args : list of str
+        Pandoc writer args
+    cache : bool
+        Knitty cache. Knitty stage is memoized only if it's on
+        (like the chunks it's output is taken from the previous render).
+    refresh_cache : bool
+        Ignore stored Knitty cache and memoized Knitty stage.
+    memo : bool
+        Memoize stages (in ``<name>_cache/pipeline`` dir).
+    direct_ipynb : bool
+        Knitty writes the notebook itself (see ``Stitch.stitch_notebook``)
+        instead of Pandoc's ipynb writer: outputs are stored as the kernel
+        sent them. Output format must be ipynb.
+
+    Returns
+    -------
+    stages : list of (str, bool)
+        stage names and whether the stage was run (or skipped)
+    """
+    from . import json_backend
+    from .knitty import data_dir_name
+    from .tools import KnittyError
+    from .pandoc_filter_arg import pandoc_filter_arg
+    from .stitch.stitch import Stitch
+    from .stitch.pool import shutdown
+
+    pandoc_extra_args = list(pandoc_extra_args) if pandoc_extra_args else []
+    if standalone:
+        pandoc_extra_args.append('--standalone')
+    if self_contained:
+        pandoc_extra_args.append('--self-contained')
+    filter_to = pandoc_filter_arg(output, to)
+    if direct_ipynb and filter_to != 'ipynb':
+        raise KnittyError(f"Direct notebook writer needs ipynb output format (got '{filter_to}').")
+    name = data_dir_name(filter_to, input_file, output)
+    memo = StageMemo(p.join(Stitch.name_cache_dir(name), 'pipeline') if memo else None)
+    pandoc = pandoc_id()
+    stages = []
+
+    # pre-knitty:
+    key = StageMemo.key(read_bytes(input_file), read_bytes(yaml_meta), input_file)
+    markdown = memo.get(STAGES[0], key)
+    stages.append((STAGES[0], markdown is None))
+    if markdown is None:
+        markdown = read_markdown(input_file, yaml_meta).encode('utf-8')
+        memo.put(STAGES[0], key, markdown)
+
+    # Pandoc reader:
+    key = StageMemo.key(markdown, read, pandoc)
+    json_ast = memo.get(STAGES[1], key)
+    stages.append((STAGES[1], json_ast is None))
+    if json_ast is None:
+        json_ast = run_pandoc(markdown.decode('utf-8'), ['-f', read, '-t', 'json']).encode('utf-8')
+        memo.put(STAGES[1], key, json_ast)
+
+    # Knitty:
+    stitcher = Stitch(name=name, filter_to=filter_to, standalone=standalone, self_contained=self_contained,
+                      pandoc_format=read, pandoc_extra_args=pandoc_extra_args, cache=cache,
+                      refresh_cache=refresh_cache)
+    key = StageMemo.key(json_ast, name, filter_to, standalone, self_contained, read, pandoc_extra_args, pandoc,
+                        direct_ipynb)
+    ast = json_backend.loads(json_ast)
+    # chunks with cache=False are always executed:
+    memoized = cache and not refresh_cache and not has_uncached(ast)
+    stitched = memo.get(STAGES[2], key) if memoized else None
+    if stitched is not None and not direct_ipynb and not resources_exist(json_backend.loads(stitched),
+                                                                          stitcher.resource_dir):
+        stitched = None
+    stages.append((STAGES[2], stitched is None))
+    if stitched is None:
+        try:
+            if direct_ipynb:
+                nb = stitcher.stitch_notebook(ast)
+                stitched = (json.dumps(nb, indent=1, ensure_ascii=False) + '\n').encode('utf-8')
+            else:
+                stitched = json_backend.dumps(stitcher.stitch_ast(ast))
+        finally:
+            for kp in stitcher.kernel_managers.values():
+                shutdown(kp)
+        if memoized:
+            memo.put(STAGES[2], key, stitched)
+
+    # Pandoc writer (or the notebook as is):
+    writer_args = (['-t', to] if to else []) + pandoc_extra_args
+    key = StageMemo.key(stitched, writer_args, p.abspath(output), pandoc, direct_ipynb)
+    written = memo.get(STAGES[3], key)
+    run = written is None or written.decode('ascii') != file_hash(output)
+    stages.append((STAGES[3], run))
+    if run:
+        if p.dirname(output):
+            os.makedirs(p.dirname(output), exist_ok=True)
+        if direct_ipynb:
+            tmp = '{}.{}.tmp'.format(output, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(stitched)
+            os.replace(tmp, output)
+        else:
+            run_pandoc(stitched.decode('utf-8'), ['-f', 'json'] + writer_args + ['-o', output])
+        memo.put(STAGES[3], key, (file_hash(output) or '').encode('ascii'))
+    return stages
+
+
+def run_pandoc(text: str, args: list) -> str:
+    from .tools import panflute
+
+    return panflute().run_pandoc(text, args)
+
+
+def has_uncached(ast: dict) -> bool:
+    """
+    Whether the document has code chunks with ``cache=False``.
+    """
+    from .stitch.stitch import is_code_block, parse_kernel_arguments
+
+    return any(parse_kernel_arguments(block)[1].get('cache') is False
+               for block in ast['blocks'] if is_code_block(block))
+
+
+def resources_exist(ast: dict, resource_dir: str) -> bool:
+    """
+    Whether images in ``resource_dir`` that the stitched AST links
+    (see ``Stitch.wrap_image_output``) exist.
+    """
+    prefix = p.join(resource_dir, '')
+
+    def walk(obj):
+        if isinstance(obj, dict):
+            if obj.get('t') == 'Image':
+                target = obj['c'][2][0]
+                if target.startswith(prefix) and not p.exists(target):
+                    return False
+            return all(walk(v) for v in obj.values())
+        if isinstance(obj, list):
+            return all(walk(v) for v in obj)
+        return True
+
+    return walk(ast['blocks'])
+
+
+@click.command(
+    context_settings=dict(ignore_unknown_options=True,
+                          allow_extra_args=True),
+    help=("Render INPUT_FILE in one process: pre-knitty → pandoc → knitty → pandoc. "
+          "Output of each stage is memoized by the hash of it's inputs and unchanged stages are skipped. "
+          "Extra args are passed to Pandoc writer and to Knitty.")
+)
+@click.pass_context
+@click.argument('input_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output', type=str, required=True,
+              help='Pandoc writer option. Output file.')
+@click.option('-y', '--yaml', 'yaml_meta', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='yaml metadata file for pre-knitty and Pandoc.')
+@click.option('-f', '-r', '--from', '--read', 'read', type=str, default="markdown",
+              help='Pandoc reader option. Specify input format.')
+@click.option('-w', '-t', '--write', '--to', 'to', type=str, default=None,
+              help="Pandoc writer option. Specify output format.")
+@click.option('--standalone', is_flag=True, default=False,
+              help='Pandoc writer option. Produce a standalone document instead of fragment.')
+@click.option('--self-contained', is_flag=True, default=False,
+              help='Pandoc writer option. Store resources like images inside document instead of external files.')
+@click.option('--no-cache', 'no_cache', is_flag=True, default=False,
+              help='Do not use chunks execution results cache (execute all chunks).')
+@click.option('--refresh-cache', is_flag=True, default=False,
+              help='Ignore stored chunks execution results cache and overwrite it.')
+@click.option('--no-memo', 'no_memo', is_flag=True, default=False,
+              help='Run all stages (do not memoize their output).')
+@click.option('--direct-ipynb', is_flag=True, default=False,
+              help=('Write ipynb output without Pandoc: code cells keep the original outputs of the kernel '
+                    '(images, html etc.). Markdown cells are converted by Pandoc.'))
+def main(ctx, input_file, output, yaml_meta, read, to, standalone, self_contained, no_cache, refresh_cache,
+         no_memo, direct_ipynb):
+    start = time.perf_counter()
+    stages = render(input_file, output, read=read, to=to, yaml_meta=yaml_meta, standalone=standalone,
+                    self_contained=self_contained, pandoc_extra_args=ctx.args, cache=not no_cache,
+                    refresh_cache=refresh_cache, memo=not no_memo, direct_ipynb=direct_ipynb)
+    print('rendered {} in {:.2f}s ({})'.format(
+        output, time.perf_counter() - start,
+        ', '.join('{}: {}'.format(stage, 'run' if run else 'skipped') for stage, run in stages)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,33 @@
 """
 CLI wrapper for stitch_preprosess function
 """
+import io
 import sys
+import codecs
 from os import path as p
-from .preprocess_filter import knitty_preprosess
+from typing import Iterator
+from .preprocess_filter import knitty_preprosess_stream, BLOCK
 import click
 from .consts import META_COMMENTS_MAP, META_KNITTY_COMMENTS_EXT, META_KNITTY_LANG
 
 
+def read_stdin() -> Iterator[str]:
+    """
+    Reads stdin like ``sys.stdin.read()`` but yields the text as soon as it's available.
+    """
+    buffer = getattr(sys.stdin, 'buffer', None)
+    if not hasattr(buffer, 'read1'):
+        yield from sys.stdin
+        return
+    decoder = io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder(sys.stdin.encoding)(errors=sys.stdin.errors), translate=True)
+    while True:
+        data = buffer.read1(BLOCK)
+        yield decoder.decode(data, final=not data)
+        if not data:
+            break
+
+
 @click.command(help=f"""A text filter that reads from stdin and writes to stdout.
 INPUT_FILE is optional but it helps to determine language and hence a Jupyter kernel.\n
 Settings that can be set in stdin OR in the --yaml file:\n
@@ -22,16 +42,23 @@ Can be set in stdin metadata only: 1) Force set document default language name,
 {META_KNITTY_LANG}: 'py2'\n
 {META_KNITTY_COMMENTS_EXT}: 'py'\n
 ...\n
+stdin is converted as a stream: output is written as soon as the first
+metadata block ends (or after --meta-lines lines).
 """)
 @click.argument('input_file', type=click.Path(), default=None, required=False)
 @click.option('-y', '--yaml', 'yaml_meta', type=click.Path(), default=None, required=False,
               help='yaml metadata file (wrapped in ---... like in pandoc) with settings for pre-knitty. ')
-def main(input_file, yaml_meta):
+@click.option('-m', '--meta-lines', type=int, default=None,
+              help='Search stdin metadata in the first META_LINES lines only. By default the output ' +
+                   'is held back until the first metadata block ends (until EOF if there is no metadata).')
+def main(input_file, yaml_meta, meta_lines):
     ext = p.splitext(p.basename(input_file))[1].lstrip('.') if input_file else None
     if yaml_meta:
         with open(yaml_meta, 'r', encoding='utf-8') as y:
             yaml_meta = y.read()
-    sys.stdout.write(knitty_preprosess(sys.stdin.read(), ext, yaml_meta))
+    for text in knitty_preprosess_stream(read_stdin(), ext, yaml_meta, meta_lines):
+        sys.stdout.write(text)
+        sys.stdout.flush()
 
 
 if __name__ == '__main__':
@@ -7,8 +7,11 @@ that originally comes from *Python Cookbook* 3E, recipie 2.18
 """
 import re
 from collections import namedtuple
-from typing import List, Tuple, Iterable, Union
+from functools import lru_cache
+from itertools import chain
+from typing import List, Tuple, Iterable, Iterator, Union
 from .tools import load_yaml, get, strict_str
+from .tools.tools import yaml_regex
 from .consts import META_COMMENTS_MAP, META_KNITTY_COMMENTS_EXT, META_KNITTY_LANG
 
 Token = namedtuple("Token", ['kind', 'value'])
@@ -205,7 +208,7 @@ class Replacer:
             begin, end = read('BEGIN'), read('END')
             nl_post_begin, nl_pre_end = read('NL_POST_BEGIN'), read('NL_PRE_END')
             if (begin, end) in self._block_comm:
-                if not re.search(rf"{re.escape(begin)}|{re.escape(end)}", body):
+                if begin not in body and end not in body:
                     block_comm = True
             if not block_comm:
                 if begin:
@@ -234,26 +237,16 @@ class Replacer:
             return ''
 
 
-def knitty_preprosess(source: str, lang: str=None, yaml_meta: str=None) -> str:
+def read_settings(metadata: dict, lang: str=None, yaml_meta: str=None) -> Tuple[str, Union[List[str], None]]:
     """
-    Stitch options preprocess function. Transforms document.
+    Default language and comments spec from the document metadata
+    and pre-knitty settings (see ``knitty_preprosess``).
 
-    Also converts document with Hydrogen code cells
-    to markdown document with code chunks.
-
-    Parameters
-    ----------
-    source :
-        ...
-    lang :
-        Default language. When used with `pre-knitty` CLI the file's extension is passed.
-        If `lang` arg is `None` but `knitty-comments-ext` metadata key is set then uses the key.
-        Otherwise uses 'py' that is `Replacer` class default.
-    yaml_meta :
-        pre-knitty settings via read YAML file contents
+    Returns
+    -------
+    tuple :
+        (lang, comments)
     """
-    # Read metadata:
-    metadata = load_yaml(source)[1]
     # Read lang extension used for getting comments spec from metadata:
     _lang = strict_str(get(metadata, META_KNITTY_LANG))
     comment_lang = strict_str(get(metadata, META_KNITTY_COMMENTS_EXT))
@@ -270,7 +263,7 @@ def knitty_preprosess(source: str, lang: str=None, yaml_meta: str=None) -> str:
         """
         Returns comments list if found them in right format.
         """
-        for meta in (lambda: metadata, lambda: load_yaml(yaml_meta)[1]):
+        for meta in (lambda: metadata, lambda: yaml_settings(yaml_meta)):
             comments_map = get(meta(), META_COMMENTS_MAP)
             _comments = get(comments_map, comment_lang)
             if isinstance(_comments, list):
@@ -279,7 +272,303 @@ def knitty_preprosess(source: str, lang: str=None, yaml_meta: str=None) -> str:
                         return _comments
         return None
 
-    comments = comments()
+    return lang, comments()
+
+
+@lru_cache(maxsize=16)
+def yaml_settings(yaml_meta: Union[str, None]) -> dict:
+    """
+    Parsed pre-knitty settings file contents (parsed once per contents).
+    """
+    return load_yaml(yaml_meta)[1]
+
+
+@lru_cache(maxsize=None)
+def hydro_line(comm: str):
+    """
+    Compiled regex of the Hydrogen cell line for the escaped inline
+    comment ``comm`` (matches at line starts only).
+    Has groups: OPT, LANG.
+    """
+    return re.compile('(?m)^' + SEARCH._HYDRO_LINE.format(comm=comm, opt=SEARCH._GFM_OPT))
+
+
+class Groups(dict):
+    """
+    Regex match substitute for ``Replacer.replace_cells``.
+    """
+    def group(self, name: str):
+        return self.get(name)
+
+
+NEWLINE = re.compile(r'\r?\n?')
+CHUNK_LINE = re.compile(r'\n[@`]')
+META_END = re.compile(r'(?m)^(?:---|\.\.\.)$')
+# size of stdin reads in pre-knitty CLI (bytes):
+BLOCK = 2**16
+
+
+class Tokenizer:
+    """
+    Line-oriented tokenizer that gives the same output as the whole
+    file regex substitution (see ``regex_preprosess``) in linear time.
+    Text is read in blocks of complete lines and converted cells are
+    emitted as soon as the next cell line is read.
+
+    Hydrogen cells: cell lines are found with ``hydro_line`` regex,
+    the cell text between them is split into block comments and the body
+    without regex backtracking (see ``split_cell``).
+
+    Code chunks: ``SEARCH.PATTERN`` is substituted in blocks that are cut
+    right before lines that can't start a match (not ``@`` or `````).
+    Quoted option values with new lines inside are not supported.
+
+    Parameters
+    ----------
+    lang :
+        Default language (see ``Replacer``).
+    comments :
+        Comments spec: inline comment and pairs of block comments.
+        ``None`` turns code cells mode off unless the first line is a cell line.
+    """
+    def __init__(self, lang: str=None, comments: List[str]=None):
+        self.lang = lang
+        self.comments = comments
+
+    @staticmethod
+    def blocks(chunks: Iterable[str], end: str='') -> Iterator[str]:
+        """
+        Regroups text chunks to the blocks of complete lines
+        (adds ``end`` to the last line).
+        """
+        tail = ''
+        for chunk in chunks:
+            i = chunk.rfind('\n')
+            if i < 0:
+                tail += chunk
+                continue
+            yield tail + chunk[:i + 1]
+            tail = chunk[i + 1:]
+        if tail or end:
+            yield tail + end
+
+    def tokenize(self, chunks: Iterable[str]) -> Iterator[str]:
+        """
+        Converts text chunks (like lines of a file) and yields converted text.
+        """
+        chunks = iter(chunks)
+        head = ''
+        for chunk in chunks:
+            head += chunk
+            if '\n' in chunk:
+                break
+        chunks = chain((head,), chunks)
+        comments, block_comm = self.comments, ()
+        if comments:
+            comm = re.escape(comments[0])
+            if len(comments) > 2:
+                block_comm = tuple((comments[i], comments[i + 1])
+                                   for i in range(1, len(comments), 2))
+        else:
+            first_line = SEARCH.HYDRO_FIRST_LINE.match(head[:head.find('\n') + 1] or head)
+            comm = re.escape(first_line.group('COMM')) if first_line else None
+        if comm is not None:
+            # regex assumes new line at the end:
+            chunks = self.cells(self.blocks(chunks, end='\n'), hydro_line(comm), block_comm)
+        return self.chunks(chunks)
+
+    def cells(self, blocks: Iterable[str], line, block_comm: Tuple[Tuple[str, str], ...]) -> Iterator[str]:
+        """
+        Converts document with Hydrogen code cells (see ``Replacer.replace_cells``).
+        """
+        replacer = Replacer(self.lang, block_comm)
+        begins = tuple(str(begin) for begin, e in block_comm)
+        ends = tuple(str(end) for b, end in block_comm)
+        header, body, bof = None, [], True
+
+        def convert(text: str) -> str:
+            groups = split_cell(text, begins, ends)
+            if header is not None:
+                groups.update(OPT=header.group('OPT'), LANG=header.group('LANG'))
+            return replacer.replace_cells(groups)
+
+        for block in blocks:
+            pos = 0
+            for m in line.finditer(block):
+                start = m.start()
+                if start > pos:
+                    body.append(block[pos:start])
+                    pos = start
+                if not body:
+                    if bof and start == 0:
+                        header, pos = m, m.end()
+                    # else: cell line right after the cell line is cell body
+                    continue
+                text = ''.join(body)[:-1]  # new line before the cell line is kept
+                if continues(text, header is None, begins):
+                    continue
+                yield convert(text) + '\n'
+                header, body, pos = m, [], m.end()
+            if pos < len(block):
+                body.append(block[pos:])
+            bof = False
+        yield convert(''.join(body))
+
+    def chunks(self, chunks: Iterable[str]) -> Iterator[str]:
+        """
+        Replaces Knitty-format code chunk options with Pandoc-format ones.
+        """
+        replace = Replacer(self.lang).replace
+        buf = ''
+        for chunk in chunks:
+            # only new lines that were not checked yet:
+            lo = max(len(buf) - 1, 0)
+            buf += chunk
+            i = buf.rfind('\n', lo)
+            while i >= 0 and (i + 1 == len(buf) or buf[i + 1] in '@`'):
+                i = buf.rfind('\n', lo, i)
+            if i >= 0:
+                yield sub(replace, buf[:i + 1])
+                buf = buf[i + 1:]
+        yield sub(replace, buf)
+
+
+def sub(replace, text: str) -> str:
+    """
+    ``re.sub(SEARCH.PATTERN, replace, text)`` that tries to match only
+    before lines that start with ``@`` or ````` (matches start at
+    new lines before them).
+    """
+    out, pos = [], 0
+    starts = (m.start() + 1 for m in CHUNK_LINE.finditer(text))
+    for start in chain((0,) if text.startswith(('@', '`')) else (), starts):
+        if start > 0:
+            start -= 2 if start > 1 and text[start - 2] == '\r' else 1
+        if start < pos:
+            continue
+        m = SEARCH.PATTERN.match(text, start)
+        if m is not None:
+            out += [text[pos:start], replace(m)]
+            pos = m.end()
+    out.append(text[pos:])
+    return ''.join(out)
+
+
+def continues(text: str, bof: bool, begins: Tuple[str, ...]) -> bool:
+    """
+    Whether the cell ``text`` continues after the next cell line
+    (mimics the regex: new line after the begin block comment is
+    the new line before the cell line, empty match at BOF).
+    """
+    if begins:
+        begin = next((b for b in begins if text.startswith(b)), '')
+        return text[len(begin):] in ('', '\r')
+    return bof and not text
+
+
+def split_cell(text: str, begins: Tuple[str, ...], ends: Tuple[str, ...]) -> Groups:
+    """
+    Splits the cell text like ``SEARCH.hydro_regex`` does.
+    Has groups: BODY, BEGIN, END, NL_POST_BEGIN, NL_PRE_END.
+    """
+    if not begins:
+        return Groups(BODY=text.rstrip())
+    begin = next((b for b in begins if text.startswith(b)), None)
+    pos = len(begin) if begin else 0
+    nl_post_begin = NEWLINE.match(text, pos).group()
+    rest = text[pos + len(nl_post_begin):]
+    stripped = rest.rstrip()
+    i, end, nl_pre_end = len(stripped), None, ''
+    for e in ends:
+        if stripped.endswith(e):
+            j = len(stripped) - len(e)
+            nl = '\r\n' if rest.endswith('\r\n', 0, j) else rest[j - 1:j] if rest[j - 1:j] in ('\r', '\n') else ''
+            if j - len(nl) < i:
+                i, end, nl_pre_end = j - len(nl), e, nl
+    return Groups(BEGIN=begin, NL_POST_BEGIN=nl_post_begin, BODY=rest[:i], NL_PRE_END=nl_pre_end, END=end)
+
+
+def read_metadata(chunks: Iterable[str], max_lines: int=None) -> Tuple[str, dict]:
+    """
+    Reads text chunks until the end of the first yaml metadata block
+    (or first ``max_lines`` lines, or EOF).
+
+    Returns
+    -------
+    tuple :
+        (text_read, first_yaml_dict)
+    """
+    head = []
+    lines = 0
+    for chunk in chunks:
+        head.append(chunk)
+        lines += chunk.count('\n')
+        if max_lines is not None and lines >= max_lines:
+            text = ''.join(head)
+            return text, load_yaml('\n'.join(text.split('\n', max_lines)[:max_lines]))[1]
+        if META_END.search(chunk):
+            text = ''.join(head)
+            head = [text]
+            if yaml_regex.search(text):
+                return text, load_yaml(text)[1]
+    text = ''.join(head)
+    return text, load_yaml(text)[1]
+
+
+def knitty_preprosess(source: str, lang: str=None, yaml_meta: str=None) -> str:
+    """
+    Stitch options preprocess function. Transforms document.
+
+    Also converts document with Hydrogen code cells
+    to markdown document with code chunks.
+
+    Parameters
+    ----------
+    source :
+        ...
+    lang :
+        Default language. When used with `pre-knitty` CLI the file's extension is passed.
+        If `lang` arg is `None` but `knitty-comments-ext` metadata key is set then uses the key.
+        Otherwise uses 'py' that is `Replacer` class default.
+    yaml_meta :
+        pre-knitty settings via read YAML file contents
+    """
+    lang, comments = read_settings(load_yaml(source)[1], lang, yaml_meta)
+    return ''.join(Tokenizer(lang, comments).tokenize((source,)))
+
+
+def knitty_preprosess_stream(chunks: Iterable[str], lang: str=None, yaml_meta: str=None,
+                             meta_lines: int=None) -> Iterator[str]:
+    """
+    Streaming ``knitty_preprosess``: converts text chunks and yields
+    converted text as soon as possible. The text is held back until the
+    first yaml metadata block ends (the whole text if there is no
+    metadata) unless metadata is searched in the first ``meta_lines`` only.
+
+    Parameters
+    ----------
+    chunks :
+        text chunks like lines of a file
+    lang :
+        see ``knitty_preprosess``
+    yaml_meta :
+        see ``knitty_preprosess``
+    meta_lines :
+        search yaml metadata in the first ``meta_lines`` lines only
+    """
+    chunks = iter(chunks)
+    head, metadata = read_metadata(chunks, meta_lines)
+    lang, comments = read_settings(metadata, lang, yaml_meta)
+    return Tokenizer(lang, comments).tokenize(chain((head,), chunks))
+
+
+def regex_preprosess(source: str, lang: str=None, yaml_meta: str=None) -> str:
+    """
+    Reference ``knitty_preprosess`` implementation with whole file regex
+    substitution (the tokenizer gives the same output). Backtracks badly
+    on large files.
+    """
+    lang, comments = read_settings(load_yaml(source)[1], lang, yaml_meta)
     first_line = SEARCH.HYDRO_FIRST_LINE.match(source)
     if comments or first_line:
         block_comm = tuple()
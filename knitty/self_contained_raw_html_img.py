@@ -1,28 +1,169 @@
-import shutilwhich_cwdpatch.patch
+"""
+Replaces images with their self-contained html output as raw inline html.
+Local images (and data URIs) with plain alt text and width/height in pixels
+are embedded in-process with the same html that Pandoc 3 writes: each
+distinct file is read and encoded once, in a thread pool. Other images
+(remote, unsupported attributes or types, older Pandoc) are converted by Pandoc.
+"""
 import re
+import base64
+import os.path as p
+from functools import lru_cache
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Union
+
 import panflute as pf
-if hasattr(pf.tools, 'which'):
-    from shutilwhich_cwdpatch import which
-    pf.tools.which = which
-else:
-    raise RuntimeError('panflute patch failed')
+from .tools import panflute
+
+MIME_TYPES = dict(png='image/png', jpg='image/jpeg', jpeg='image/jpeg', gif='image/gif', svg='image/svg+xml')
+URL_SCHEME = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:')
+PIXELS = re.compile(r'^(\d+)(?:px)?$')
+ALT_INLINES = (pf.Str, pf.Space, pf.SoftBreak, pf.LineBreak, pf.Emph, pf.Strong, pf.Strikeout, pf.Span, pf.Code)
+WORKERS = 8
+
+
+@lru_cache(maxsize=None)
+def pandoc_major() -> int:
+    out = pf.run_pandoc(args=['--version'])
+    return int(re.search(r'\d+', out.splitlines()[0]).group(0))
+
+
+def image_file(url: str) -> Union[str, None]:
+    """
+    Local file of the image (``None`` for remote images, data URIs
+    and unsupported types).
+    """
+    if URL_SCHEME.match(url):
+        return None
+    path = unquote(url)
+    if p.splitext(path)[1].lstrip('.').lower() not in MIME_TYPES:
+        return None
+    return path
+
+
+def data_uri(path: str) -> Union[str, None]:
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    mime = MIME_TYPES[p.splitext(path)[1].lstrip('.').lower()]
+    return 'data:{};base64,{}'.format(mime, base64.b64encode(data).decode('ascii'))
+
+
+def encode_images(paths) -> Dict[str, Union[str, None]]:
+    """
+    Data URIs of the image files (``None`` if file can't be read).
+    """
+    paths = sorted(set(paths))
+    if len(paths) <= 1:
+        return {path: data_uri(path) for path in paths}
+    with ThreadPoolExecutor(max_workers=min(WORKERS, len(paths))) as executor:
+        return dict(zip(paths, executor.map(data_uri, paths)))
+
+
+def alt_text(elem: pf.Image) -> Union[str, None]:
+    """
+    Alt text like Pandoc's ``stringify`` (``None`` if there are
+    inlines that are not supported).
+    """
+    parts = []
+
+    def walk(inlines):
+        for inline in inlines:
+            if not isinstance(inline, ALT_INLINES):
+                return False
+            if isinstance(inline, (pf.Str, pf.Code)):
+                parts.append(inline.text)
+            elif isinstance(inline, (pf.Space, pf.SoftBreak, pf.LineBreak)):
+                parts.append(' ')
+            elif not walk(inline.content):
+                return False
+        return True
+
+    return ''.join(parts) if walk(elem.content) else None
+
+
+def escape(value: str) -> str:
+    # the same entities as Pandoc writes:
+    return (value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            .replace('"', '&quot;').replace("'", '&#39;'))
+
+
+def raw_html(elem: pf.Image, images: Dict[str, Union[str, None]]) -> Union[str, None]:
+    """
+    Self-contained ``<img>`` tag as Pandoc 3 writes it for the image
+    in a paragraph (``None`` if it should be converted by Pandoc).
+    """
+    alt = alt_text(elem)
+    if alt is None or set(elem.attributes) - {'width', 'height'}:
+        return None
+    dims = {}
+    for dim in ('width', 'height'):
+        if dim in elem.attributes:
+            match = PIXELS.match(elem.attributes[dim])
+            if match is None:
+                return None
+            dims[dim] = match.group(1)
+    if elem.url.startswith('data:'):
+        src = elem.url
+    else:
+        path = image_file(elem.url)
+        if path is None:
+            return None
+        src = images[path] if path in images else data_uri(path)
+        if src is None:
+            return None
+
+    attrs = [('role', 'img')] + ([('aria-label', alt)] if alt else []) + [('src', src)]
+    attrs += [(name, value) for name, value in (('title', elem.title), ('id', elem.identifier),
+                                                ('class', ' '.join(elem.classes))) if value]
+    attrs += list(dims.items()) + ([('alt', alt)] if alt else [])
+    return '<img {} />'.format(' '.join('{}="{}"'.format(name, escape(value)) for name, value in attrs))
+
+
+def pandoc_raw_html(elem: pf.Image) -> str:
+    return re.search(
+        r'<figure>.*?</figure>|<img.*?>',
+        pf.convert_text(pf.Para(elem), input_format='panflute',
+                        output_format='html', standalone=True,
+                        extra_args=['--self-contained']),
+        re.DOTALL
+    ).group(0).replace('\n', '').replace('\r', '')
+
+
+def prepare(doc):
+    """
+    Encode image files of the document in a thread pool.
+    """
+    paths = []
+
+    # noinspection PyUnusedLocal
+    def collect(elem, doc_):
+        if isinstance(elem, pf.Image):
+            path = image_file(elem.url)
+            if path is not None:
+                paths.append(path)
+
+    doc.walk(collect)
+    doc.knitty_images = encode_images(paths) if pandoc_major() >= 3 else {}
 
 
 # noinspection PyUnusedLocal
 def action(elem, doc):
     if isinstance(elem, pf.Image):
-        raw_html = re.search(
-            r'<figure>.*?</figure>|<img.*?>',
-            pf.convert_text(pf.Para(elem), input_format='panflute',
-                            output_format='html', standalone=True,
-                            extra_args=['--self-contained']),
-            re.DOTALL
-        ).group(0).replace('\n', '').replace('\r', '')
-        return pf.RawInline(raw_html, format='html')
+        html = None
+        if pandoc_major() >= 3:
+            html = raw_html(elem, getattr(doc, 'knitty_images', {}))
+        if html is None:
+            html = pandoc_raw_html(elem)
+        return pf.RawInline(html, format='html')
 
 
 def main(doc=None):
-    return pf.run_filter(action, doc=doc)
+    panflute()  # patch ``which``
+    return pf.run_filter(action, prepare=prepare, doc=doc)
 
 
 if __name__ == '__main__':
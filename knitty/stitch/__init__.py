@@ -1 +1,2 @@
 from .stitch import kernel_factory, run_code, Stitch, KnittyError # noqa
+from .cache import ChunkCache, MemoryCache, chunk_key  # noqa
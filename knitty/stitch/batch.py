@@ -0,0 +1,107 @@
+"""
+Batching of Pandoc conversions of kernel outputs:
+one Pandoc call per format and extra args instead of one per output.
+"""
+import re
+import uuid
+import threading
+from typing import Callable, List
+
+MARKDOWN_FORMATS = re.compile(r'^(markdown|gfm|commonmark)')
+
+# Sources that can be converted differently when they are a part of the bigger
+# document: headers (auto identifiers), setext headers and yaml (lines of = or -),
+# references and footnotes, citations and example lists (@), title block (%).
+NOT_BATCHABLE = re.compile(r'(^|\n)(#|[=-]+[ \t]*(\n|$))|\]:|\[\^|@|^%')
+
+
+class Pending:
+    """
+    Placeholder for output blocks that are yet to be converted.
+    """
+    def __init__(self, source: str, pandoc_format: str, pandoc_extra_args: list):
+        self.source = source
+        self.pandoc_format = pandoc_format
+        self.pandoc_extra_args = pandoc_extra_args if pandoc_extra_args else []
+        self.blocks = None
+
+
+class TokenizeBatch:
+    """
+    Collects pending conversions. Sources of the same markdown format
+    and extra args are joined with unique sentinel paragraphs, converted
+    by one Pandoc call and split back. If anything goes wrong
+    then sources are converted one by one.
+    """
+    def __init__(self):
+        self.pending = []  # type: List[Pending]
+        self._lock = threading.Lock()
+
+    def add(self, source: str, pandoc_format: str="markdown", pandoc_extra_args: list=None) -> Pending:
+        pending = Pending(source, pandoc_format, pandoc_extra_args)
+        with self._lock:
+            self.pending.append(pending)
+        return pending
+
+    @staticmethod
+    def batchable(pending: Pending) -> bool:
+        return (MARKDOWN_FORMATS.match(pending.pandoc_format) is not None and
+                not NOT_BATCHABLE.search(pending.source))
+
+    @staticmethod
+    def convert(group: List[Pending], tokenize: Callable):
+        sentinel = 'KNITTYBATCH{}N'.format(uuid.uuid4().hex)
+        source = ''.join(
+            p.source if i == 0 else '\n\n{}{}\n\n{}'.format(sentinel, i, p.source)
+            for i, p in enumerate(group)
+        )
+        first = group[0]
+        try:
+            blocks = tokenize(source, first.pandoc_format, first.pandoc_extra_args)
+        except Exception:
+            blocks = []
+        parts, i = [[]], 1
+        for block in blocks:
+            if block == {'t': 'Para', 'c': [{'t': 'Str', 'c': '{}{}'.format(sentinel, i)}]}:
+                parts.append([])
+                i += 1
+            else:
+                parts[-1].append(block)
+        if len(parts) == len(group):
+            for p, part in zip(group, parts):
+                p.blocks = part
+
+    def flush(self, blocks: list, tokenize: Callable) -> list:
+        """
+        Convert all pending sources and replace placeholders.
+
+        Parameters
+        ----------
+        blocks : list
+            blocks with ``Pending`` placeholders
+        tokenize : callable
+            ``tokenize_block`` function
+
+        Returns
+        -------
+        blocks : list
+        """
+        groups = {}
+        for p in self.pending:
+            if self.batchable(p):
+                groups.setdefault((p.pandoc_format, tuple(p.pandoc_extra_args)), []).append(p)
+        for group in groups.values():
+            if len(group) > 1:
+                self.convert(group, tokenize)
+        for p in self.pending:
+            if p.blocks is None:
+                p.blocks = tokenize(p.source, p.pandoc_format, p.pandoc_extra_args)
+        self.pending = []
+
+        new_blocks = []
+        for block in blocks:
+            if isinstance(block, Pending):
+                new_blocks.extend(block.blocks)
+            else:
+                new_blocks.append(block)
+        return new_blocks
@@ -0,0 +1,219 @@
+"""
+Content-addressed on-disk cache of code chunks execution results.
+"""
+import os
+import re
+import json
+import glob
+import hashlib
+import threading
+from typing import Iterable, Union
+
+TIMINGS = 'timings.json'
+KEY = re.compile(r'^[0-9a-f]{64}$')
+
+
+def chunk_key(kernel_name: str, code: str, attrs: dict, parents: Iterable[str]=()) -> str:
+    """
+    Hash of a code chunk.
+
+    Parameters
+    ----------
+    kernel_name : str
+    code : str
+    attrs : dict
+        resolved chunk options
+    parents : iterable of str
+        keys of the chunks that the chunk state depends on
+        (the previous chunk executed by the same kernel)
+
+    Returns
+    -------
+    key : str
+        hex digest
+    """
+    data = json.dumps([kernel_name, code, attrs, list(parents)],
+                      sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def strip_message(message: dict) -> dict:
+    """
+    Keep only parts of the iopub message that are used by ``Stitch.wrap_output``.
+    """
+    return {'msg_type': message['msg_type'],
+            'header': {'msg_type': message['header']['msg_type']},
+            'content': message['content']}
+
+
+class ChunkCache:
+    """
+    Stores iopub messages of executed code chunks in ``path`` dir.
+    One JSON file per chunk key. Results that the last render didn't use
+    are removed (see ``prune``) so the cache doesn't grow with every edit.
+
+    Attributes
+    ----------
+    path : str
+    refresh : bool
+        Whether to ignore stored results (they are overwritten then).
+    hits : int
+    misses : int
+    used : set of str
+        keys that were got or put during the current render
+    """
+    def __init__(self, path: str, refresh: bool=False):
+        self.path = path
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        self._lock = threading.Lock()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key: str) -> Union[list, None]:
+        """
+        Returns stored messages or ``None``. Counts hits and misses.
+        """
+        messages = None
+        self.used.add(key)
+        if not self.refresh:
+            try:
+                with open(self._file(key), 'r', encoding='utf-8') as f:
+                    messages = json.load(f)
+            except (OSError, ValueError):
+                pass
+        self.count(messages is not None)
+        return messages
+
+    def contains(self, key: str) -> bool:
+        """
+        Whether the key is stored (doesn't count hits and misses).
+        """
+        return not self.refresh and os.path.isfile(self._file(key))
+
+    def count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key: str, messages: list):
+        """
+        Atomically writes messages to the cache.
+        """
+        self.used.add(key)
+        os.makedirs(self.path, exist_ok=True)
+        file = self._file(key)
+        tmp = '{}.{}.{}.tmp'.format(file, os.getpid(), threading.get_ident())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump([strip_message(m) for m in messages], f, default=str)
+        os.replace(tmp, file)
+
+    def stats(self) -> str:
+        return '{} hits, {} misses'.format(self.hits, self.misses)
+
+    def prune(self):
+        """
+        Remove stored results that were not used during the current
+        render (should be called only if the render succeeded:
+        results of the chunks after a failed one are not used).
+        """
+        for file in glob.glob(os.path.join(glob.escape(self.path), '*.json')):
+            key = os.path.basename(file)[:-len('.json')]
+            if KEY.match(key) and key not in self.used:
+                try:
+                    os.remove(file)
+                except OSError:
+                    pass
+
+    def load_timings(self) -> dict:
+        """
+        Durations of the previous runs (seconds): ``{'chunks': {chunk_name: t},
+        'kernels': {kernel_name: startup_t}}``.
+        """
+        timings = {'chunks': {}, 'kernels': {}}
+        try:
+            with open(os.path.join(self.path, TIMINGS), 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            for kind in timings:
+                timings[kind].update(stored.get(kind, {}))
+        except (OSError, ValueError, AttributeError):
+            pass
+        return timings
+
+    def save_timings(self, timings: dict):
+        os.makedirs(self.path, exist_ok=True)
+        file = os.path.join(self.path, TIMINGS)
+        tmp = '{}.{}.tmp'.format(file, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(timings, f)
+        os.replace(tmp, file)
+
+
+class MemoryCache(ChunkCache):
+    """
+    Keeps messages of the chunks of the previous render only (watch mode
+    with warm kernels: the kernel state corresponds to the previous render
+    so older results can't be reused). Nothing is written to disk
+    (``path`` is used for checkpoints only).
+
+    Attributes
+    ----------
+    previous : dict
+        messages of the previous render by key
+    current : dict
+        messages of the current render by key
+    executed : bool
+        whether chunks were executed during the current render
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.previous = {}
+        self.current = {}
+        self.executed = False
+        self.timings = {'chunks': {}, 'kernels': {}}
+
+    def next_render(self):
+        """
+        Start a render (results are looked up in the previous one).
+        """
+        self.current = {}
+        self.executed = False
+        self.hits = self.misses = 0
+
+    def finish_render(self, ok: bool):
+        """
+        Results of the render are used by the next one. If the render
+        failed before any chunk was executed the previous results are
+        kept: the kernel state has not changed.
+        """
+        if ok or self.executed:
+            self.previous = self.current
+        self.current = {}
+
+    def get(self, key: str) -> Union[list, None]:
+        messages = self.previous.get(key)
+        if messages is not None:
+            self.current[key] = messages
+        self.count(messages is not None)
+        return messages
+
+    def contains(self, key: str) -> bool:
+        return key in self.previous
+
+    def put(self, key: str, messages: list):
+        self.current[key] = [strip_message(m) for m in messages]
+        self.executed = True
+
+    def prune(self):
+        pass  # only the previous render is kept anyway
+
+    def load_timings(self) -> dict:
+        return self.timings
+
+    def save_timings(self, timings: dict):
+        self.timings = timings
@@ -0,0 +1,113 @@
+"""
+Snapshots of Python kernel user namespace (via ``dill`` or ``cloudpickle``
+installed in the kernel environment) that let a render resume from
+the first changed chunk instead of replaying all previous chunks.
+"""
+import os
+import re
+import hashlib
+from typing import Iterable
+
+from pandocfilters import CodeBlock
+
+SKIPPED = 'knitty-snapshot-skipped:'
+
+# If pickling fails then unpicklable variables are found (by pickling them
+# one by one to a null stream) and skipped:
+SNAPSHOT_CODE = '''\
+def _knitty_snapshot(path):
+    import os
+    try:
+        import dill as pickler
+    except ImportError:
+        import cloudpickle as pickler
+
+    class Null:
+        def write(self, b):
+            return len(b)
+
+    ip = get_ipython()
+    skip = set(ip.user_ns_hidden) | {{'In', 'Out', 'exit', 'quit', 'get_ipython'}}
+    ns = {{k: v for k, v in ip.user_ns.items() if not k.startswith('_') and k not in skip}}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{{}}.{{}}.tmp'.format(path, os.getpid())
+
+    def dump():
+        with open(tmp, 'wb') as f:
+            pickler.dump({{'ns': ns, 'execution_count': ip.execution_count}}, f)
+
+    try:
+        try:
+            dump()
+        except Exception:
+            skipped = []
+            for k in sorted(ns):
+                try:
+                    pickler.dump(ns[k], Null())
+                except Exception:
+                    skipped.append(k)
+                    del ns[k]
+            print({skipped!r}, ', '.join(skipped))
+            dump()
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+_knitty_snapshot({path!r})
+del _knitty_snapshot
+'''
+
+# The cell increments execution count after it's executed:
+RESTORE_CODE = '''\
+def _knitty_restore(path):
+    try:
+        import dill as pickler
+    except ImportError:
+        import cloudpickle as pickler
+    ip = get_ipython()
+    with open(path, 'rb') as f:
+        data = pickler.load(f)
+    ip.user_ns.update(data['ns'])
+    ip.execution_count = data['execution_count'] - 1
+_knitty_restore({path!r})
+del _knitty_restore
+'''
+
+
+def state_key(prev: str, key: str) -> str:
+    """
+    Key of the kernel state after the chunk: depends on the keys
+    of all executed chunks of the kernel.
+    """
+    return hashlib.sha256('{}:{}'.format(prev or '', key).encode('utf-8')).hexdigest()
+
+
+def checkpoint_path(path: str, chunk_name: str, state: str) -> str:
+    return os.path.join(path, '{}.{}.pkl'.format(chunk_name, state))
+
+
+def snapshot_code(path: str) -> str:
+    """
+    Code that saves the kernel namespace to ``path``.
+    """
+    return SNAPSHOT_CODE.format(path=os.path.abspath(path), skipped=SKIPPED)
+
+
+def restore_block(path: str) -> dict:
+    """
+    Code block that restores the kernel namespace from ``path``.
+    It's replayed like the cached chunks.
+    """
+    return CodeBlock(['', [], []], RESTORE_CODE.format(path=os.path.abspath(path)))
+
+
+def remove_stale(path: str, chunk_name: str, keep: Iterable[str]=()):
+    """
+    Remove old snapshots of the chunk.
+    """
+    keep = {os.path.abspath(p) for p in keep}
+    pattern = re.compile(re.escape(chunk_name) + r'\.[0-9a-f]{64}\.pkl$')
+    for name in (os.listdir(path) if os.path.isdir(path) else []):
+        file = os.path.join(path, name)
+        if pattern.match(name) and os.path.abspath(file) not in keep:
+            os.remove(file)
@@ -0,0 +1,391 @@
+"""
+Static def-use analysis of Python code chunks for incremental
+re-execution: the cache key of a chunk depends on the keys of the chunks
+that define the names it uses (instead of the previous chunk key).
+
+The analysis is an approximation:
+
+* ``x.attr = ...``, ``x[i] = ...`` and ``x.method(...)`` are treated
+  as redefinitions of ``x`` (possible mutation),
+* mutation of arguments inside functions is not tracked,
+* functions and classes carry the global names they use (and the names
+  they declare ``global``) to the chunks that call them.
+
+Chunks that can't be analysed (syntax errors, IPython magics, shell
+commands, ``exec``, ``globals()``, ``from m import *``, output history
+variables like ``_``) are barriers: they depend on all previous chunks and
+all next chunks depend on them.
+"""
+import re
+import ast
+from functools import lru_cache
+from typing import Dict, List, Set, Tuple, Union
+
+from .cache import chunk_key
+from .kernelspec import get_kernel_spec
+
+BARRIER_NAMES = frozenset(['exec', 'eval', 'globals', 'locals', 'vars', '__import__',
+                           'get_ipython', '__builtins__'])
+HISTORY_NAME = re.compile(r'^(_+|_\d+|_i+|_i\d+|_ih|_oh|_dh|In|Out)$')
+
+Closure = Tuple[Set[str], Set[str]]
+
+
+class Names:
+    """
+    Names of a chunk.
+
+    Attributes
+    ----------
+    defines : set of str
+        global names that the chunk (re)defines
+    uses : set of str
+        global names that the chunk reads
+    closures : dict
+        ``(uses, defines)`` of functions and classes defined by the chunk
+        (names used and declared ``global`` in their bodies)
+    """
+    def __init__(self):
+        self.defines = set()  # type: Set[str]
+        self.uses = set()  # type: Set[str]
+        self.closures = {}  # type: Dict[str, Closure]
+
+
+class _Visitor(ast.NodeVisitor):
+    def __init__(self):
+        self.names = Names()
+        self.barrier = False
+
+    def use(self, name):
+        if name in BARRIER_NAMES or HISTORY_NAME.match(name):
+            self.barrier = True
+        self.names.uses.add(name)
+
+    def define(self, name):
+        self.names.defines.add(name)
+        self.names.closures.pop(name, None)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.use(node.id)
+        else:
+            self.define(node.id)
+
+    def _base(self, node):
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        return node.id if isinstance(node, ast.Name) else None
+
+    def _mutate(self, node):
+        name = self._base(node)
+        if name is not None:
+            self.use(name)
+            self.define(name)
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._mutate(node)
+        self.generic_visit(node)
+
+    visit_Subscript = visit_Attribute
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute):
+            self._mutate(node.func.value)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.use(node.target.id)
+        self.generic_visit(node)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.define(node.name)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.barrier = True
+            else:
+                self.define(alias.asname or alias.name.split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def _scope(self, nodes) -> Closure:
+        """
+        Names that are read in a nested scope and names declared global there.
+        """
+        loads, stores, globals_ = set(), set(), set()
+        for node in nodes:
+            for sub in ast.walk(node):
+                if isinstance(sub, ast.Name):
+                    (loads if isinstance(sub.ctx, ast.Load) else stores).add(sub.id)
+                elif isinstance(sub, ast.Global):
+                    globals_.update(sub.names)
+                elif isinstance(sub, (ast.Import, ast.ImportFrom)) and any(a.name == '*' for a in sub.names):
+                    self.barrier = True
+        for name in loads:
+            if name in BARRIER_NAMES:
+                self.barrier = True
+        return loads, globals_
+
+    def _function_header(self, node):
+        args = node.args
+        for sub in args.defaults + [d for d in args.kw_defaults if d is not None]:
+            self.visit(sub)
+        for sub in getattr(node, 'decorator_list', []):
+            self.visit(sub)
+
+    def visit_FunctionDef(self, node):
+        self._function_header(node)
+        self.define(node.name)
+        self.names.closures[node.name] = self._scope(node.body)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        self._function_header(node)
+        self.names.uses.update(self._scope([node.body])[0])
+
+    def visit_ClassDef(self, node):
+        for sub in node.bases + node.keywords + node.decorator_list:
+            self.visit(sub)
+        uses, globals_ = self._scope(node.body)
+        self.names.uses.update(uses)
+        self.define(node.name)
+        self.names.closures[node.name] = (uses, globals_)
+
+    def _visit_comprehension(self, node):
+        uses, _ = self._scope([node])
+        stores = {sub.id for gen in node.generators for sub in ast.walk(gen.target)
+                  if isinstance(sub, ast.Name)}
+        for name in uses - stores:
+            self.use(name)
+        for gen in node.generators:
+            for sub in ast.walk(gen.iter):
+                if isinstance(sub, ast.Call) and isinstance(sub.func, ast.Attribute):
+                    self._mutate(sub.func.value)
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_comprehension
+
+
+def to_python(code: str) -> str:
+    """
+    Translate IPython syntax (magics, shell commands) to Python.
+    """
+    try:
+        from IPython.core.inputtransformer2 import TransformerManager
+    except ImportError:
+        return code
+    return TransformerManager().transform_cell(code)
+
+
+def syntax_error(code: str) -> Union[str, None]:
+    """
+    Compile Python code chunk (IPython syntax is allowed).
+
+    Returns
+    -------
+    error : str or None
+    """
+    try:
+        compile(to_python(code), '<chunk>', 'exec', flags=getattr(ast, 'PyCF_ALLOW_TOP_LEVEL_AWAIT', 0),
+                dont_inherit=True)
+    except SyntaxError as e:
+        return 'SyntaxError: {} (line {})'.format(e.msg, e.lineno)
+    except ValueError as e:
+        return 'ValueError: {}'.format(e)
+    return None
+
+
+def chunk_names(code: str) -> Union[Names, None]:
+    """
+    Static analysis of Python code chunk.
+
+    Returns
+    -------
+    names : Names or None
+        ``None`` if the chunk is a barrier.
+    """
+    try:
+        tree = ast.parse(to_python(code))
+    except (SyntaxError, ValueError):
+        return None
+    visitor = _Visitor()
+    visitor.visit(tree)
+    return None if visitor.barrier else visitor.names
+
+
+@lru_cache(maxsize=None)
+def is_python_kernel(kernel_name: str) -> bool:
+    """
+    Whether the kernel language is Python (by kernel spec or
+    by kernel name if there is no spec).
+    """
+    try:
+        language = get_kernel_spec(kernel_name).language
+    except Exception:
+        language = kernel_name.rstrip('0123456789')
+    return language.lower() == 'python'
+
+
+class DefUseGraph:
+    """
+    Def-use DAG of the chunks of a kernel in the document order.
+    Nodes are chunk indices, ``keys`` are chunk cache keys.
+
+    The graph also tracks which definition of each name the kernel
+    holds (``state``) so that replaying cached chunks out of the document
+    order doesn't leave the kernel with overwritten definitions
+    (see ``restore``).
+
+    Parameters
+    ----------
+    kernel_name : str
+    """
+    def __init__(self, kernel_name: str):
+        self.kernel_name = kernel_name
+        self.keys = []  # type: List[str]
+        self.parents = []  # type: List[Set[int]]
+        self.uses = []  # type: List[Union[Set[str], None]]
+        self.defines = []  # type: List[Union[Set[str], None]]
+        self.definers = {}  # type: Dict[str, int]
+        self.closures = {}  # type: Dict[str, Closure]
+        self.barrier = None  # type: Union[int, None]
+        self.state = {}  # type: Dict[str, int]
+
+    def _expand(self, names: Names) -> Tuple[Set[str], Set[str]]:
+        """
+        Add names used by the called functions (and their globals).
+        """
+        uses, defines = set(names.uses), set(names.defines)
+        stack = [name for name in uses if name in self.closures]
+        seen = set(stack)
+        while stack:
+            used, globals_ = self.closures[stack.pop()]
+            uses |= used
+            defines |= globals_
+            for name in used - seen:
+                if name in self.closures:
+                    seen.add(name)
+                    stack.append(name)
+        return uses, defines
+
+    def add(self, code: str, attrs: dict, barrier: bool=False) -> int:
+        """
+        Add a chunk to the graph and compute it's key.
+
+        Parameters
+        ----------
+        code : str
+        attrs : dict
+            resolved chunk options
+        barrier : bool
+            whether to skip the analysis and treat the chunk as a barrier
+
+        Returns
+        -------
+        node : int
+        """
+        node = len(self.keys)
+        names = None if barrier else chunk_names(code)
+        uses = defines = None
+        if names is None:
+            parents = set(range(node))
+        else:
+            uses, defines = self._expand(names)
+            parents = {self.definers[name] for name in uses if name in self.definers}
+            if self.barrier is not None:
+                parents.add(self.barrier)
+        self.parents.append(parents)
+        self.uses.append(uses)
+        self.defines.append(defines)
+        self.keys.append(chunk_key(self.kernel_name, code, attrs, [self.keys[i] for i in sorted(parents)]))
+
+        if names is None:
+            self.barrier = node
+            self.definers, self.closures = {}, {}
+        else:
+            for name in defines:
+                self.definers[name] = node
+                self.closures.pop(name, None)
+            self.closures.update(names.closures)
+        return node
+
+    def ancestors(self, node: int) -> Set[int]:
+        """
+        Transitive parents of the node.
+        """
+        result, stack = set(), list(self.parents[node])
+        while stack:
+            parent = stack.pop()
+            if parent not in result:
+                result.add(parent)
+                stack.extend(self.parents[parent])
+        return result
+
+    def definer(self, name: str, node: int) -> Union[int, None]:
+        """
+        The last chunk before the node that defines the name
+        (barriers are skipped).
+        """
+        for i in reversed(range(node)):
+            if self.defines[i] is not None and name in self.defines[i]:
+                return i
+        return None
+
+    def run(self, node: int):
+        """
+        Record that the kernel executed the chunk.
+        """
+        for name in self.defines[node] or ():
+            self.state[name] = node
+
+    def restore(self, node: int, pending: Set[int]) -> List[int]:
+        """
+        Chunks to execute again before the node and record that they and
+        the node are executed. These are:
+
+        * pending ancestors of the node,
+        * definers of the names that the replayed chunks use if the kernel
+          holds another definition (anti-dependencies),
+        * chunks before the node whose definitions the kernel holds but
+          the replayed chunks overwrite (write-after-write), so the kernel
+          ends up with the same definitions as after the document order
+          execution.
+
+        Parameters
+        ----------
+        node : int
+        pending : set of int
+            chunks that were taken from the cache and were not executed
+
+        Returns
+        -------
+        replay : list of int
+            in the document order
+        """
+        replay = self.ancestors(node) & pending
+        while True:
+            state, more = dict(self.state), set()
+            for i in sorted(replay) + [node]:
+                for name in self.uses[i] or ():
+                    definer = self.definer(name, i)
+                    if definer is not None and state.get(name) != definer:
+                        more.add(definer)
+                for name in self.defines[i] or ():
+                    state[name] = i
+            for name, i in state.items():
+                latest = self.definer(name, node + 1)
+                if i != latest and self.state.get(name) == latest:
+                    more.add(latest)
+            more -= replay
+            if not more:
+                break
+            for i in more:
+                replay |= {i} | (self.ancestors(i) & pending)
+        for i in sorted(replay) + [node]:
+            self.run(i)
+        return sorted(replay)
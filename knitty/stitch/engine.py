@@ -0,0 +1,185 @@
+"""
+asyncio execution engine: kernels execute the next chunks
+while outputs of the previous chunks are still being converted.
+"""
+import asyncio
+from queue import Empty
+
+from jupyter_client.manager import AsyncKernelManager
+
+from .stitch import KernelPair, OutputCollector, kernel_init_code, session_kernel_name, INIT_TIMEOUT
+from .checkpoint import snapshot_code
+from .kernelspec import kernel_spec_manager
+from .warmup import default_profile
+from .fork import fork_server, fork_kernel_manager
+
+
+async def async_kernel_factory(kernel_name: str, profile=None, **kwargs) -> KernelPair:
+    """
+    Start a new kernel with ``AsyncKernelManager`` and ``AsyncKernelClient``
+    (same as ``start_new_async_kernel`` but kernel specs are cached).
+    Kernels are forked as in ``kernel_factory``.
+    """
+    server = fork_server(kernel_name, profile if profile is not None else default_profile())
+    if server is not None:
+        km = fork_kernel_manager(server, asynchronous=True,
+                                 kernel_name=kernel_name, kernel_spec_manager=kernel_spec_manager())
+    else:
+        km = AsyncKernelManager(kernel_name=kernel_name, kernel_spec_manager=kernel_spec_manager())
+    await km.start_kernel(**kwargs)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        await kc.wait_for_ready(timeout=60)
+    except RuntimeError:
+        kc.stop_channels()
+        await km.shutdown_kernel()
+        raise
+    return KernelPair(km, kc)
+
+
+async def async_run_code(code: str, kp: KernelPair, timeout=None, store_history=True):
+    """
+    Same as ``run_code`` but for kernel pair with ``AsyncKernelClient``.
+    """
+    msg_id = kp.kc.execute(code, store_history=store_history)
+    while True:
+        msg = await kp.kc.get_shell_msg(timeout=timeout)
+        if msg['parent_header'].get('msg_id') == msg_id:
+            break
+
+    collector = OutputCollector(msg_id)
+    while not collector.done:
+        try:
+            msg = await kp.kc.get_iopub_msg(timeout=4)
+        except Empty:
+            continue
+        collector.feed(msg)
+    return collector.messages
+
+
+class AsyncEngine:
+    """
+    Executes chunks in the document order and converts outputs via
+    ``Stitch.wrap_chunk`` in a worker thread. At most ``depth`` executed
+    chunks wait for conversion (then the execution pauses).
+
+    Kernels are started by the engine and shut down after the document.
+
+    Parameters
+    ----------
+    stitcher : Stitch
+    depth : int
+    """
+    def __init__(self, stitcher, depth: int=1):
+        self.stitcher = stitcher
+        self.depth = max(depth, 1)
+        self.kernels = {}
+        self.starting = {}
+
+    async def start_kernel(self, kernel_name: str) -> KernelPair:
+        kernel_name = session_kernel_name(kernel_name)
+        kp = await async_kernel_factory(kernel_name)
+        code = kernel_init_code(kernel_name)
+        if code:
+            await async_run_code(code, kp, timeout=INIT_TIMEOUT, store_history=False)
+        return kp
+
+    def prestart(self, kernel_names):
+        """
+        Start kernels concurrently (see ``Stitch.prestart_kernels``).
+        """
+        for kernel_name in kernel_names:
+            if kernel_name not in self.starting:
+                self.starting[kernel_name] = asyncio.ensure_future(self.start_kernel(kernel_name))
+
+    async def get_kernel(self, kernel_name: str) -> KernelPair:
+        kp = self.kernels.get(kernel_name)
+        if not kp:
+            task = self.starting.pop(kernel_name, None)
+            kp = await (task if task is not None else self.start_kernel(kernel_name))
+            self.kernels[kernel_name] = kp
+        return kp
+
+    async def run_chunk(self, chunk):
+        """
+        Async version of ``Stitch.run_chunk``.
+        """
+        messages, replay, key = self.stitcher.lookup_chunk(chunk, chunk.kernel_key in self.kernels)
+        if messages is not None:
+            return messages
+        kp = await self.get_kernel(chunk.kernel_key)
+        for block in replay:
+            await async_run_code(block['c'][1], kp)
+        messages = await async_run_code(chunk.block['c'][1], kp)
+        self.stitcher.store_chunk(key, messages, chunk.name)
+        if chunk.checkpoint:
+            self.stitcher.check_snapshot(
+                chunk, await async_run_code(snapshot_code(chunk.checkpoint), kp, store_history=False))
+        return messages
+
+    async def _produce(self, chunks, queue):
+        for chunk in chunks:
+            if chunk.executable:
+                chunk.messages = await self.run_chunk(chunk)
+            await queue.put(chunk)
+
+    async def _consume(self, chunks, queue, lm, wrap):
+        loop = asyncio.get_event_loop()
+        results = []
+        for _ in chunks:
+            chunk = await queue.get()
+            results.append(await loop.run_in_executor(None, wrap, chunk, lm))
+        return results
+
+    async def _stitch(self, chunks, lm, wrap):
+        queue = asyncio.Queue(maxsize=self.depth)
+        if self.stitcher.prestart_kernels:
+            self.prestart(self.stitcher.needed_kernels(chunks))
+        producer = asyncio.ensure_future(self._produce(chunks, queue))
+        consumer = asyncio.ensure_future(self._consume(chunks, queue, lm, wrap))
+        try:
+            await asyncio.wait([producer, consumer], return_when=asyncio.FIRST_EXCEPTION)
+            for task in (producer, consumer):
+                if task.done() and task.exception() is not None:
+                    raise task.exception()
+            return consumer.result()
+        finally:
+            for task in (producer, consumer):
+                task.cancel()
+            await self.shutdown()
+
+    async def shutdown(self):
+        for kernel_name, task in list(self.starting.items()):
+            # noinspection PyBroadException
+            try:
+                self.kernels.setdefault(kernel_name, await task)
+            except Exception:
+                pass
+        self.starting = {}
+        for kp in self.kernels.values():
+            kp.kc.stop_channels()
+            await kp.km.shutdown_kernel(now=True)
+        self.kernels = {}
+
+    def stitch(self, chunks, lm, wrap=None) -> list:
+        """
+        Execute and wrap chunks.
+
+        Parameters
+        ----------
+        chunks : list of Chunk
+        lm : LangMapper
+        wrap : callable, optional
+            ``wrap(chunk, lm)`` instead of ``Stitch.wrap_chunk``
+
+        Returns
+        -------
+        blocks : list of lists
+            output blocks of each chunk (same order as ``chunks``)
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._stitch(chunks, lm, wrap or self.stitcher.wrap_chunk))
+        finally:
+            loop.close()
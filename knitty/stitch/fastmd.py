@@ -0,0 +1,197 @@
+"""
+In-process Markdown to Pandoc JSON AST converter for a simple subset
+of Pandoc's ``markdown`` format. Used as a fast path for kernel outputs
+instead of spawning Pandoc.
+
+Supported subset:
+
+* paragraphs of words made of alphanumeric characters and ``,.;:!?%()+=/-``,
+* tight bullet lists (``-``, ``*``, ``+``) with single line items,
+* pipe tables with a header and short lines (Pandoc API 1.22+ only)
+  without captions.
+
+Anything else (and any doubt) gives ``None`` so the caller uses Pandoc.
+"""
+import re
+from typing import List, Union, Tuple
+
+ABBREVIATIONS = frozenset('''
+aet. aetat. al. Apr. Aug. bk. Bros. c. Capt. cf. ch. chap. chs. Co. col. Corp. cp. d. Dec. Dr.
+e.g. ed. eds. esp. f. fasc. Feb. ff. fig. fl. fol. fols. Fr. Gen. Gov. Hon. i.e. ill. Inc. incl.
+Jan. Jr. Jul. Jun. Ltd. M.A. M.D. Mar. Mr. Mrs. Ms. n. n.b. nn. No. Nov. Oct. p. Ph.D. pp. Pres.
+Prof. pt. q.v. Rep. Rev. s.v. s.vv. saec. sec. Sen. Sep. Sept. Sgt. Sr. St. univ. viz. vol. vs.
+'''.split())
+
+# Pandoc options that affect reading:
+READER_OPTIONS = ('--columns', '--tab-stop', '--preserve-tabs', '--abbreviations', '--strip-comments',
+                  '--shift-heading-level-by', '--indented-code-classes', '--default-image-extension',
+                  '--file-scope', '--metadata', '-M', '--metadata-file', '--track-changes', '--extract-media',
+                  '--filter', '-F', '--lua-filter', '-L', '--citeproc', '-C', '--bibliography', '--defaults', '-d')
+COLUMNS = 72
+TABLE_API = (1, 22)
+
+PUNCTUATION = frozenset(',.;:!?%()+=/-')
+BULLET = re.compile(r'^([-*+]) (\S.*)$')
+ORDERED = re.compile(r'^\w+[.)](\s|$)')
+SEPARATOR = re.compile(r'^\|?( *:?-+:? *\|)*( *:?-+:? *)\|?$')
+CAPTION = re.compile(r'^([Tt]able)?:')
+ATTR = ['', [], []]
+
+
+def inlines(text: str) -> Union[list, None]:
+    """
+    Convert a line or a paragraph to inlines.
+    """
+    if '--' in text or '...' in text:
+        return None
+    for c in text:
+        if not (c.isalnum() or c in PUNCTUATION or c == ' ' or c == '\n'):
+            return None
+    out = []
+    for i, line in enumerate(text.split('\n')):
+        if i > 0:
+            out.append({'t': 'SoftBreak'})
+        for j, word in enumerate(line.split()):
+            if word in ABBREVIATIONS:
+                return None
+            if j > 0:
+                out.append({'t': 'Space'})
+            out.append({'t': 'Str', 'c': word})
+    return out
+
+
+def paragraph(lines: List[str]) -> Union[dict, None]:
+    for line in lines:
+        if not line[0].isalnum() or ORDERED.match(line):
+            return None
+    content = inlines('\n'.join(lines))
+    return None if content is None else {'t': 'Para', 'c': content}
+
+
+def bullet_list(lines: List[str]) -> Union[dict, None]:
+    matches = [BULLET.match(line) for line in lines]
+    if not all(matches) or len({m.group(1) for m in matches}) != 1:
+        return None
+    items = []
+    for m in matches:
+        item = m.group(2)
+        if not item[0].isalnum() or ORDERED.match(item):
+            return None
+        content = inlines(item)
+        if content is None:
+            return None
+        items.append([{'t': 'Plain', 'c': content}])
+    return {'t': 'BulletList', 'c': items}
+
+
+def _cells(line: str) -> List[str]:
+    line = line.strip(' ')
+    if line.startswith('|'):
+        line = line[1:]
+    if line.endswith('|'):
+        line = line[:-1]
+    return [cell.strip(' ') for cell in line.split('|')]
+
+
+def _cell(text: str) -> Union[list, None]:
+    if not text:
+        return [ATTR, {'t': 'AlignDefault'}, 1, 1, []]
+    if not text[0].isalnum():
+        return None
+    content = inlines(text)
+    if content is None:
+        return None
+    return [ATTR, {'t': 'AlignDefault'}, 1, 1, [{'t': 'Plain', 'c': content}]]
+
+
+def _row(line: str, n: int) -> Union[list, None]:
+    cells = [_cell(cell) for cell in _cells(line)]
+    if len(cells) != n or None in cells:
+        return None
+    return [ATTR, cells]
+
+
+def pipe_table(lines: List[str]) -> Union[dict, None]:
+    if (len(lines) < 2 or not SEPARATOR.match(lines[1]) or SEPARATOR.match(lines[0]) or
+            any('|' not in line or len(line) > COLUMNS for line in lines)):
+        return None
+    aligns = []
+    for spec in _cells(lines[1]):
+        left, right = spec.startswith(':'), spec.endswith(':')
+        aligns.append('AlignCenter' if left and right else 'AlignLeft' if left else
+                      'AlignRight' if right else 'AlignDefault')
+    n = len(aligns)
+    rows = [_row(line, n) for line in [lines[0]] + lines[2:]]
+    if None in rows:
+        return None
+    # Pandoc drops the header row with all cells empty:
+    head = rows[:1] if any(cell[4] for cell in rows[0][1]) else []
+    return {'t': 'Table', 'c': [
+        ATTR,
+        [None, []],
+        [[{'t': align}, {'t': 'ColWidthDefault'}] for align in aligns],
+        [ATTR, head],
+        [[ATTR, 0, [], rows[1:]]],
+        [ATTR, []],
+    ]}
+
+
+def fast_tokenize(source: str, pandoc_format: str="markdown", pandoc_extra_args: list=None,
+                  api_version: Tuple[int, ...]=None) -> Union[list, None]:
+    """
+    Convert simple markdown to Pandoc JSON AST blocks.
+    Returns ``None`` if the source is not in the supported subset.
+
+    Parameters
+    ----------
+    source : str
+    pandoc_format : str
+        only ``markdown`` is supported
+    pandoc_extra_args : list of str
+        args that affect Pandoc reader are not supported
+    api_version : tuple of int
+        Pandoc API version (tables are supported since 1.22)
+
+    Returns
+    -------
+    blocks : list or None
+    """
+    if pandoc_format != 'markdown':
+        return None
+    for arg in (pandoc_extra_args if pandoc_extra_args else []):
+        if arg.split('=', 1)[0] in READER_OPTIONS:
+            return None
+    if '\t' in source or '\r' in source:
+        return None
+
+    groups, group = [], []
+    for line in source.split('\n'):
+        if line.strip(' '):
+            if line[0] == ' ' or line[-1] == ' ':
+                return None
+            group.append(line)
+        elif group:
+            groups.append(group)
+            group = []
+    if group:
+        groups.append(group)
+
+    for i, lines in enumerate(groups):
+        # Pandoc takes the text of an adjacent caption paragraph as the table caption:
+        if CAPTION.match(lines[0]) and any('|' in group[0] for group in groups[max(i - 1, 0):i + 2]):
+            return None
+
+    blocks = []
+    for lines in groups:
+        if BULLET.match(lines[0]):
+            if blocks and blocks[-1]['t'] == 'BulletList':
+                return None
+            block = bullet_list(lines)
+        elif '|' in lines[0]:
+            block = pipe_table(lines) if api_version and tuple(api_version[:2]) >= TABLE_API else None
+        else:
+            block = paragraph(lines)
+        if block is None:
+            return None
+        blocks.append(block)
+    return blocks
@@ -0,0 +1,162 @@
+"""
+Python kernels forked from a warm fork server (Linux): the server is
+started once per Python executable and ``preimport`` modules and
+kernels are forked from it (see ``knitty.stitch.forkserver``).
+Servers are shut down at exit.
+"""
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+import threading
+import subprocess
+from functools import lru_cache
+from typing import Dict, Tuple, Union
+
+from ..tools import KnittyError
+from . import forkserver
+from .kernelspec import get_kernel_spec
+from .warmup import KernelProfile
+
+SCRIPT = os.path.abspath(forkserver.__file__)
+
+_servers = {}  # type: Dict[Tuple[str, tuple], ForkServerProcess]
+_lock = threading.Lock()
+
+
+def fork_supported() -> bool:
+    return sys.platform.startswith('linux') and hasattr(os, 'fork')
+
+
+class ForkServerProcess:
+    """
+    Fork server started with ``python`` (the kernel interpreter).
+
+    Parameters
+    ----------
+    python : str
+    modules : tuple of str
+        modules to import before forking kernels
+    """
+    def __init__(self, python: str, modules: tuple=()):
+        self.python = python
+        self.modules = tuple(modules)
+        self.dir = tempfile.mkdtemp(prefix='knitty-fork-')
+        self.path = os.path.join(self.dir, 'server.sock')
+        env = dict(os.environ)
+        env.pop('JPY_PARENT_PID', None)
+        # new session: Ctrl+C in the terminal interrupts kernels only via KernelManager
+        self.proc = subprocess.Popen([python, SCRIPT, 'serve', self.path] + list(self.modules),
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                     cwd=self.dir, env=env, start_new_session=True)
+        ready = self.proc.stdout.readline()
+        self.proc.stdout.close()
+        if ready != forkserver.READY:
+            self.proc.wait()
+            shutil.rmtree(self.dir, ignore_errors=True)
+            raise KnittyError('knitty fork server failed to start with {}'.format(python))
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def connect_cmd(self, connection_file: str) -> list:
+        """
+        Command that starts a kernel proxy (instead of the kernel).
+        """
+        return [sys.executable, SCRIPT, 'connect', self.path, connection_file]
+
+    def kernel_pid(self, connection_file: str) -> Union[int, None]:
+        try:
+            return forkserver.kernel_pid(self.path, connection_file)
+        except OSError:
+            return None
+
+    def shutdown(self):
+        if self.alive():
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def kernel_python(kernel_name: str) -> Union[str, None]:
+    """
+    Python executable of the kernel if it's an ``ipykernel`` kernel.
+    """
+    argv = get_kernel_spec(kernel_name).argv
+    if argv[1:3] not in (['-m', 'ipykernel_launcher'], ['-m', 'ipykernel']):
+        return None
+    python = argv[0]
+    # same as KernelManager does:
+    if python in {'python', 'python%i' % sys.version_info[0], 'python%i.%i' % sys.version_info[:2]}:
+        return sys.executable
+    return python
+
+
+def fork_server(kernel_name: str, profile: KernelProfile) -> Union[ForkServerProcess, None]:
+    """
+    Running fork server for the kernel or ``None`` if the kernel
+    is not forked (see ``KernelProfile.fork``).
+    """
+    if not profile.fork(kernel_name) or not fork_supported():
+        return None
+    python = kernel_python(kernel_name)
+    if python is None:
+        return None
+    key = (python, tuple(profile.preimport(kernel_name)))
+    with _lock:
+        server = _servers.get(key)
+        if server is None or not server.alive():
+            server = _servers[key] = ForkServerProcess(*key)
+    return server
+
+
+@lru_cache(maxsize=None)
+def _manager_classes() -> tuple:
+    from jupyter_client.manager import KernelManager, AsyncKernelManager
+
+    class ForkMixin:
+        fork_server = None  # type: ForkServerProcess
+
+        def format_kernel_cmd(self, extra_arguments=None):
+            return self.fork_server.connect_cmd(os.path.realpath(self.connection_file))
+
+        @property
+        def forked_pid(self):
+            """
+            PID of the kernel (the process that ``KernelManager``
+            started is the proxy).
+            """
+            return self.fork_server.kernel_pid(os.path.realpath(self.connection_file))
+
+    class ForkKernelManager(ForkMixin, KernelManager):
+        pass
+
+    class AsyncForkKernelManager(ForkMixin, AsyncKernelManager):
+        pass
+
+    return ForkKernelManager, AsyncForkKernelManager
+
+
+def fork_kernel_manager(server: ForkServerProcess, asynchronous: bool=False, **kwargs):
+    """
+    ``KernelManager`` (or ``AsyncKernelManager``) that forks the kernel
+    from the server. ``kwargs`` are passed to the manager.
+    """
+    manager_class = _manager_classes()[1 if asynchronous else 0]
+    km = manager_class(**kwargs)
+    km.fork_server = server
+    return km
+
+
+@atexit.register
+def shutdown_fork_servers():
+    with _lock:
+        servers = list(_servers.values())
+        _servers.clear()
+    for server in servers:
+        server.shutdown()
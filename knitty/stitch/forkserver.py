@@ -0,0 +1,290 @@
+"""
+Fork server for Python kernels (Linux). The server is a warm interpreter
+that has ``ipykernel`` and the profile modules imported. It forks a new
+process per kernel start and the child becomes the kernel, so kernels
+start with heavy modules already imported.
+
+A running kernel can't be forked safely (ZMQ sockets and threads don't
+survive ``fork``) so the server is not a kernel itself: the child starts
+``IPKernelApp`` after it gets the connection file, working dir,
+environment and std streams of a regular kernel process.
+
+``KernelManager`` starts a proxy process (``connect`` command) instead
+of the kernel. The proxy sends the request to the server and lives as
+long as the forked kernel does: it forwards signals (interrupts) to the
+kernel and the server kills the kernel when the proxy is killed.
+
+This module is a standalone script (stdlib only) so the server runs in
+the kernel environment even if Knitty is not installed there::
+
+    python forkserver.py serve SOCKET [MODULE ...]
+    python forkserver.py connect SOCKET CONNECTION_FILE
+"""
+import os
+import sys
+import json
+import array
+import select
+import signal
+import socket
+import importlib
+import traceback
+
+READY = b'ready\n'
+STD_FDS = [0, 1, 2]
+# signals that the proxy forwards to the kernel:
+FORWARD = ('SIGINT', 'SIGTERM', 'SIGHUP', 'SIGQUIT', 'SIGUSR1', 'SIGUSR2')
+
+
+# -------------------------------------------
+# Protocol: newline terminated JSON.
+# Fork request also carries std fds.
+# -------------------------------------------
+def send_line(sock: socket.socket, obj: dict, fds=()):
+    data = json.dumps(obj).encode('utf-8') + b'\n'
+    if fds:
+        sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+        data = data[sent:]
+    sock.sendall(data)
+
+
+def recv_request(sock: socket.socket):
+    """
+    Read one request (the client sends nothing after it).
+
+    Returns
+    -------
+    tuple
+        ``(obj, fds)``, ``obj`` is ``None`` if the connection was closed
+    """
+    fds = array.array('i')
+    data, ancillary, _, _ = sock.recvmsg(2**16, socket.CMSG_LEN(len(STD_FDS) * fds.itemsize))
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    chunks = [data]
+    while chunks[-1] and not chunks[-1].endswith(b'\n'):
+        chunks.append(sock.recv(2**16))
+    data = b''.join(chunks)
+    return (json.loads(data.decode('utf-8')) if data.endswith(b'\n') else None), list(fds)
+
+
+def exit_code(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+# -------------------------------------------
+# Server
+# -------------------------------------------
+class ForkServer:
+    """
+    Forks kernels on requests. ``kernels`` maps proxy connections
+    to ``(pid, connection_file)`` of the forked kernels.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.kernels = {}
+        self.parent = os.getppid()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+        # wake up on SIGCHLD to report kernel exit right away:
+        self.wakeup, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    def serve(self):
+        try:
+            # exit with the process that started the server:
+            while os.getppid() == self.parent:
+                readable, _, _ = select.select([self.sock, self.wakeup] + list(self.kernels), [], [], 0.5)
+                for sock in readable:
+                    if sock is self.wakeup:
+                        os.read(self.wakeup, 2**10)
+                    elif sock is self.sock:
+                        self.accept()
+                    else:  # proxies send nothing after the request: it was killed
+                        self.close(sock, kill=True)
+                self.reap()
+        finally:
+            for sock in list(self.kernels):
+                self.close(sock, kill=True)
+            self.sock.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def accept(self):
+        conn, _ = self.sock.accept()
+        try:
+            req, fds = recv_request(conn)
+        except (OSError, ValueError):
+            conn.close()
+            return
+        cmd = req.get('cmd') if req is not None else None
+        if cmd == 'fork':
+            pid = os.fork()
+            if pid == 0:
+                self.child(conn, req, fds)
+            for fd in fds:
+                os.close(fd)
+            self.kernels[conn] = (pid, req['connection_file'])
+            send_line(conn, dict(pid=pid))
+            return
+        for fd in fds:
+            os.close(fd)
+        if cmd == 'pid':
+            pid = next((pid for pid, cf in self.kernels.values() if cf == req['connection_file']), None)
+            send_line(conn, dict(pid=pid))
+        conn.close()
+
+    def child(self, conn: socket.socket, req: dict, fds: list):
+        """
+        Become the kernel. Never returns.
+        """
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.close(self.wakeup)
+            for sock in [self.sock, conn] + list(self.kernels):
+                sock.close()
+            # don't get signals sent to the server process group:
+            os.setsid()
+            for fd, std_fd in zip(fds, STD_FDS):
+                os.dup2(fd, std_fd)
+                os.close(fd)
+            os.chdir(req['cwd'])
+            os.environ.clear()
+            os.environ.update(req['env'])
+            sys.path.insert(0, req['cwd'])  # like `python -m ipykernel_launcher` in cwd
+            sys.argv = ['ipykernel_launcher', '-f', req['connection_file']] + req.get('args', [])
+            from ipykernel import kernelapp
+            kernelapp.launch_new_instance()
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except Exception:
+                    pass
+            os._exit(code)
+
+    def close(self, sock: socket.socket, kill: bool=False, code: int=None):
+        pid, _ = self.kernels.pop(sock)
+        if kill:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            try:
+                send_line(sock, dict(exit=code))
+            except OSError:
+                pass
+        sock.close()
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            sock = next((s for s, (p, _) in self.kernels.items() if p == pid), None)
+            if sock is not None:
+                self.close(sock, code=exit_code(status))
+
+
+def serve(path: str, modules: list):
+    from ipykernel import kernelapp  # noqa: most of the kernel startup time
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print('knitty fork server: failed to import {}: {!r}'.format(module, e), file=sys.stderr)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    server = ForkServer(path)
+    sys.stdout.buffer.write(READY)
+    sys.stdout.flush()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    server.serve()
+
+
+# -------------------------------------------
+# Proxy
+# -------------------------------------------
+def connect(path: str, connection_file: str) -> int:
+    """
+    Ask the server to fork a kernel and wait until it exits.
+
+    Returns
+    -------
+    code : int
+        exit code of the kernel
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    args = []
+    if os.environ.get('JPY_PARENT_PID'):
+        # the server imported ipykernel with other environment:
+        args.append('--IPKernelApp.parent_handle=' + os.environ['JPY_PARENT_PID'])
+    send_line(sock, dict(cmd='fork', connection_file=connection_file, cwd=os.getcwd(),
+                         env=dict(os.environ), args=args), fds=STD_FDS)
+    reader = sock.makefile('rb')
+    pid = json.loads(reader.readline().decode('utf-8'))['pid']
+
+    def forward(signum, frame):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    for name in FORWARD:
+        signal.signal(getattr(signal, name), forward)
+    line = reader.readline()
+    return json.loads(line.decode('utf-8'))['exit'] if line else 1
+
+
+def kernel_pid(path: str, connection_file: str):
+    """
+    PID of the kernel forked for the connection file or ``None``.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        sock.connect(path)
+        send_line(sock, dict(cmd='pid', connection_file=connection_file))
+        line = sock.makefile('rb').readline()
+    return json.loads(line.decode('utf-8'))['pid'] if line else None
+
+
+def main(argv: list):
+    # script dir modules shouldn't shadow the kernel ones:
+    if sys.path and sys.path[0] == os.path.dirname(os.path.abspath(__file__)):
+        del sys.path[0]
+    cmd, path, *args = argv
+    if cmd == 'serve':
+        serve(path, args)
+    elif cmd == 'connect':
+        code = connect(path, *args)
+        sys.exit(code if code >= 0 else 128 - code)
+    else:
+        raise ValueError(cmd)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,45 @@
+"""
+Cached kernel spec lookups: ``KernelSpecManager`` scans all Jupyter
+data dirs on every lookup.
+"""
+import threading
+from functools import lru_cache
+
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _get_kernel_spec(kernel_name: str):
+    from jupyter_client.kernelspec import KernelSpecManager, NATIVE_KERNEL_NAME
+
+    # same as KernelManager does:
+    name = NATIVE_KERNEL_NAME if kernel_name == 'python' else kernel_name
+    return KernelSpecManager().get_kernel_spec(name)
+
+
+def get_kernel_spec(kernel_name: str):
+    """
+    Cached ``KernelSpecManager().get_kernel_spec`` (``python`` is
+    the native kernel). Raises ``NoSuchKernel``.
+
+    Returns
+    -------
+    spec : KernelSpec
+    """
+    with _lock:
+        return _get_kernel_spec(kernel_name)
+
+
+@lru_cache(maxsize=None)
+def kernel_spec_manager():
+    """
+    ``KernelSpecManager`` shared by kernel managers that uses
+    the cached lookups.
+    """
+    from jupyter_client.kernelspec import KernelSpecManager
+
+    class CachedKernelSpecManager(KernelSpecManager):
+        def get_kernel_spec(self, kernel_name, *args, **kwargs):
+            return get_kernel_spec(kernel_name)
+
+    return CachedKernelSpecManager()
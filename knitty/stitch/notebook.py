@@ -0,0 +1,201 @@
+"""
+Jupyter notebook output. ``PANDOC_CODECELL_CLASSES`` (for Pandoc's ipynb
+writer) are added on the dict AST, and the direct writer builds nbformat 4
+JSON from the kernel messages: mime bundles are stored as the kernel sent
+them (images and html are not converted by Pandoc).
+"""
+import json
+import uuid
+import os.path as p
+from typing import Union
+
+from .stitch import (Chunk, CODEBLOCK, coalesce_streams, extract_execution_count, is_execute_input, is_stderr,
+                     is_stitchable)
+from ..consts import PANDOC_CODECELL_CLASSES
+from ..tools import KnittyError, panflute
+
+INLINE_SPACES = ('Space', 'SoftBreak', 'LineBreak')
+
+
+def stringify(obj) -> str:
+    """
+    Text of the JSON AST inlines or blocks (like ``panflute.stringify``).
+    """
+    if isinstance(obj, list):
+        return ''.join(map(stringify, obj))
+    if not isinstance(obj, dict):
+        return ''
+    t, c = obj.get('t'), obj.get('c')
+    if t == 'Str':
+        return c
+    if t in INLINE_SPACES:
+        return ' '
+    if t in ('Code', 'Math', 'RawInline'):
+        return c[1]
+    if t in ('Para', 'Plain', 'Header'):
+        return stringify(c) + '\n\n'
+    return stringify(c)
+
+
+def meta_value(value):
+    """
+    Python value of the JSON AST metadata value (like ``Doc.get_metadata``).
+    """
+    if not isinstance(value, dict):
+        return value
+    t, c = value.get('t'), value.get('c')
+    if t == 'MetaMap':
+        return {k: meta_value(v) for k, v in c.items()}
+    if t == 'MetaList':
+        return [meta_value(v) for v in c]
+    if t in ('MetaInlines', 'MetaBlocks'):
+        return stringify(c)
+    return c
+
+
+def codecell_classes(obj, default=None):
+    """
+    Adds ``PANDOC_CODECELL_CLASSES`` to the code blocks with ``input=True``
+    (``default`` is used when there is no ``input`` attribute). Elements
+    are not changed in place: changed elements and their parents are copies.
+    """
+    if isinstance(obj, list):
+        new = [codecell_classes(v, default) for v in obj]
+        return obj if all(v is w for v, w in zip(new, obj)) else new
+    if not isinstance(obj, dict):
+        return obj
+    if obj.get('t') == CODEBLOCK:
+        (ident, classes, kvs), code = obj['c']
+        input_ = dict(kvs).get('input', default)
+        missing = [clss for clss in PANDOC_CODECELL_CLASSES if clss not in classes]
+        if str(input_).lower() != 'true' or not missing:
+            return obj
+        return {'t': CODEBLOCK, 'c': [[ident, classes + missing, kvs], code]}
+    new = {k: codecell_classes(v, default) for k, v in obj.items()}
+    return obj if all(new[k] is v for k, v in obj.items()) else new
+
+
+def ipynb_ast(ast: dict) -> dict:
+    """
+    ``codecell_classes`` for the document (``input`` metadata is the default).
+    """
+    default = meta_value(ast['meta'].get('input'))
+    return dict(ast, meta=codecell_classes(ast['meta'], default), blocks=codecell_classes(ast['blocks'], default))
+
+
+def markdown_cells(version: list, groups: list) -> list:
+    """
+    Markdown sources of the groups of blocks (with one Pandoc call).
+    """
+    if not groups:
+        return []
+    sep = 'knitty-cell-{}'.format(uuid.uuid4().hex)
+    blocks = []
+    for group in groups:
+        if blocks:
+            blocks.append({'t': 'RawBlock', 'c': ['markdown', sep]})
+        blocks += group
+    ast = {'pandoc-api-version': version, 'meta': {}, 'blocks': blocks}
+    text = panflute().run_pandoc(json.dumps(ast), ['-f', 'json', '-t', 'markdown', '--wrap=preserve'])
+    return [source.strip('\n') for source in text.split('\n' + sep + '\n')]
+
+
+def outputs(stitcher, messages: list, attrs: dict) -> list:
+    """
+    nbformat outputs of the kernel messages.
+    """
+    warning = stitcher.get_option('warning', attrs)
+    outs = []
+    for message in coalesce_streams(messages):
+        msg_type, content = message['header']['msg_type'], message['content']
+        if is_execute_input(message) or (is_stderr(message) and not warning):
+            continue
+        if msg_type == 'stream':
+            outs.append({'output_type': 'stream', 'name': content['name'], 'text': content['text']})
+        elif msg_type == 'error':
+            if stitcher.get_option('error', attrs) == 'raise':
+                raise KnittyError(content['traceback'])
+            outs.append({'output_type': 'error', 'ename': content.get('ename', ''),
+                         'evalue': content.get('evalue', ''), 'traceback': content['traceback']})
+        elif content.get('data'):
+            out = {'output_type': msg_type, 'data': content['data'], 'metadata': content.get('metadata', {})}
+            if msg_type == 'execute_result':
+                out['execution_count'] = content.get('execution_count')
+            outs.append(out)
+    return outs
+
+
+def code_cell(stitcher, chunk: Chunk) -> dict:
+    """
+    nbformat code cell of the executed chunk (see ``Stitch.wrap_chunk``).
+    """
+    messages, attrs = chunk.messages, chunk.attrs
+    cell = {'cell_type': 'code', 'execution_count': extract_execution_count(messages),
+            'metadata': {}, 'source': chunk.block['c'][1], 'outputs': []}
+    if not stitcher.get_option('echo', attrs):
+        cell['metadata']['jupyter'] = {'source_hidden': True}
+    if is_stitchable(messages, attrs):
+        cell['outputs'] = outputs(stitcher, messages, attrs)
+    return cell
+
+
+def kernelspec(chunks: list) -> Union[dict, None]:
+    """
+    Notebook kernelspec metadata of the kernel of the first executable chunk.
+    """
+    from .kernelspec import get_kernel_spec
+
+    for chunk in chunks:
+        if chunk.executable:
+            name = chunk.kernel_name
+            # noinspection PyBroadException
+            try:
+                spec = get_kernel_spec(name)
+                # ``python`` is an alias of the native kernel:
+                return {'name': p.basename(spec.resource_dir) or name, 'display_name': spec.display_name,
+                        'language': spec.language}
+            except Exception:
+                return {'name': name, 'display_name': name}
+    return None
+
+
+def notebook(stitcher, version: list, meta: dict, items: list) -> dict:
+    """
+    nbformat 4 notebook: code cells for chunks, markdown cells for the
+    other blocks.
+
+    Parameters
+    ----------
+    stitcher : Stitch
+    version : list
+        pandoc-api-version
+    meta : dict
+        document metadata (``jupyter`` map is the notebook metadata)
+    items : list
+        blocks and chunks in the document order (chunks that are
+        not executable are converted as blocks)
+    """
+    groups, cells = [], []
+    for item in items:
+        if isinstance(item, Chunk) and not item.executable:
+            item = item.block
+        if isinstance(item, Chunk):
+            cells.append(item)
+        elif cells and isinstance(cells[-1], list):
+            cells[-1].append(item)
+        else:
+            cells.append([item])
+            groups.append(cells[-1])
+    sources = iter(markdown_cells(version, groups))
+    cells = [code_cell(stitcher, cell) if isinstance(cell, Chunk) else
+             {'cell_type': 'markdown', 'metadata': {}, 'source': next(sources)}
+             for cell in cells]
+
+    metadata = meta_value(meta.get('jupyter')) or {}
+    if not isinstance(metadata, dict):
+        metadata = {}
+    if 'kernelspec' not in metadata:
+        spec = kernelspec([cell for cell in items if isinstance(cell, Chunk)])
+        if spec is not None:
+            metadata['kernelspec'] = spec
+    return {'cells': cells, 'metadata': metadata, 'nbformat': 4, 'nbformat_minor': 4}
@@ -33,6 +33,23 @@ class Choice(Enum):
         self.error(obj, value)
 
 
+class Int(TraitType):
+
+    default_value = 0
+    info_text = "Non-negative integer; unwraps pandoc's JSON AST"
+
+    def validate(self, obj, value):
+        if isinstance(value, Mapping):
+            value = value.get('c')
+            if isinstance(value, list):
+                value = ''.join(filter(None, (x.get('c') for x in value)))
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if type(value) is int and value >= 0:
+            return value
+        self.error(obj, value)
+
+
 class Str(TraitType):
 
     default_value = ''
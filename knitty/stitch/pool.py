@@ -0,0 +1,190 @@
+"""
+Pool of warm Jupyter kernels that are reused by several documents.
+"""
+import os
+import time
+import threading
+from typing import Dict, List
+
+import psutil
+
+from .stitch import KernelPair, kernel_factory, initialize_kernel, run_code
+from .warmup import KernelProfile, default_profile
+
+# Code that resets kernel namespace between documents.
+# Kernels without reset code are recycled.
+RESET_CODE = {
+    'python': 'get_ipython().reset(new_session=True)',
+    'ir': 'rm(list = ls(all.names = TRUE))',
+}
+
+
+def kernel_pid(km):
+    """
+    PID of the kernel process started by KernelManager ``km`` or ``None``.
+    """
+    if hasattr(km, 'forked_pid'):
+        return km.forked_pid
+    provisioner = getattr(km, 'provisioner', None)
+    if provisioner is not None:
+        return getattr(provisioner, 'pid', None)
+    kernel = getattr(km, 'kernel', None)
+    return getattr(kernel, 'pid', None)
+
+
+def kernel_rss(km) -> int:
+    """
+    Resident set size of the kernel process (with children) in bytes.
+    """
+    pid = kernel_pid(km)
+    if pid is None:
+        return 0
+    try:
+        proc = psutil.Process(pid)
+        return sum(p.memory_info().rss for p in [proc] + proc.children(recursive=True))
+    except psutil.Error:
+        return 0
+
+
+class _Entry:
+    def __init__(self, kernel_name: str, kp: KernelPair, cwd: str):
+        self.kernel_name = kernel_name
+        self.kp = kp
+        self.cwd = cwd
+        self.started = time.monotonic()
+        self.documents = 0
+
+
+class KernelPool:
+    """
+    Owns warm kernels per kernel name.
+    Kernels are reset or recycled when they are released by a document.
+
+    Parameters
+    ----------
+    max_documents : int, default 0
+        Recycle a kernel after it served that many documents (0 means no limit).
+    max_rss : int, default 0
+        Recycle a kernel when it's RSS is more than that many MB (0 means no limit).
+    max_age : float, default 0
+        Recycle a kernel when it's older than that many seconds (0 means no limit).
+    warm : int, default 1
+        Number of idle kernels per kernel name and working dir to keep started.
+    profile : KernelProfile, default None
+        Modules to import in new kernels and whether to fork them
+        (defaults to ``KNITTY_KERNEL_PROFILE`` profile). Modules stay
+        imported after the namespace reset.
+    """
+    def __init__(self, max_documents: int=0, max_rss: int=0, max_age: float=0, warm: int=1,
+                 profile: KernelProfile=None):
+        self.profile = profile if profile is not None else default_profile()
+        self.max_documents = max_documents
+        self.max_rss = max_rss
+        self.max_age = max_age
+        self.warm = warm
+        self._idle = {}  # type: Dict[str, List[_Entry]]
+        self._busy = {}  # type: Dict[int, _Entry]
+        self._lock = threading.Lock()
+        self._threads = []  # type: List[threading.Thread]
+
+    def _start(self, kernel_name: str, cwd: str) -> _Entry:
+        kp = kernel_factory(kernel_name, profile=self.profile, cwd=cwd)
+        initialize_kernel(kernel_name, kp, profile=self.profile)
+        return _Entry(kernel_name, kp, cwd)
+
+    def prestart(self, kernel_name: str, cwd: str=None):
+        """
+        Start a kernel in background and add it to idle kernels.
+        """
+        cwd = os.path.abspath(cwd if cwd else os.getcwd())
+
+        def work():
+            entry = self._start(kernel_name, cwd)
+            with self._lock:
+                self._idle.setdefault(kernel_name, []).append(entry)
+
+        thread = threading.Thread(target=work, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def acquire(self, kernel_name: str, cwd: str=None) -> KernelPair:
+        """
+        Get an idle kernel started in the ``cwd`` dir or start a new one.
+        """
+        cwd = os.path.abspath(cwd if cwd else os.getcwd())
+        self.join()
+        with self._lock:
+            idle = self._idle.get(kernel_name, [])
+            entry = next((e for e in idle if e.cwd == cwd), None)
+            if entry is not None:
+                idle.remove(entry)
+        if entry is None:
+            entry = self._start(kernel_name, cwd)
+        with self._lock:
+            self._busy[id(entry.kp)] = entry
+        return entry.kp
+
+    def expired(self, entry: _Entry) -> bool:
+        """
+        Whether the kernel should be recycled.
+        """
+        return ((self.max_documents and entry.documents >= self.max_documents) or
+                (self.max_age and time.monotonic() - entry.started > self.max_age) or
+                (self.max_rss and kernel_rss(entry.kp.km) > self.max_rss * 2**20) or
+                (entry.kernel_name not in RESET_CODE) or
+                not entry.kp.km.is_alive())
+
+    def release(self, kp: KernelPair):
+        """
+        Return the kernel to the pool. It's namespace is reset
+        or it's shut down and a warm replacement is started.
+        """
+        with self._lock:
+            entry = self._busy.pop(id(kp))
+        entry.documents += 1
+        if not self.expired(entry):
+            try:
+                run_code(RESET_CODE[entry.kernel_name], kp, timeout=60, store_history=False)
+            except Exception:
+                pass
+            else:
+                with self._lock:
+                    self._idle.setdefault(entry.kernel_name, []).append(entry)
+                return
+        shutdown(kp)
+        with self._lock:
+            n = len([e for e in self._idle.get(entry.kernel_name, []) if e.cwd == entry.cwd])
+        if n < self.warm:
+            self.prestart(entry.kernel_name, entry.cwd)
+
+    def join(self):
+        """
+        Wait for kernels that are started in background.
+        """
+        while self._threads:
+            self._threads.pop().join()
+
+    def status(self) -> dict:
+        with self._lock:
+            idle = {name: len(entries) for name, entries in self._idle.items()}
+            busy = len(self._busy)
+        return dict(idle=idle, busy=busy)
+
+    def shutdown(self):
+        """
+        Shut down all kernels.
+        """
+        self.join()
+        with self._lock:
+            entries = [e for es in self._idle.values() for e in es] + list(self._busy.values())
+            self._idle, self._busy = {}, {}
+        for entry in entries:
+            shutdown(entry.kp)
+
+
+def shutdown(kp: KernelPair):
+    try:
+        kp.kc.stop_channels()
+        kp.km.shutdown_kernel(now=True)
+    except Exception:
+        pass
@@ -0,0 +1,119 @@
+"""
+Pipelined code execution: several execute requests are sent to a kernel
+ahead and shell/iopub messages are routed to the requests by ``msg_id``.
+"""
+from queue import Empty
+from typing import Dict
+
+import zmq
+
+from .stitch import KernelPair, OutputCollector
+
+
+class MessageRouter:
+    """
+    Sends execute requests to a kernel without waiting for the previous
+    ones and demultiplexes kernel messages by ``parent_header.msg_id``.
+    Requests are sent with ``stop_on_error=False`` so an error in one
+    chunk doesn't abort the queued ones (same as sequential execution).
+
+    Messages of requests that were not sent by the router
+    (like ``initialize_kernel`` code) and late messages of collected
+    requests are dropped.
+
+    Not thread-safe: one router per kernel per thread.
+
+    Parameters
+    ----------
+    kp : KernelPair
+
+    Attributes
+    ----------
+    kp : KernelPair
+    collectors : dict
+        ``OutputCollector`` of each pending request by ``msg_id``
+    replies : dict
+        ``execute_reply`` messages by ``msg_id``
+    """
+    def __init__(self, kp: KernelPair):
+        self.kp = kp
+        self.collectors = {}  # type: Dict[str, OutputCollector]
+        self.replies = {}  # type: Dict[str, dict]
+        self._poller = zmq.Poller()
+        self._channels = {}
+        for channel, route in ((kp.kc.shell_channel, self.route_reply),
+                               (kp.kc.iopub_channel, self.route_output)):
+            self._poller.register(channel.socket, zmq.POLLIN)
+            self._channels[channel.socket] = (channel, route)
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of requests that are submitted but not collected.
+        """
+        return len(self.collectors)
+
+    def submit(self, code: str, store_history: bool=True) -> str:
+        """
+        Send execute request.
+
+        Returns
+        -------
+        msg_id : str
+        """
+        msg_id = self.kp.kc.execute(code, store_history=store_history, stop_on_error=False)
+        self.collectors[msg_id] = OutputCollector(msg_id)
+        return msg_id
+
+    def route_reply(self, msg: dict):
+        msg_id = msg['parent_header'].get('msg_id')
+        if msg_id in self.collectors:
+            self.replies[msg_id] = msg
+
+    def route_output(self, msg: dict):
+        collector = self.collectors.get(msg['parent_header'].get('msg_id'))
+        if collector is not None:
+            collector.feed(msg)
+
+    def done(self, msg_id: str) -> bool:
+        return msg_id in self.replies and self.collectors[msg_id].done
+
+    def poll(self, timeout=None):
+        """
+        Route all messages that are ready (wait for them at most
+        ``timeout`` seconds). Raises ``Empty`` if there were none.
+        """
+        events = self._poller.poll(None if timeout is None else int(timeout * 1000))
+        if not events:
+            raise Empty
+        for socket, _ in events:
+            channel, route = self._channels[socket]
+            while channel.msg_ready():
+                route(channel.get_msg(timeout=0))
+
+    def wait(self, msg_id: str, timeout=None) -> list:
+        """
+        Wait until the kernel replies to the request and becomes idle.
+        Messages of the other requests are routed meanwhile.
+
+        Parameters
+        ----------
+        msg_id : str
+        timeout : int
+            max seconds between kernel messages
+
+        Returns
+        -------
+        messages : list of dicts
+            same as ``run_code`` result
+        """
+        while not self.done(msg_id):
+            self.poll(timeout)
+        del self.replies[msg_id]
+        return self.collectors.pop(msg_id).messages
+
+    def run(self, code: str, timeout=None, store_history: bool=True) -> list:
+        """
+        Same as ``run_code``.
+        """
+        return self.wait(self.submit(code, store_history=store_history), timeout)
@@ -6,35 +6,83 @@ in the output.
 # Copyright (c) Jan Schulz <jasc@gmx.net>
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
-import shutilwhich_cwdpatch.patch
 import os
 import re
+import sys
 import copy
 import json
+import time
 import base64
+import shutil
 import mimetypes
-from collections import namedtuple
+from collections import namedtuple, deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from queue import Empty
 
-from traitlets import HasTraits
-from jupyter_client.manager import start_new_kernel
-from nbconvert.utils.base import NbConvertBase
+from traitlets import HasTraits, TraitError
 from pandocfilters import RawBlock, Div, CodeBlock, Image, Str, Para
-import panflute as pf
 import argparse
 
 from . import options as opt
-from ..tools import KnittyError
+from .cache import ChunkCache, chunk_key
+from .batch import TokenizeBatch
+from .fastmd import fast_tokenize
+from .depgraph import DefUseGraph, is_python_kernel, syntax_error
+from .checkpoint import SKIPPED, state_key, checkpoint_path, snapshot_code, restore_block, remove_stale
+from .kernelspec import kernel_spec_manager, get_kernel_spec
+from .warmup import default_profile
+from .fork import fork_server, fork_kernel_manager
+from ..tools import KnittyError, panflute
 
-if hasattr(pf.tools, 'which'):
-    from shutilwhich_cwdpatch import which
-    pf.tools.which = which
-else:
-    raise KnittyError('panflute patch failed')
+# jupyter_client, nbconvert and panflute are imported on first use:
+# documents without executable chunks don't need them.
 
 
 CODEBLOCK = 'CodeBlock'
 KernelPair = namedtuple("KernelPair", "km kc")
+SESSION = re.compile(r'^[\w.-]+$')
+
+
+def session_key(kernel_name, session=None):
+    """
+    Key of the kernel in ``Stitch.kernel_managers``: kernel name
+    or ``'<kernel name>:<session>'`` for named sessions.
+    """
+    return kernel_name if not session else '{}:{}'.format(kernel_name, session)
+
+
+def session_kernel_name(key):
+    """
+    Kernel name of the ``session_key``.
+    """
+    return key.split(':', 1)[0]
+
+
+class Chunk:
+    """
+    Code block with parsed options and it's execution messages.
+    """
+    def __init__(self, block, lang, name, attrs, kernel_name):
+        self.block = block
+        self.lang = lang
+        self.name = name
+        self.attrs = attrs
+        self.kernel_name = kernel_name
+        self.messages = []
+        self.checkpoint = None  # snapshot path
+
+    @property
+    def executable(self):
+        return is_executable(self.block, self.kernel_name, self.attrs)
+
+    @property
+    def kernel_key(self):
+        """
+        Chunks with the same key share the kernel (see ``session_key``).
+        """
+        return session_key(self.kernel_name, self.attrs.get('session'))
 
 
 class _Fig(HasTraits):
@@ -89,6 +137,48 @@ class Stitch(HasTraits):
 
     use_prompt : bool, default ``False``
         Whether to use prompt.
+    parallel_kernels : bool, default ``False``
+        Whether to execute chunks of different kernels concurrently
+        (chunks of the same kernel are still executed in order).
+        Useful when languages are independent. Output is assembled
+        after all chunks are executed.
+    async_depth : int, default ``0``
+        If positive then the asyncio engine is used: kernels execute next
+        chunks while outputs of at most ``async_depth`` previous chunks
+        are being converted (by Pandoc, images writing etc.).
+        Kernels are not taken from the ``kernel_pool`` then and
+        are shut down after the document.
+    pipeline_depth : int, default ``0``
+        If positive then up to ``pipeline_depth`` next chunks are sent
+        to their kernel before the outputs of the current chunk are
+        collected (kernel messages are routed to chunks by ``msg_id``).
+        Saves a round trip per chunk for documents with many small
+        chunks. Queued chunks are executed even if the previous
+        chunk fails. Ignored by the asyncio engine.
+    batch_pandoc : bool, default ``True``
+        Whether to convert all outputs that are parsed by Pandoc
+        (``results=pandoc``, markdown outputs) with one Pandoc call
+        per format and extra args (outputs are separated by sentinels).
+        Outputs with syntax that depends on the rest of the document
+        (headers, references, footnotes, citations) are converted
+        separately.
+    fast_markdown : bool, default ``False``
+        Whether to convert simple ``markdown`` outputs (paragraphs,
+        tight bullet lists, pipe tables) to Pandoc AST in-process
+        without calling Pandoc. Other outputs are still converted
+        by Pandoc. See ``knitty.stitch.fastmd``.
+    prestart_kernels : bool, default ``True``
+        Whether to find all kernels the document needs before the
+        execution and start them concurrently in the background while
+        the first chunks are executed. Kernels whose chunks are all
+        found in the cache are not started. Ignored in streaming mode.
+    parallel_sessions : bool, default ``True``
+        Whether to execute chunks of different named sessions
+        (see ``session`` chunk option) concurrently. Chunks without
+        session are executed in order as a separate session (unless
+        ``parallel_kernels`` is set). Output is assembled after all
+        chunks are executed. Ignored by the asyncio engine and
+        in streaming mode.
     results : str, default ``'default'``
         * ``'default'``: default Stitch behaviour
         * ``'pandoc'``: same as 'default' but plain text is parsed via Pandoc:
@@ -101,6 +191,31 @@ class Stitch(HasTraits):
           (with appropriate settigns).
         * ``'hide'``: evaluate chunk but hide results
 
+    incremental : bool, default ``False``
+        Works with the cache turned on. Python chunks are analysed
+        statically and a chunk cache key depends on the chunks that
+        define the names it uses (not on the previous chunk). So after
+        an edit only changed chunks and chunks that depend on them
+        are executed (the kernel state is restored by re-executing
+        cached ancestors). Set ``incremental=False`` for chunks with
+        side effects: then the chunk depends on all previous chunks
+        and all next chunks depend on it.
+    checkpoint : bool, default ``False``
+        Works with the cache turned on and Python kernels.
+        Whether to save the kernel namespace after the chunk is executed
+        (via ``dill`` or ``cloudpickle`` that should be installed
+        in the kernel environment). On the next run if the chunk and
+        all previous chunks of the kernel are found in the cache then
+        the snapshot is restored instead of replaying them.
+    cache : bool, default ``True``
+        Chunk option only. If ``False`` then the chunk is always
+        executed even if the cache is turned on.
+    session : str, optional
+        Chunk option only. Chunks of the same language and session
+        share a kernel that is separate from the kernel of chunks
+        without session or with other session. So independent parts
+        of the document can be executed concurrently
+        (see ``parallel_sessions``).
 
     Notes
     -----
@@ -115,9 +230,18 @@ class Stitch(HasTraits):
     self_contained = opt.Bool(True)
     standalone = opt.Bool(True)
     use_prompt = opt.Bool(False)
+    parallel_kernels = opt.Bool(False)
+    async_depth = opt.Int(0)
+    pipeline_depth = opt.Int(0)
+    batch_pandoc = opt.Bool(True)
+    fast_markdown = opt.Bool(False)
+    prestart_kernels = opt.Bool(True)
+    parallel_sessions = opt.Bool(True)
 
     # Document or Cell
     warning = opt.Bool(True)
+    incremental = opt.Bool(False)
+    checkpoint = opt.Bool(False)
     error = opt.Choice({"continue", "raise"}, default_value="continue")
     prompt = opt.Str(None)
     echo = opt.Bool(True)
@@ -134,7 +258,11 @@ class Stitch(HasTraits):
                  prompt: str=None,
                  use_prompt: bool=False,
                  pandoc_extra_args: list=None,
-                 pandoc_format: str="markdown"):
+                 pandoc_format: str="markdown",
+                 cache: bool=False,
+                 refresh_cache: bool=False,
+                 kernel_pool=None,
+                 warm_kernels: dict=None):
         """
         Parameters
         ----------
@@ -158,16 +286,44 @@ class Stitch(HasTraits):
         pandoc_format : str, default ``markdown``
             Pandoc format option for converting text from markdown
             to JSON AST
+        cache : bool, default False
+            Whether to cache chunks execution results on disk
+            (see ``name_cache_dir``). When all chunks of a kernel
+            are found in the cache the kernel is not started at all.
+        refresh_cache : bool, default False
+            Whether to ignore stored cache (it's overwritten then).
+        kernel_pool : KernelPool, default None
+            If set then kernels are acquired from the pool instead of
+            being started. Return them via ``release_kernels``.
+        warm_kernels : dict, default None
+            ``kernel_managers`` dict shared between documents (watch mode).
+            Kernels keep the state of the previous document so cache
+            hits are used even if the kernel is started and nothing
+            is replayed.
         """
         super().__init__(standalone=standalone,
                          self_contained=self_contained, warning=warning,
                          error=error, prompt=prompt, use_prompt=use_prompt)
-        self._kernel_pairs = {}
+        self._kernel_pairs = warm_kernels if warm_kernels is not None else {}
+        self.warm = warm_kernels is not None
         self.name = name
         self.filter_to = filter_to
         self.resource_dir = self.name_resource_dir(name)
+        self._staging_dir = None
         self.pandoc_extra_args = pandoc_extra_args
         self.pandoc_format = pandoc_format
+        self.cache = ChunkCache(self.name_cache_dir(name), refresh=refresh_cache) if cache else None
+        self._chain = {}
+        self._pending = {}
+        self._blocks = {}
+        self.kernel_pool = kernel_pool
+        self._batch = None
+        self._api_version = None
+        self._routers = {}
+        self._graphs = {}
+        self._states = {}
+        self._starting = {}
+        self._timings = {'chunks': {}, 'kernels': {}}
 
     def __getattr__(self, attr):
         if '.' in attr:
@@ -204,11 +360,64 @@ class Stitch(HasTraits):
         """
         return '{}_files'.format(name)
 
+    @property
+    def staging_dir(self):
+        """
+        Directory the images of the document are written to. It replaces
+        ``resource_dir`` when the document is done (see ``commit_resources``).
+        """
+        if self._staging_dir is None:
+            self._staging_dir = '{}.{}.{}.tmp'.format(self.resource_dir, os.getpid(), id(self))
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            os.makedirs(self._staging_dir)
+        return self._staging_dir
+
+    def commit_resources(self, ok=True):
+        """
+        Replace ``resource_dir`` with ``staging_dir`` (if any images
+        were written) or discard ``staging_dir`` if not ``ok``. Renders
+        of the same document in parallel never mix their images and
+        a failed render keeps the previous ``resource_dir``.
+        """
+        staging, self._staging_dir = self._staging_dir, None
+        if staging is None:
+            return
+        if not ok:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        old = []
+        while True:
+            try:
+                os.rename(staging, self.resource_dir)
+                break
+            except OSError:
+                if not os.path.exists(self.resource_dir):
+                    raise
+                # a parallel render could have committed in between:
+                old.append('{}.{}.old'.format(staging, len(old)))
+                try:
+                    os.rename(self.resource_dir, old[-1])
+                except FileNotFoundError:
+                    old.pop()
+        for path in old:
+            shutil.rmtree(path, ignore_errors=True)
+
+    @property
+    def checkpoint_dir(self):
+        return os.path.join(self.cache.path, 'checkpoints')
+
+    @staticmethod
+    def name_cache_dir(name):
+        """
+        Give the directory name for the chunks cache
+        """
+        return '{}_cache'.format(name)
+
     @property
     def kernel_managers(self):
         """
         dict of KernelManager, KernelClient pairs, keyed by
-        kernel name.
+        kernel name (or ``session_key``).
         """
         return self._kernel_pairs
 
@@ -220,6 +429,7 @@ class Stitch(HasTraits):
         Parameters
         ----------
         kernel_name : str
+            kernel name or ``session_key``
 
         Returns
         -------
@@ -227,11 +437,100 @@ class Stitch(HasTraits):
         """
         kp = self.kernel_managers.get(kernel_name)
         if not kp:
+            future = self._starting.pop(kernel_name, None)
+            kp = future.result() if future is not None else self.start_kernel(kernel_name)
+            self.kernel_managers[kernel_name] = kp
+        return kp
+
+    def start_kernel(self, kernel_name):
+        """
+        Start a new kernel (or acquire it from ``kernel_pool``).
+
+        Parameters
+        ----------
+        kernel_name : str
+            kernel name or ``session_key``
+
+        Returns
+        -------
+        kp : KernelPair
+        """
+        kernel_name = session_kernel_name(kernel_name)
+        start = time.perf_counter()
+        if self.kernel_pool is not None:
+            kp = self.kernel_pool.acquire(kernel_name)
+        else:
             kp = kernel_factory(kernel_name)
             initialize_kernel(kernel_name, kp)
-            self.kernel_managers[kernel_name] = kp
+        self._timings['kernels'][kernel_name] = round(time.perf_counter() - start, 3)
         return kp
 
+    def needed_kernels(self, chunks):
+        """
+        Kernels that are going to be started to execute the chunks
+        (in the order of the first chunk): kernels that are not started
+        yet and have executable chunks that are not found in the cache.
+
+        Parameters
+        ----------
+        chunks : list of Chunk
+
+        Returns
+        -------
+        kernel_names : list of str
+            kernel names (or ``session_key``)
+        """
+        needed = []
+        chain, graphs = {}, {}
+        for chunk in chunks:
+            kernel_name = chunk.kernel_key
+            if (not chunk.executable or kernel_name in needed or
+                    kernel_name in self.kernel_managers):
+                continue
+            if self.cache is not None:
+                _, _, key = self.next_key(chunk, chain, graphs)
+                if chunk.attrs.get('cache') is not False and self.cache.contains(key):
+                    continue
+            needed.append(kernel_name)
+        return needed
+
+    def prestart(self, kernel_names):
+        """
+        Start kernels concurrently in the background. ``get_kernel``
+        waits for them.
+        """
+        kernel_names = [name for name in kernel_names
+                        if name not in self._starting and name not in self.kernel_managers]
+        if not kernel_names:
+            return
+        executor = ThreadPoolExecutor(max_workers=len(kernel_names))
+        for kernel_name in kernel_names:
+            self._starting[kernel_name] = executor.submit(self.start_kernel, kernel_name)
+        executor.shutdown(wait=False)
+
+    def adopt_started(self):
+        """
+        Add prestarted kernels that were not used to ``kernel_managers``
+        (so they are released or shut down like the others).
+        """
+        while self._starting:
+            kernel_name, future = self._starting.popitem()
+            # noinspection PyBroadException
+            try:
+                self.kernel_managers[kernel_name] = future.result()
+            except Exception:
+                pass  # the kernel was not used
+
+    def release_kernels(self):
+        """
+        Return kernels to ``kernel_pool`` (if it's set).
+        """
+        if self.kernel_pool is not None:
+            for kp in self.kernel_managers.values():
+                self.kernel_pool.release(kp)
+            self.kernel_managers.clear()
+            self._routers.clear()
+
     def get_option(self, option, attrs=None):
         if attrs is None:
             attrs = {}
@@ -263,52 +562,673 @@ class Stitch(HasTraits):
               - meta
               - blocks
         """
-        version = ast['pandoc-api-version']
-        meta = ast['meta']
-        blocks = ast['blocks']
+        self._batch = TokenizeBatch() if self.batch_pandoc else None
+        new_blocks = []
+        for item in self.run_document(ast, self.wrap_chunk):
+            if isinstance(item, list):
+                new_blocks.extend(item)
+            else:
+                new_blocks.append(item)
+        if self._batch is not None:
+            new_blocks = self._batch.flush(new_blocks, tokenize_block)
+            self._batch = None
+        result = {'pandoc-api-version': ast['pandoc-api-version'],
+                  'meta': ast['meta'],
+                  'blocks': new_blocks}
+        if self.filter_to == 'ipynb':
+            from .notebook import ipynb_ast  # notebook imports this module
+
+            result = ipynb_ast(result)
+        return result
+
+    def stitch_notebook(self, ast: dict) -> dict:
+        """
+        Convert a document to Jupyter notebook directly (not via Pandoc's
+        ipynb writer): outputs are taken from the kernel messages as is.
+
+        Parameters
+        ----------
+        ast : dict
+            Loaded Pandoc JSON AST
+
+        Returns
+        -------
+        nb : dict
+            nbformat 4 notebook
+        """
+        from .notebook import notebook  # notebook imports this module
+
+        self._batch = None
+        items = self.run_document(ast, lambda chunk, lm: chunk)
+        return notebook(self, ast['pandoc-api-version'], ast['meta'], items)
+
+    def run_document(self, ast: dict, wrap) -> list:
+        """
+        Execute the chunks of the document.
+
+        Parameters
+        ----------
+        ast : dict
+            Loaded Pandoc JSON AST
+        wrap : callable
+            ``wrap(chunk, lm)`` converts the executed chunk
+            (see ``wrap_chunk``)
+
+        Returns
+        -------
+        items : list
+            blocks that are not code blocks and ``wrap`` results
+            of the chunks (in the document order)
+        """
+        lm = self.start_document(ast['pandoc-api-version'], ast['meta'])
+        chunks = [self.parse_chunk(i, block, lm) if is_code_block(block) else block
+                  for i, block in enumerate(ast['blocks'])]
+        code_chunks = [c for c in chunks if isinstance(c, Chunk)]
+        needed = self.needed_kernels(code_chunks)
+        errors, _ = self.validate(code_chunks, needed, full=False)
+        if errors:
+            raise KnittyError('Invalid document (nothing was executed):\n' + '\n'.join(errors))
+        if self.prestart_kernels and self.async_depth <= 0:
+            self.prestart(needed)
+        wrapped = self.iter_wrapped(code_chunks, lm, wrap)
+
+        items = []
+        ok = False
+        try:
+            for chunk in chunks:
+                # We should only have code blocks now...
+                items.append(next(wrapped) if isinstance(chunk, Chunk) else chunk)
+            ok = True
+        finally:
+            self.commit_resources(ok)
+            self.adopt_started()
+            if self.cache is not None:
+                if ok:
+                    self.cache.prune()
+                self.cache.save_timings(self._timings)
+        return items
+
+    def start_document(self, version, meta):
+        """
+        Read document options and reset the state of the previous document.
 
+        Returns
+        -------
+        lm : LangMapper
+        """
+        self._api_version = tuple(version)
         self.parse_document_options(meta)
-        lm = opt.LangMapper(meta)
-        new_blocks = []
+        self._chain, self._pending, self._graphs, self._states, self._blocks = {}, {}, {}, {}, {}
+        if self.cache is not None:
+            self.cache.used.clear()
+            self._timings = self.cache.load_timings()
+        return opt.LangMapper(meta)
 
-        for i, block in enumerate(blocks):
-            if not is_code_block(block):
-                new_blocks.append(block)
+    def stitch_blocks(self, version, meta, blocks):
+        """
+        Streaming version of ``stitch_ast``: blocks are taken from
+        an iterable and yielded as soon as they are ready. Chunks are
+        executed sequentially: ``parallel_kernels``, ``parallel_sessions``,
+        ``async_depth``, ``pipeline_depth`` and ``batch_pandoc`` options
+        are ignored.
+
+        Parameters
+        ----------
+        version : list
+            pandoc-api-version
+        meta : dict
+        blocks : iterable of dicts
+
+        Yields
+        ------
+        block : dict
+        """
+        lm = self.start_document(version, meta)
+        self._batch = None
+        try:
+            for i, block in enumerate(blocks):
+                if not is_code_block(block):
+                    yield block
+                    continue
+                chunk = self.parse_chunk(i, block, lm)
+                self.execute_chunk(chunk)
+                yield from self.wrap_chunk(chunk, lm)
+        finally:
+            # blocks that link the images are already written:
+            self.commit_resources()
+        if self.cache is not None:
+            self.cache.prune()
+            self.cache.save_timings(self._timings)
+
+    def option_error(self, option, value):
+        """
+        Validate chunk option.
+
+        Returns
+        -------
+        error : str or None
+        """
+        if option == 'results':
+            if isinstance(value, str) and (value in ('default', 'hide') or re.match(r'^pandoc(\s|$)', value)):
+                return None
+            return "Invalid results option {!r}: expected 'default', 'hide' or 'pandoc [args]'".format(value)
+        if option == 'cache':
+            return None if isinstance(value, bool) else 'Invalid cache option {!r}: expected bool'.format(value)
+        if option == 'session':
+            if isinstance(value, str) and SESSION.match(value):
+                return None
+            return 'Invalid session option {!r}: expected a name (letters, digits, _, ., -)'.format(value)
+        if not self.has_trait(option):
+            return None
+        obj, name = self, option
+        if '.' in option:
+            ns, name = option.split('.', 1)
+            obj = getattr(self, ns)
+        try:
+            obj.traits()[name].validate(obj, value)
+        except TraitError as e:
+            return str(e)
+        return None
+
+    def validate(self, chunks, kernels=(), full=True):
+        """
+        Check chunk options, kernel specs and syntax of Python chunks
+        (syntax errors are errors only for chunks with ``error=raise``).
+
+        Parameters
+        ----------
+        chunks : list of Chunk
+        kernels : list of str
+            kernels (or ``session_key``) that would be started: missing
+            kernel specs of other kernels are warnings
+        full : bool, default True
+            whether to do the checks that can only give warnings
+
+        Returns
+        -------
+        tuple
+            ``(errors, warnings)`` lists of str
+        """
+        errors, warnings = [], []
+        kernel_names = []
+        kernels = {session_kernel_name(key) for key in kernels}
+        for chunk in chunks:
+            for option, value in chunk.attrs.items():
+                error = self.option_error(option, value)
+                if error is not None:
+                    errors.append('chunk {}: {}'.format(chunk.name, error))
+            if not chunk.executable:
                 continue
-            # We should only have code blocks now...
-            # Execute first, to get prompt numbers
-            (lang, name), attrs = parse_kernel_arguments(block)
-            attrs['eval'] = self.get_option('eval', attrs)
-            kernel_name = lm.map_to_kernel(lang)
-            if name is None:
-                name = "unnamed_chunk_{}".format(i)
-            if is_executable(block, kernel_name, attrs):
-                # still need to check, since kernel_factory(lang) is executaed
-                # even if the key is present, only want one kernel / lang
-                kernel = self.get_kernel(kernel_name)
-                messages = execute_block(block, kernel)
-                execution_count = extract_execution_count(messages)
+            if chunk.kernel_name not in kernel_names and chunk.kernel_name not in self.kernel_managers:
+                kernel_names.append(chunk.kernel_name)
+            raise_ = self.get_option('error', chunk.attrs) == 'raise'
+            if (full or raise_) and is_python_kernel(chunk.kernel_name):
+                error = syntax_error(chunk.block['c'][1])
+                if error is not None:
+                    (errors if raise_ else warnings).append('chunk {}: {}'.format(chunk.name, error))
+        for kernel_name in (kernel_names if full else [k for k in kernel_names if k in kernels]):
+            # noinspection PyBroadException
+            try:
+                get_kernel_spec(kernel_name)
+            except Exception:
+                (errors if kernel_name in kernels else warnings).append(
+                    'kernel {!r} is not installed'.format(kernel_name))
+        return errors, warnings
+
+    def plan(self, ast: dict) -> dict:
+        """
+        Validate the document and predict cache hits and duration
+        (from the previous runs) without executing anything.
+
+        Parameters
+        ----------
+        ast : dict
+            Loaded Pandoc JSON AST
+
+        Returns
+        -------
+        plan : dict
+            JSON serializable
+        """
+        try:
+            lm = self.start_document(ast['pandoc-api-version'], ast['meta'])
+            chunks = [self.parse_chunk(i, block, lm) for i, block in enumerate(ast['blocks'])
+                      if is_code_block(block)]
+        except (TraitError, TypeError) as e:
+            return {'ok': False, 'errors': ['document: {}'.format(e)], 'warnings': []}
+        executable = [chunk for chunk in chunks if chunk.executable]
+        needed = self.needed_kernels(chunks)
+        errors, warnings = self.validate(chunks, needed)
+
+        timings = self._timings
+        kernels = {}
+        hits = misses = 0
+        unknown = 0
+        chain, graphs, pending, names = {}, {}, {}, {}
+        live = set(self.kernel_managers)
+
+        def duration(name):
+            nonlocal unknown
+            if name not in timings['chunks']:
+                unknown += 1
+            return timings['chunks'].get(name, 0)
+
+        for chunk in executable:
+            kernel_name = chunk.kernel_key
+            kernel = kernels.setdefault(kernel_name, {'chunks': 0, 'cached': 0, 'executed': 0, 'replayed': 0,
+                                                      'start': kernel_name in needed, 'seconds': 0})
+            kernel['chunks'] += 1
+            graph, node, key = (None, None, None)
+            use_cache = self.cache is not None and chunk.attrs.get('cache') is not False
+            if self.cache is not None:
+                graph, node, key = self.next_key(chunk, chain, graphs)
+            kernel_pending = pending.setdefault(kernel_name, [])
+            if graph is not None:
+                names.setdefault(kernel_name, {})[node] = chunk.name
+            if use_cache and (kernel_name not in live or graph is not None or self.warm) and self.cache.contains(key):
+                hits += 1
+                kernel['cached'] += 1
+                kernel_pending.append((node, chunk.name))
+                continue
+            misses += 1 if use_cache else 0
+            if graph is None:
+                replay = [name for _, name in kernel_pending]
+                kernel_pending.clear()
             else:
-                execution_count = None
-                messages = []
-
-            # ... now handle input formatting...
-            if self.get_option('echo', attrs):
-                prompt = self.get_option('prompt', attrs)
-                new_blocks.append(wrap_input_code(block, self.use_prompt, prompt,
-                                                  execution_count, lm.map_to_style(lang)))
-
-            # ... and output formatting
-            if is_stitchable(messages, attrs):
-                result = self.wrap_output(
-                    name, messages, attrs,
-                )
-                new_blocks.extend(result)
-        result = {'pandoc-api-version': version,
-                  'meta': meta,
-                  'blocks': new_blocks}
+                nodes = graph.restore(node, {i for i, _ in kernel_pending})
+                replay = [names[kernel_name][i] for i in nodes]
+                kernel_pending[:] = [p for p in kernel_pending if p[0] not in nodes]
+            if kernel_name not in live:
+                live.add(kernel_name)
+                startup = timings['kernels'].get(chunk.kernel_name)
+                if startup is None:
+                    unknown += 1
+                kernel['seconds'] += startup or 0
+            kernel['executed'] += 1
+            kernel['replayed'] += len(replay)
+            kernel['seconds'] += duration(chunk.name) + sum(duration(name) for name in replay)
+
+        # queues of kernels (see ``queue_key``) are executed concurrently:
+        queues = {}
+        for chunk in executable:
+            queues.setdefault(self.queue_key(chunk), set()).add(chunk.kernel_key)
+        estimated = max((sum(kernels[key]['seconds'] for key in keys) for keys in queues.values()), default=0)
+        for kernel in kernels.values():
+            kernel['seconds'] = round(kernel['seconds'], 3)
+        return {
+            'ok': not errors,
+            'errors': errors,
+            'warnings': warnings,
+            'chunks': len(chunks),
+            'executable': len(executable),
+            'kernels': kernels,
+            'cache': None if self.cache is None else {'hits': hits, 'misses': misses},
+            'estimated_seconds': round(estimated, 3),
+            'unknown_timings': unknown,
+        }
+
+    def iter_wrapped(self, chunks, lm, wrap=None):
+        """
+        Execute chunks and yield their wrapped input and output blocks
+        (in the same order). Execution engine depends on
+        ``async_depth``, ``parallel_kernels``, ``parallel_sessions`` and
+        ``pipeline_depth`` options.
+
+        Parameters
+        ----------
+        chunks : list of Chunk
+        lm : LangMapper
+        wrap : callable, optional
+            ``wrap(chunk, lm)`` instead of ``wrap_chunk``
+
+        Yields
+        ------
+        blocks : list
+            (or ``wrap`` result)
+        """
+        wrap = wrap or self.wrap_chunk
+        if self.async_depth > 0:
+            from .engine import AsyncEngine  # engine imports this module
+
+            yield from AsyncEngine(self, self.async_depth).stitch(chunks, lm, wrap)
+            return
+        if len({self.queue_key(chunk) for chunk in chunks}) > 1:
+            self.execute_parallel(chunks)
+            executed = chunks
+        else:
+            executed = self.iter_executed(chunks)
+        for chunk in executed:
+            # Execute first, to get prompt numbers
+            yield wrap(chunk, lm)
+
+    def parse_chunk(self, i, block, lm):
+        """
+        Parameters
+        ----------
+        i : int
+            block index in the document
+        block : dict
+            code block
+        lm : LangMapper
+
+        Returns
+        -------
+        chunk : Chunk
+        """
+        (lang, name), attrs = parse_kernel_arguments(block)
+        attrs['eval'] = self.get_option('eval', attrs)
+        if name is None:
+            name = "unnamed_chunk_{}".format(i)
+        return Chunk(block, lang, name, attrs, lm.map_to_kernel(lang))
+
+    def execute_chunk(self, chunk):
+        """
+        Set ``chunk.messages`` if the chunk is executable.
+        """
+        if chunk.executable:
+            chunk.messages = self.run_chunk(chunk)
+
+    def iter_executed(self, chunks):
+        """
+        Execute chunks in order and yield them. With ``pipeline_depth``
+        option next chunks are submitted before the chunk is yielded.
+        """
+        if self.pipeline_depth <= 0:
+            for chunk in chunks:
+                self.execute_chunk(chunk)
+                yield chunk
+            return
+        window = deque()
+        for chunk in chunks:
+            window.append((chunk, self.submit_chunk(chunk)))
+            if len(window) > self.pipeline_depth:
+                chunk_, result = window.popleft()
+                chunk_.messages = result()
+                yield chunk_
+        while window:
+            chunk_, result = window.popleft()
+            chunk_.messages = result()
+            yield chunk_
+
+    def queue_key(self, chunk):
+        """
+        Chunks with different queue keys are executed concurrently
+        (see ``parallel_kernels`` and ``parallel_sessions`` options).
+        """
+        if self.async_depth > 0:
+            return ''
+        if self.parallel_kernels or (self.parallel_sessions and chunk.attrs.get('session')):
+            return chunk.kernel_key
+        return ''
+
+    def execute_parallel(self, chunks):
+        """
+        Execute chunks of different queues (different kernels or
+        sessions, see ``queue_key``) concurrently. Chunks of the same
+        queue are executed in the document order.
+        """
+        queues = {}
+        for chunk in chunks:
+            queues.setdefault(self.queue_key(chunk), []).append(chunk)
+
+        def work(queue):
+            for _ in self.iter_executed(queue):
+                pass
+
+        with ThreadPoolExecutor(max_workers=max(len(queues), 1)) as executor:
+            for future in [executor.submit(work, queue) for queue in queues.values()]:
+                future.result()
+
+    def wrap_chunk(self, chunk, lm):
+        """
+        Wrap input code and output messages of the executed chunk.
+
+        Returns
+        -------
+        blocks : list
+        """
+        blocks = []
+        messages, attrs = chunk.messages, chunk.attrs
+        # ... now handle input formatting...
+        if self.get_option('echo', attrs):
+            prompt = self.get_option('prompt', attrs)
+            blocks.append(wrap_input_code(chunk.block, self.use_prompt, prompt,
+                                          extract_execution_count(messages), lm.map_to_style(chunk.lang)))
+
+        # ... and output formatting
+        if is_stitchable(messages, attrs):
+            blocks.extend(self.wrap_output(chunk.name, messages, attrs))
+        return blocks
+
+    def run_chunk(self, chunk):
+        """
+        Execute a code chunk or take it's messages from the cache.
+
+        The cache key of the chunk depends on the key of the previous
+        chunk of the same kernel. While the kernel is not started
+        cache hits are replayed. On the first miss the kernel is started
+        and the replayed chunks are executed again to restore the
+        kernel state (their messages are discarded).
+        With ``incremental`` option the key depends on the chunks
+        from the def-use graph and only ancestors of the missed chunk
+        are executed again (see ``DefUseGraph.restore``).
+
+        Parameters
+        ----------
+        chunk : Chunk
+
+        Returns
+        -------
+        messages : list of dicts
+        """
+        messages, replay, key = self.lookup_chunk(chunk, chunk.kernel_key in self.kernel_managers)
+        if messages is not None:
+            return messages
+        # still need to check, since kernel_factory(lang) is executaed
+        # even if the key is present, only want one kernel / lang
+        kernel = self.get_kernel(chunk.kernel_key)
+        for block in replay:
+            execute_block(block, kernel)
+        messages = execute_block(chunk.block, kernel)
+        self.store_chunk(key, messages, chunk.name)
+        if chunk.checkpoint:
+            self.check_snapshot(chunk, run_code(snapshot_code(chunk.checkpoint), kernel, store_history=False))
+        return messages
+
+    def submit_chunk(self, chunk):
+        """
+        Pipelined version of ``run_chunk``: sends the chunk (and replayed
+        chunks) to the kernel without waiting.
+
+        Parameters
+        ----------
+        chunk : Chunk
+
+        Returns
+        -------
+        result : callable
+            returns chunk messages (waits for them if needed)
+        """
+        if not chunk.executable:
+            return lambda: chunk.messages
+        messages, replay, key = self.lookup_chunk(chunk, chunk.kernel_key in self.kernel_managers)
+        if messages is not None:
+            return lambda: messages
+        router = self.get_router(chunk.kernel_key)
+        replay_ids = [router.submit(block['c'][1]) for block in replay]
+        msg_id = router.submit(chunk.block['c'][1])
+        snapshot_id = (router.submit(snapshot_code(chunk.checkpoint), store_history=False)
+                       if chunk.checkpoint else None)
+
+        def result():
+            for replay_id in replay_ids:
+                router.wait(replay_id)
+            messages_ = router.wait(msg_id)
+            self.store_chunk(key, messages_, chunk.name)
+            if snapshot_id is not None:
+                self.check_snapshot(chunk, router.wait(snapshot_id))
+            return messages_
         return result
 
+    def get_router(self, kernel_name):
+        """
+        Get ``MessageRouter`` of the kernel (starting the kernel if needed).
+        """
+        from .router import MessageRouter  # router imports this module
+
+        kp = self.get_kernel(kernel_name)
+        router = self._routers.get(kernel_name)
+        if router is None or router.kp is not kp:
+            router = self._routers[kernel_name] = MessageRouter(kp)
+        return router
+
+    def lookup_chunk(self, chunk, live):
+        """
+        Look up chunk in the cache.
+
+        Parameters
+        ----------
+        chunk : Chunk
+        live : bool
+            whether the chunk kernel is already started
+
+        Returns
+        -------
+        tuple
+            ``(messages, replay, key)``: messages are ``None`` if the
+            chunk should be executed, replay is a list of blocks to be
+            executed first to restore the kernel state, key is ``None``
+            if the chunk result should not be stored.
+        """
+        if self.cache is None:
+            return None, [], None
+        kernel_key, attrs = chunk.kernel_key, chunk.attrs
+        graph, node, key = self.next_key(chunk, self._chain, self._graphs)
+        state = self._states[kernel_key] = state_key(self._states.get(kernel_key), key)
+        if self.get_option('checkpoint', attrs) and is_python_kernel(chunk.kernel_name):
+            chunk.checkpoint = checkpoint_path(self.checkpoint_dir, chunk.name, state)
+        use_cache = attrs.get('cache') is not False
+        pending = self._pending.setdefault(kernel_key, [])
+        replay = []
+        if graph is not None:
+            blocks = self._blocks.setdefault(kernel_key, {})
+            blocks[node] = chunk.block
+
+        # with def-use graph or warm kernels cache hits are valid even if the kernel is started
+        if not live or graph is not None or self.warm:
+            messages = self.cache.get(key) if use_cache else None
+            if messages is not None:
+                if not (live and self.warm):
+                    pending.append((node, chunk.block, chunk.checkpoint))
+                elif graph is not None:
+                    graph.run(node)
+                return messages, [], key
+            if not live:
+                restored = [i for i, _, _ in pending]
+                replay = self.restore_snapshot(pending)
+                for i in restored[:len(restored) - len(pending)] if graph is not None else ():
+                    graph.run(i)
+            if graph is None:
+                replay += [block for _, block, _ in pending]
+                pending.clear()
+            else:
+                # replayed chunks can overwrite later definitions, these are executed again too:
+                nodes = graph.restore(node, {i for i, _, _ in pending})
+                replay += [blocks[i] for i in nodes]
+                pending[:] = [p for p in pending if p[0] not in nodes]
+        elif use_cache:
+            self.cache.count(False)
+        return None, replay, (key if use_cache else None)
+
+    def restore_snapshot(self, pending):
+        """
+        Find the latest pending chunk with a snapshot. Pending chunks
+        before it (and the chunk) are removed from ``pending``.
+
+        Returns
+        -------
+        replay : list
+            code block that restores the snapshot or empty list
+        """
+        for i in reversed(range(len(pending))):
+            path = pending[i][2]
+            if path and os.path.isfile(path):
+                del pending[:i + 1]
+                return [restore_block(path)]
+        return []
+
+    def check_snapshot(self, chunk, messages):
+        """
+        Report failed snapshot and remove old snapshots of the chunk.
+        """
+        for message in messages:
+            content = message['content']
+            if message['msg_type'] == 'error':
+                print('knitty: snapshot after chunk {} failed: {}: {}'.format(
+                    chunk.name, content['ename'], content['evalue']), file=sys.stderr)
+                return
+            if is_stdout(message) and content['text'].startswith(SKIPPED):
+                print('knitty: snapshot after chunk {} skipped unpicklable variables:{}'.format(
+                    chunk.name, content['text'][len(SKIPPED):].rstrip()), file=sys.stderr)
+        remove_stale(self.checkpoint_dir, chunk.name, keep=[chunk.checkpoint])
+
+    def next_key(self, chunk, chain, graphs):
+        """
+        Cache key of the next chunk. Depends on the previous chunk of
+        the kernel (``chain`` dict of keys by ``Chunk.kernel_key``) or on
+        the chunks from the def-use graph (``graphs`` dict, see
+        ``get_graph``). Dicts are updated.
+
+        Returns
+        -------
+        tuple
+            ``(graph, node, key)``: graph and node are ``None``
+            if the def-use graph is not used.
+        """
+        kernel_name, attrs = chunk.kernel_name, chunk.attrs
+        graph = self.get_graph(chunk, graphs)
+        if graph is None:
+            prev = chain.get(chunk.kernel_key)
+            key = chain[chunk.kernel_key] = chunk_key(kernel_name, chunk.block['c'][1], attrs,
+                                                      [prev] if prev else [])
+            return None, None, key
+        node = graph.add(chunk.block['c'][1], attrs, barrier=not self.get_option('incremental', attrs))
+        return graph, node, graph.keys[node]
+
+    def get_graph(self, chunk, graphs=None):
+        """
+        Def-use graph of the chunk kernel if ``incremental`` option
+        is set for the document and the kernel is a Python kernel.
+
+        Parameters
+        ----------
+        chunk : Chunk
+        graphs : dict, default None
+            graphs by ``Chunk.kernel_key``, default is the graphs of the document
+
+        Returns
+        -------
+        graph : DefUseGraph or None
+        """
+        if not self.incremental or not is_python_kernel(chunk.kernel_name):
+            return None
+        graphs = self._graphs if graphs is None else graphs
+        graph = graphs.get(chunk.kernel_key)
+        if graph is None:
+            graph = graphs[chunk.kernel_key] = DefUseGraph(chunk.kernel_name)
+        return graph
+
+    def store_chunk(self, key, messages, chunk_name=None):
+        """
+        Store messages in the cache (if ``key`` is not ``None``)
+        and remember the chunk duration (see ``Messages``).
+        """
+        if key is not None:
+            self.cache.put(key, messages)
+        duration = getattr(messages, 'duration', None)
+        if chunk_name is not None and duration is not None:
+            self._timings['chunks'][chunk_name] = round(duration, 3)
+
     def wrap_output(self, chunk_name, messages, attrs):
         """
         Wrap the messages of a code-block.
@@ -326,7 +1246,8 @@ class Stitch(HasTraits):
 
         Notes
         -----
-        Messages printed to stdout are wrapped in a CodeBlock.
+        Messages printed to stdout are wrapped in a CodeBlock
+        (adjacent stream messages are merged, see ``coalesce_streams``).
         Messages publishing mimetypes (e.g. matplotlib figures)
         resuse Jupyter's display priority. See
         ``NbConvertBase.display_data_priority``.
@@ -357,7 +1278,10 @@ class Stitch(HasTraits):
             md_format, md_extra_args = 'markdown', None
 
         # messsage_pairs can come from stdout or the io stream (maybe others?)
-        output_messages = [x for x in messages if not is_execute_input(x)]
+        # merged before hidden stderr is dropped (it still separates stdout blocks):
+        warning = self.get_option('warning', attrs)
+        output_messages = [x for x in coalesce_streams([x for x in messages if not is_execute_input(x)])
+                           if warning or not is_stderr(x)]
         display_messages = [x for x in output_messages if not is_stdout(x) and
                             not is_stderr(x)]
 
@@ -365,15 +1289,15 @@ class Stitch(HasTraits):
 
         # Handle all stdout first...
         for message in output_messages:
-            is_warning = is_stderr(message) and self.get_option('warning', attrs)
+            is_warning = is_stderr(message)
             if is_stdout(message) or is_warning:
                 text = message['content']['text']
                 output_blocks += (
-                    plain_output(text) if is_warning else
-                    plain_output(text, pandoc_format, pandoc_extra_args, pandoc)
+                    self.tokenize(text, pandoc_format, pandoc_extra_args) if pandoc and not is_warning else
+                    plain_output(text)
                 )
 
-        priority = list(enumerate(NbConvertBase().display_data_priority))
+        priority = list(enumerate(display_data_priority()))
         priority.append((len(priority), 'application/javascript'))
         order = dict(
             (x[1], x[0]) for x in priority
@@ -400,7 +1324,8 @@ class Stitch(HasTraits):
 
                 if key == 'text/plain':
                     # ident, classes, kvs
-                    blocks = plain_output(data, pandoc_format, pandoc_extra_args, pandoc)
+                    blocks = (self.tokenize(data, pandoc_format, pandoc_extra_args) if pandoc else
+                              plain_output(data))
                 elif key == 'text/latex':
                     blocks = [RawBlock('latex', data)]
                 elif key == 'text/html':
@@ -411,13 +1336,28 @@ class Stitch(HasTraits):
                 elif key.startswith('image') or key == 'application/pdf':
                     blocks = [self.wrap_image_output(chunk_name, data, key, attrs)]
                 elif key == 'text/markdown':
-                    blocks = tokenize_block(data, md_format, md_extra_args)
+                    blocks = self.tokenize(data, md_format, md_extra_args)
                 else:
-                    blocks = tokenize_block(data, pandoc_format, pandoc_extra_args)
+                    blocks = self.tokenize(data, pandoc_format, pandoc_extra_args)
 
             output_blocks += blocks
         return output_blocks
 
+    def tokenize(self, source, pandoc_format, pandoc_extra_args):
+        """
+        Same as ``tokenize_block`` but inside ``stitch_ast`` with
+        ``batch_pandoc`` option the conversion is deferred: a placeholder
+        is returned and all placeholders are converted at once at the end.
+        With ``fast_markdown`` option simple markdown is converted in-process.
+        """
+        if self.fast_markdown:
+            blocks = fast_tokenize(source, pandoc_format, pandoc_extra_args, self._api_version)
+            if blocks is not None:
+                return blocks
+        if self._batch is not None:
+            return [self._batch.add(source, pandoc_format, pandoc_extra_args)]
+        return tokenize_block(source, pandoc_format, pandoc_extra_args)
+
     def wrap_image_output(self, chunk_name, data, key, attrs):
         """
         Extra handling for images
@@ -462,15 +1402,17 @@ class Stitch(HasTraits):
                 raise TypeError("Unknown mimetype %s" % key)
         else:
             # we are saving to filesystem
+            # the file is written to the staging dir, the link is to resource_dir:
             ext = mimetypes.guess_extension(key)
             filepath = os.path.join(self.resource_dir,
                                     "{}{}".format(chunk_name, ext))
-            os.makedirs(self.resource_dir, exist_ok=True)
+            staging_path = os.path.join(self.staging_dir,
+                                        "{}{}".format(chunk_name, ext))
             if ext == '.svg':
-                with open(filepath, 'wt', encoding='utf-8') as f:
+                with open(staging_path, 'wt', encoding='utf-8') as f:
                     f.write(data)
             else:
-                with open(filepath, 'wb') as f:
+                with open(staging_path, 'wb') as f:
                     f.write(base64.decodebytes(data.encode('utf-8')))
             # Image :: alt text (list of inlines), target
             # Image :: Attr [Inline] Target
@@ -482,13 +1424,19 @@ class Stitch(HasTraits):
         return block
 
 
-def kernel_factory(kernel_name: str) -> KernelPair:
+def kernel_factory(kernel_name: str, profile=None, **kwargs) -> KernelPair:
     """
     Start a new kernel.
 
     Parameters
     ----------
     kernel_name : str
+    profile : KernelProfile, default None
+        If it sets ``fork`` for the kernel then the kernel is forked
+        from a warm fork server. Defaults to ``KNITTY_KERNEL_PROFILE``
+        profile.
+    kwargs :
+        passed to ``KernelManager.start_kernel`` (like ``cwd``)
 
     Returns
     -------
@@ -496,7 +1444,34 @@ def kernel_factory(kernel_name: str) -> KernelPair:
       - km (KernelManager)
       - kc (KernelClient)
     """
-    return KernelPair(*start_new_kernel(kernel_name=kernel_name))
+    from jupyter_client.manager import KernelManager
+
+    # same as ``start_new_kernel`` but kernel specs are cached:
+    server = fork_server(kernel_name, profile if profile is not None else default_profile())
+    if server is not None:
+        km = fork_kernel_manager(server, kernel_name=kernel_name, kernel_spec_manager=kernel_spec_manager())
+    else:
+        km = KernelManager(kernel_name=kernel_name, kernel_spec_manager=kernel_spec_manager())
+    km.start_kernel(**kwargs)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=60)
+    except RuntimeError:
+        kc.stop_channels()
+        km.shutdown_kernel()
+        raise
+    return KernelPair(km, kc)
+
+
+@lru_cache(maxsize=None)
+def display_data_priority() -> tuple:
+    """
+    ``NbConvertBase.display_data_priority``
+    """
+    from nbconvert.utils.base import NbConvertBase
+
+    return tuple(NbConvertBase().display_data_priority)
 
 
 # -----------
@@ -598,7 +1573,7 @@ def tokenize_block(source: str, pandoc_format: str="markdown", pandoc_extra_args
     """
     if pandoc_extra_args is None:
         pandoc_extra_args = []
-    json_doc = pf.convert_text(
+    json_doc = panflute().convert_text(
         source, input_format=pandoc_format, output_format='json',
         standalone=('--standalone' in pandoc_extra_args),
         extra_args=[a for a in pandoc_extra_args if a != '--standalone'])
@@ -681,6 +1656,24 @@ def is_execute_input(message):
     return message['msg_type'] == 'execute_input'
 
 
+def coalesce_streams(messages: list) -> list:
+    """
+    Merge adjacent ``stdout`` stream messages (and adjacent ``stderr``
+    ones) into a single message: a chunk that prints in a loop can send
+    a message per line. Other messages break the runs and keep their place.
+    """
+    runs = []
+    for message in messages:
+        name = message['content'].get('name') if message['msg_type'] == 'stream' else None
+        if name is not None and runs and runs[-1][0] == name:
+            runs[-1][1].append(message)
+        else:
+            runs.append((name, [message]))
+    return [run[0] if len(run) == 1 else
+            dict(run[0], content=dict(run[0]['content'], text=''.join(m['content']['text'] for m in run)))
+            for _, run in runs]
+
+
 # --------------
 # Code Execution
 # --------------
@@ -692,7 +1685,7 @@ def execute_block(block, kp, timeout=None):
     return messages
 
 
-def run_code(code: str, kp: KernelPair, timeout=None):
+def run_code(code: str, kp: KernelPair, timeout=None, store_history=True):
     """
     Execute a code chunk, capturing the output.
 
@@ -701,6 +1694,8 @@ def run_code(code: str, kp: KernelPair, timeout=None):
     code : str
     kp : KernelPair
     timeout : int
+    store_history : bool
+        If ``False`` then the execution count is not incremented.
 
     Returns
     -------
@@ -711,7 +1706,7 @@ def run_code(code: str, kp: KernelPair, timeout=None):
     See https://github.com/jupyter/nbconvert/blob/master/nbconvert
       /preprocessors/execute.py
     """
-    msg_id = kp.kc.execute(code)
+    msg_id = kp.kc.execute(code, store_history=store_history)
     while True:
         try:
             msg = kp.kc.shell_channel.get_msg(timeout=timeout)
@@ -725,9 +1720,9 @@ def run_code(code: str, kp: KernelPair, timeout=None):
             # not our reply
             continue
 
-    messages = []
+    collector = OutputCollector(msg_id)
 
-    while True:  # until idle message
+    while not collector.done:  # until idle message
         try:
             # We've already waited for execute_reply, so all output
             # should already be waiting. However, on slow networks, like
@@ -736,31 +1731,70 @@ def run_code(code: str, kp: KernelPair, timeout=None):
             # finishes, we won't actually have to wait this long, anyway.
             msg = kp.kc.iopub_channel.get_msg(timeout=4)
         except Empty:
-            pass
             # TODO: Log error
-        if msg['parent_header'].get('msg_id') != msg_id:
-            # not an output from our execution
             continue
+        collector.feed(msg)
+    return collector.messages
+
+
+class Messages(list):
+    """
+    Output messages of the execution request.
+
+    Attributes
+    ----------
+    duration : float or None
+        seconds between kernel ``busy`` and ``idle`` statuses
+    """
+    duration = None
+
+
+class OutputCollector:
+    """
+    Collects iopub messages that are outputs of the execution request.
+    Used by both sync and async code execution.
+
+    Attributes
+    ----------
+    msg_id : str
+        execute request ``msg_id``
+    messages : Messages
+    done : bool
+        whether the kernel became idle after the execution
+    """
+    def __init__(self, msg_id):
+        self.msg_id = msg_id
+        self.messages = Messages()
+        self.done = False
+        self._busy = None
+
+    def feed(self, msg):
+        """
+        Returns ``True`` if the message is an output from our execution.
+        """
+        if msg['parent_header'].get('msg_id') != self.msg_id:
+            # not an output from our execution
+            return False
 
         msg_type = msg['msg_type']
         content = msg['content']
 
         if msg_type == 'status':
-            if content['execution_state'] == 'idle':
-                break
-            else:
-                continue
+            date = msg['header'].get('date')
+            if content['execution_state'] == 'busy':
+                self._busy = date
+            elif content['execution_state'] == 'idle':
+                self.done = True
+                if isinstance(date, datetime) and isinstance(self._busy, datetime):
+                    self.messages.duration = (date - self._busy).total_seconds()
         elif msg_type in ('execute_input', 'execute_result', 'display_data',
                           'stream', 'error'):
             # Keep `execute_input` just for execution_count if there's
             # no result
-            messages.append(msg)
+            self.messages.append(msg)
         elif msg_type == 'clear_output':
-            messages = []
-            continue
-        elif msg_type.startswith('comm'):
-            continue
-    return messages
+            self.messages = Messages()
+        return True
 
 
 def extract_execution_count(messages):
@@ -772,28 +1806,50 @@ def extract_execution_count(messages):
             return count
 
 
-def initialize_kernel(name, kp):
+PYTHON_INIT_CODE = """\
+%colors NoColor
+try:
+    %matplotlib inline
+except:
+    pass
+try:
+    import pandas as pd
+    pd.options.display.latex.repr = True
+except:
+    pass
+"""
+INIT_TIMEOUT = 600
+
+
+def kernel_init_code(name, profile=None):
+    """
+    Code that is executed in a new kernel: Python kernel settings
+    and ``preimport`` modules of the kernel profile.
+
+    Parameters
+    ----------
+    name : str
+        kernel name
+    profile : KernelProfile, default None
+        Defaults to ``KNITTY_KERNEL_PROFILE`` profile.
+
+    Returns
+    -------
+    code : str
+    """
     # TODO: set_matplotlib_formats takes *args
     # TODO: do as needed? Push on user?
     # valid_formats = ["png", "jpg", "jpeg", "pdf", "svg"]
-    if name == 'python':
-        code = """\
-        %colors NoColor
-        try:
-            %matplotlib inline
-        except:
-            pass
-        try:
-            import pandas as pd
-            pd.options.display.latex.repr = True
-        except:
-            pass
-        """
-        kp.kc.execute(code, store_history=False)
-        # fmt_code = '\n'.join("set_matplotlib_formats('{}')".format(fmt)
-        #                      for fmt in valid_formats)
-        # code = dedent(code) + fmt_code
-        # kp.kc.execute(code, store_history=False)
-    else:
-        # raise ValueError(name)
-        pass
+    profile = profile if profile is not None else default_profile()
+    code = PYTHON_INIT_CODE if name == 'python' else ''
+    return code + profile.preimport_code(name)
+
+
+def initialize_kernel(name, kp, profile=None):
+    """
+    Execute ``kernel_init_code`` and wait until it's done
+    (so the kernel is warm when it's returned).
+    """
+    code = kernel_init_code(name, profile)
+    if code:
+        run_code(code, kp, timeout=INIT_TIMEOUT, store_history=False)
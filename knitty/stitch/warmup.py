@@ -0,0 +1,111 @@
+"""
+Kernel profile: modules to import when a kernel is started (per kernel
+name) and whether to fork Python kernels from a warm fork server
+(see ``knitty.stitch.fork``). Profile is a YAML file::
+
+    python:
+      preimport: [numpy, pandas, matplotlib.pyplot]
+      fork: true
+    ir:
+      preimport: [ggplot2]
+
+Its path is set via ``KNITTY_KERNEL_PROFILE`` environment variable
+(or ``knitty-daemon start --profile``).
+"""
+import os
+import re
+from functools import lru_cache
+from typing import List
+
+from ..tools import KnittyError
+from .kernelspec import get_kernel_spec
+
+PROFILE_ENV = 'KNITTY_KERNEL_PROFILE'
+MODULE = re.compile(r'^[\w.]+$')
+
+# Modules are loaded without binding names in the kernel namespace.
+# Code per kernel language:
+PREIMPORT_CODE = {
+    'python': '''\
+def _knitty_preimport(modules):
+    import importlib
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass
+_knitty_preimport([{modules}])
+del _knitty_preimport
+''',
+    'r': '''\
+invisible(lapply(c({modules}), function(p) suppressWarnings(suppressPackageStartupMessages(
+    requireNamespace(p, quietly = TRUE)))))
+''',
+}
+
+
+class KernelProfile:
+    """
+    Parameters
+    ----------
+    kernels : dict, default None
+        ``{kernel_name: {'preimport': [module, ...], 'fork': bool}}``
+    """
+    def __init__(self, kernels: dict=None):
+        kernels = kernels if kernels else {}
+        if not isinstance(kernels, dict):
+            raise KnittyError('Kernel profile should be a mapping of kernel names to settings.')
+        for kernel_name, settings in kernels.items():
+            if not isinstance(settings, dict) or set(settings) - {'preimport', 'fork'}:
+                raise KnittyError("Kernel profile settings of '{}' should be a mapping ".format(kernel_name) +
+                                  "with 'preimport' and 'fork' keys.")
+            preimport = settings.get('preimport', [])
+            if not isinstance(preimport, list) or not all(
+                    isinstance(m, str) and MODULE.match(m) for m in preimport):
+                raise KnittyError("Kernel profile: 'preimport' of '{}' should be a list of module names.".format(
+                    kernel_name))
+            if not isinstance(settings.get('fork', False), bool):
+                raise KnittyError("Kernel profile: 'fork' of '{}' should be true or false.".format(kernel_name))
+        self.kernels = kernels
+
+    @classmethod
+    def load(cls, path: str) -> 'KernelProfile':
+        import yaml
+
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(yaml.safe_load(f))
+
+    def preimport(self, kernel_name: str) -> List[str]:
+        return list(self.kernels.get(kernel_name, {}).get('preimport', []))
+
+    def fork(self, kernel_name: str) -> bool:
+        return self.kernels.get(kernel_name, {}).get('fork', False)
+
+    def preimport_code(self, kernel_name: str) -> str:
+        """
+        Code that imports ``preimport`` modules (empty string if there
+        are none or the kernel language is not supported).
+        """
+        modules = self.preimport(kernel_name)
+        if not modules:
+            return ''
+        try:
+            language = get_kernel_spec(kernel_name).language.lower()
+        except Exception:
+            return ''
+        if language not in PREIMPORT_CODE:
+            return ''
+        return PREIMPORT_CODE[language].format(modules=', '.join("'{}'".format(m) for m in modules))
+
+
+@lru_cache(maxsize=None)
+def _load(path: str) -> KernelProfile:
+    return KernelProfile.load(path)
+
+
+def default_profile() -> KernelProfile:
+    """
+    Profile from ``KNITTY_KERNEL_PROFILE`` file (empty if it's not set).
+    """
+    path = os.environ.get(PROFILE_ENV)
+    return _load(os.path.abspath(path)) if path else KernelProfile()
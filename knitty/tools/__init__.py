@@ -1 +1 @@
-from .tools import load_yaml, get, strict_str, KnittyError  # noqa
+from .tools import load_yaml, get, strict_str, panflute, KnittyError  # noqa
@@ -36,3 +36,17 @@ def get(maybe_dict, key: str, default=None):
 def strict_str(smth) -> str:
     """Converts not str objects to empty string"""
     return smth if smth and isinstance(smth, str) else ''
+
+
+def panflute():
+    """
+    Imports ``panflute`` with ``which`` patched by ``shutilwhich_cwdpatch``
+    (the patch is applied on the first call, not at Knitty import time).
+    """
+    import shutilwhich_cwdpatch.patch  # noqa
+    from shutilwhich_cwdpatch import which
+    import panflute as pf
+    if not hasattr(pf.tools, 'which'):
+        raise KnittyError('panflute patch failed')
+    pf.tools.which = which
+    return pf
@@ -0,0 +1,200 @@
+"""
+Watch mode: re-renders the document on save. Kernels are kept alive
+between renders and only changed chunks (and chunks that depend on them)
+are executed again, outputs of the rest are reused.
+"""
+import os
+import os.path as p
+import json
+import time
+import traceback
+from typing import List, Tuple, Union
+
+import click
+
+from .pandoc_filter_arg import pandoc_filter_arg
+from .pipeline import read_markdown
+from .knitty import data_dir_name
+from .stitch.stitch import Stitch
+from .stitch.cache import MemoryCache
+from .stitch.pool import shutdown
+
+
+class WatchSession:
+    """
+    Runs pre-knitty → Pandoc → Knitty → Pandoc pipeline in-process.
+    Kernels and outputs of the previous render are kept like in a notebook:
+    state of the deleted chunks stays in the kernel.
+
+    Parameters
+    ----------
+    input_file : str
+    output : str
+    read : str
+        Pandoc reader format
+    to : str
+        Pandoc writer format
+    yaml_meta : str
+        path of yaml metadata file for pre-knitty and Pandoc
+    standalone : bool
+    self_contained : bool
+    pandoc_extra_args : list of str
+        Pandoc writer args
+    incremental : bool
+        default for ``incremental`` document option
+    """
+    def __init__(self, input_file: str, output: str, read: str="markdown", to: str=None,
+                 yaml_meta: str=None, standalone: bool=False, self_contained: bool=False,
+                 pandoc_extra_args: list=None, incremental: bool=True):
+        self.input_file = input_file
+        self.output = output
+        self.read = read
+        self.yaml_meta = yaml_meta
+        self.standalone = standalone
+        self.self_contained = self_contained
+        self.incremental = incremental
+        self.pandoc_extra_args = list(pandoc_extra_args) if pandoc_extra_args else []
+        if standalone:
+            self.pandoc_extra_args.append('--standalone')
+        if self_contained:
+            self.pandoc_extra_args.append('--self-contained')
+        self.writer_args = (['-t', to] if to else []) + self.pandoc_extra_args
+        self.filter_to = pandoc_filter_arg(output, to)
+        self.name = data_dir_name(self.filter_to, input_file, output)
+        self.kernels = {}
+        self.cache = MemoryCache(Stitch.name_cache_dir(self.name))
+
+    @property
+    def sources(self) -> List[str]:
+        return [self.input_file] + ([self.yaml_meta] if self.yaml_meta else [])
+
+    def markdown(self) -> str:
+        """
+        Source after pre-knitty (with yaml metadata prepended).
+        """
+        return read_markdown(self.input_file, self.yaml_meta)
+
+    def render(self) -> str:
+        """
+        Render the document to ``output``.
+
+        Returns
+        -------
+        stats : str
+            cache stats (reused and executed chunks)
+        """
+        from .tools import panflute
+
+        pf = panflute()
+        ast = json.loads(pf.run_pandoc(self.markdown(), ['-f', self.read, '-t', 'json']))
+        stitcher = Stitch(name=self.name, filter_to=self.filter_to, standalone=self.standalone,
+                          self_contained=self.self_contained, pandoc_format=self.read,
+                          pandoc_extra_args=self.pandoc_extra_args, warm_kernels=self.kernels)
+        stitcher.incremental = self.incremental
+        stitcher.cache = self.cache
+        self.cache.next_render()
+        ok = False
+        try:
+            out = json.dumps(stitcher.stitch_ast(ast))
+            ok = True
+        finally:
+            self.cache.finish_render(ok)
+        pf.run_pandoc(out, ['-f', 'json'] + self.writer_args + ['-o', self.output])
+        return '{} reused, {} executed'.format(self.cache.hits, self.cache.misses)
+
+    def shutdown(self):
+        for kp in self.kernels.values():
+            shutdown(kp)
+        self.kernels.clear()
+
+
+def stamp(paths: List[str]) -> Tuple[Union[Tuple[int, int], None], ...]:
+    """
+    Modification time and size of the files (``None`` if file is missing).
+    """
+    def stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    return tuple(stat(path) for path in paths)
+
+
+def wait_for_change(paths: List[str], last: tuple, interval: float=0.1, debounce: float=0.3) -> tuple:
+    """
+    Wait until files change and then stay unchanged for ``debounce`` seconds.
+
+    Returns
+    -------
+    stamp : tuple
+        new ``stamp(paths)``
+    """
+    current = stamp(paths)
+    while current == last:
+        time.sleep(interval)
+        current = stamp(paths)
+    while True:
+        time.sleep(debounce)
+        settled = stamp(paths)
+        if settled == current and None not in settled:
+            return settled
+        current = settled
+
+
+@click.command(
+    context_settings=dict(ignore_unknown_options=True,
+                          allow_extra_args=True),
+    help=("Watch INPUT_FILE and re-render it on save (pre-knitty → pandoc → knitty → pandoc). "
+          "Kernels are kept alive between renders, only changed chunks and chunks that depend on them "
+          "are executed again. Extra args are passed to Pandoc writer and to Knitty.")
+)
+@click.pass_context
+@click.argument('input_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output', type=str, required=True,
+              help='Pandoc writer option. Output file.')
+@click.option('-y', '--yaml', 'yaml_meta', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='yaml metadata file for pre-knitty and Pandoc (also watched).')
+@click.option('-f', '-r', '--from', '--read', 'read', type=str, default="markdown",
+              help='Pandoc reader option. Specify input format.')
+@click.option('-w', '-t', '--write', '--to', 'to', type=str, default=None,
+              help="Pandoc writer option. Specify output format.")
+@click.option('--standalone', is_flag=True, default=False,
+              help='Pandoc writer option. Produce a standalone document instead of fragment.')
+@click.option('--self-contained', is_flag=True, default=False,
+              help='Pandoc writer option. Store resources like images inside document instead of external files.')
+@click.option('--debounce', type=float, default=0.3,
+              help='Seconds the files should stay unchanged before render.')
+@click.option('--no-incremental', 'no_incremental', is_flag=True, default=False,
+              help="Execute all chunks after the first changed one (if not set in the document metadata).")
+@click.option('--once', is_flag=True, default=False,
+              help='Render once and exit.')
+def main(ctx, input_file, output, yaml_meta, read, to, standalone, self_contained, debounce,
+         no_incremental, once):
+    session = WatchSession(input_file, output, read=read, to=to, yaml_meta=yaml_meta,
+                           standalone=standalone, self_contained=self_contained,
+                           pandoc_extra_args=ctx.args, incremental=not no_incremental)
+    last = stamp(session.sources)
+    try:
+        while True:
+            start = time.time()
+            # noinspection PyBroadException
+            try:
+                stats = session.render()
+                status = 'rendered {} in {:.2f}s ({})'.format(output, time.time() - start, stats)
+            except Exception:
+                traceback.print_exc()
+                status = 'render failed in {:.2f}s'.format(time.time() - start)
+            click.echo('[{}] {}'.format(time.strftime('%H:%M:%S'), status), err=True)
+            if once:
+                break
+            last = wait_for_change(session.sources, last, debounce=debounce)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -40,7 +40,7 @@ setup(
     keywords='atom hydrogen jupyter pandoc markdown report',
     packages=find_packages(exclude=['docs', 'tests']),
 
-    install_requires=['jupyter_core', 'traitlets', 'ipython', 'jupyter_client', 'ipykernel',
+    install_requires=['jupyter_core', 'traitlets', 'ipython', 'jupyter_client>=6.1', 'ipykernel',
                       'nbconvert>=5.4.1', 'pandocfilters', 'py-pandoc>=2.6',
                       'click', 'psutil', 'panflute>=1.11.2', 'shutilwhich-cwdpatch>=0.1.0',
                       'pyyaml'],
@@ -48,6 +48,7 @@ setup(
     python_requires='>=3.6',
     extras_require={
         'dev': ['pytest', 'pytest-cov', 'pandas', 'matplotlib', 'sphinx', 'sphinx_rtd_theme', 'ghp-import'],
+        'fast': ['orjson'],
     },
     # test: pytest pytest-cov pandas matplotlib
     # docs: sphinx sphinx_rtd_theme ghp-import
@@ -58,6 +59,11 @@ setup(
             'knitty=knitty.knitty:main',
             'pre-knitty=knitty.pre_knitty:main',
             'pandoc-filter-arg=knitty.pandoc_filter_arg.cli:cli',
+            'knitty-daemon=knitty.daemon:cli',
+            'knitty-watch=knitty.watch:main',
+            'knitty-batch=knitty.batch:main',
+            'knitty-build=knitty.build:main',
+            'knitty-render=knitty.pipeline:main',
         ],
     },
 )
@@ -0,0 +1,107 @@
+import re
+import json
+from textwrap import dedent
+
+import pytest
+from click.testing import CliRunner
+
+from knitty import batch as B
+from knitty.tools import KnittyError
+
+
+DOC = dedent('''\
+```python
+print('{}: {}'.format(customer, n))
+```
+
+```{.python session=other}
+print(customer)
+```
+''')
+
+
+def outputs(path) -> list:
+    return re.findall(r'<pre><code>(.*?)</code></pre>', path.read(), re.S)
+
+
+class TestParams:
+
+    def test_read(self, tmpdir):
+        path = tmpdir.join('params.csv')
+        path.write('customer,n\nacme,1\n"b, c",2\n')
+        assert B.read_params(str(path)) == [{'customer': 'acme', 'n': '1'}, {'customer': 'b, c', 'n': '2'}]
+        path = tmpdir.join('params.jsonl')
+        path.write('{"customer": "acme", "n": 1}\n\n{"customer": "b", "n": [2, null]}\n')
+        assert B.read_params(str(path)) == [{'customer': 'acme', 'n': 1}, {'customer': 'b', 'n': [2, None]}]
+
+    @pytest.mark.parametrize('name, text', [
+        ('params.txt', 'a\n1\n'),
+        ('params.csv', 'class\n1\n'),
+        ('params.jsonl', '{"a b": 1}\n'),
+        ('params.jsonl', '[1]\n'),
+    ])
+    def test_invalid(self, tmpdir, name, text):
+        path = tmpdir.join(name)
+        path.write(text)
+        with pytest.raises(KnittyError):
+            B.read_params(str(path))
+
+    def test_r_literal(self):
+        literal = B.r_literal({'a': [1, 2.5, True, None], 'b': 'x"\n'})
+        assert literal == 'list(`a` = list(1, 2.5, TRUE, NULL), `b` = "x\\"\\n")'
+
+    def test_parameter_blocks(self):
+        ast = {'meta': {}, 'blocks': [
+            {'t': 'CodeBlock', 'c': [['', ['python'], []], 'x']},
+            {'t': 'CodeBlock', 'c': [['', ['python'], [['session', 'a']]], 'x']},
+            {'t': 'CodeBlock', 'c': [['', ['python'], [['session', 'a']]], 'x']},
+            {'t': 'CodeBlock', 'c': [['', ['python'], [['eval', 'False']]], 'x']},
+            {'t': 'CodeBlock', 'c': [['', ['nokernel'], []], 'x']},
+            {'t': 'Para', 'c': []},
+        ]}
+        blocks = B.parameter_blocks(ast, {'a': 'x', 'b': [1]})
+        assert [b['c'][0] for b in blocks] == [
+            ['', ['python', 'knitty_params_0'], [['echo', 'False'], ['results', 'hide']]],
+            ['', ['python', 'knitty_params_1'], [['echo', 'False'], ['results', 'hide'], ['session', 'a']]]]
+        assert blocks[0]['c'][1] == "a = 'x'\nb = [1]"
+
+    def test_output_path(self):
+        assert B.output_path('out/{customer}-{index}.html', 3, {'customer': 'acme'}) == 'out/acme-3.html'
+        with pytest.raises(KnittyError):
+            B.output_path('{name}.html', 0, {'customer': 'acme'})
+
+
+class TestBatch:
+
+    def test_batch(self, tmpdir):
+        tmpdir.join('doc.md').write(DOC)
+        tmpdir.join('params.csv').write('customer,n\nacme,1\nglobex,2\ninitech,3\n')
+        with tmpdir.as_cwd():
+            result = CliRunner().invoke(B.main, ['doc.md', 'params.csv', '-o', 'out/{customer}.html', '-j', '2',
+                                                 '--summary', 'summary.json', '--no-cache'])
+            assert result.exit_code == 0, result.output
+            for customer, n in [('acme', 1), ('globex', 2), ('initech', 3)]:
+                assert outputs(tmpdir.join('out', customer + '.html')) == [
+                    '{}: {}\n'.format(customer, n), customer + '\n']
+            statuses = json.loads(tmpdir.join('summary.json').read())
+            assert [(s['index'], s['ok']) for s in statuses] == [(0, True), (1, True), (2, True)]
+            assert 'rendered 3 of 3' in result.output
+
+    def test_failed(self, tmpdir):
+        tmpdir.join('doc.md').write(DOC)
+        tmpdir.join('params.jsonl').write('{"customer": "acme", "n": 1, "out": "acme.html"}\n'
+                                          '{"customer": "globex", "n": 2, "out": "doc.md/globex.html"}\n')
+        with tmpdir.as_cwd():
+            result = CliRunner().invoke(B.main, ['doc.md', 'params.jsonl', '-o', '{out}', '-j', '1'])
+        assert result.exit_code == 1
+        assert 'FAILED doc.md/globex.html' in result.output
+        assert 'rendered 1 of 2' in result.output and '1 failed' in result.output
+        assert outputs(tmpdir.join('acme.html')) == ['acme: 1\n', 'acme\n']
+
+    def test_same_names(self, tmpdir):
+        tmpdir.join('doc.md').write(DOC)
+        tmpdir.join('params.csv').write('customer,n\nacme,1\nacme,2\n')
+        with tmpdir.as_cwd():
+            result = CliRunner().invoke(B.main, ['doc.md', 'params.csv', '-o', '{customer}.html'])
+        assert result.exit_code == 1
+        assert 'different names' in result.output
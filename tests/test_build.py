@@ -0,0 +1,109 @@
+import re
+import json
+import os.path as p
+from textwrap import dedent
+
+import pytest
+from click.testing import CliRunner
+
+from knitty import build as B
+
+
+def outputs(path) -> list:
+    return re.findall(r'<pre><code>(.*?)</code></pre>', path.read(), re.S)
+
+
+@pytest.fixture
+def project(tmpdir):
+    tmpdir.join('a.md').write('```python\nimport os\nprint(os.path.basename(os.getcwd()))\n```\n')
+    tmpdir.mkdir('sub').join('b.md').write('```python\nprint(1 + 1)\n```\n')
+    tmpdir.join('sub', 'c.py').write(dedent('''\
+        # %% {md}
+        """
+        Text
+        """
+        # %% {python}
+        print('c')
+        '''))
+    tmpdir.join('sub', 'script.py').write("print('not a document')\n")
+    tmpdir.mkdir('.hidden').join('d.md').write('text\n')
+    tmpdir.mkdir('a_html_files').join('e.md').write('text\n')
+    return tmpdir
+
+
+class TestDiscover:
+
+    def test_discover(self, project):
+        docs = B.discover(str(project), 'html')
+        assert [p.relpath(doc.source, str(project)) for doc in docs] == ['a.md', p.join('sub', 'b.md'),
+                                                                         p.join('sub', 'c.py')]
+        assert docs[0].output == str(project.join('a.html'))
+        assert B.discover(str(project.join('sub')), 'md') == [
+            B.Document(str(project.join('sub', 'c.py')), str(project.join('sub', 'c.md')))]
+
+    def test_skipped(self, project):
+        project.join('sub', 'late.py').write("print('cells are detected on the first line')\n# %%\nx = 1\n")
+        venv = project.mkdir('venv')
+        venv.join('pyvenv.cfg').write('home = /usr/bin\n')
+        venv.join('f.md').write('text\n')
+        project.mkdir('build').join('g.md').write('text\n')
+        project.mkdir('drafts').join('h.md').write('text\n')
+        docs = B.discover(str(project), 'html', exclude=['build', 'drafts/*'])
+        assert [p.relpath(doc.source, str(project)) for doc in docs] == ['a.md', p.join('sub', 'b.md'),
+                                                                         p.join('sub', 'c.py')]
+        assert len(B.discover(str(project), 'html')) == 5  # + build/g.md, drafts/h.md
+        assert len(B.discover(str(project), 'html', exclude=['*.md'])) == 1
+
+    def test_fingerprint(self, project):
+        doc = B.discover(str(project), 'html')[0]
+        assert B.fingerprint(doc, None, ['html']) == B.fingerprint(doc, None, ['html'])
+        assert B.fingerprint(doc, None, ['html']) != B.fingerprint(doc, None, ['tex'])
+
+    def test_admission(self):
+        admission = B.Admission(max_kernels=2)
+        assert admission.admits(3)  # nothing is running
+        admission.enter(1)
+        assert admission.admits(1) and not admission.admits(2)
+        admission.enter(1)
+        admission.leave(1)
+        assert admission.admits(1) and not admission.admits(2)
+
+
+class TestBuild:
+
+    def test_build(self, project):
+        result = CliRunner().invoke(B.main, [str(project), '-j', '2', '-k', '1', '--summary',
+                                             str(project.join('summary.json'))])
+        assert result.exit_code == 0, result.output
+        assert outputs(project.join('a.html')) == [project.basename + '\n']  # kernel works in the doc dir
+        assert outputs(project.join('sub', 'b.html')) == ['2\n']
+        assert outputs(project.join('sub', 'c.html')) == ['c\n']
+        statuses = json.loads(project.join('summary.json').read())
+        assert [(s['source'], s['ok'], s['kernels']) for s in statuses] == [
+            ('a.md', True, 1), (p.join('sub', 'b.md'), True, 1), (p.join('sub', 'c.py'), True, 1)]
+        assert 'rendered 3 of 3' in result.output and '0 up to date' in result.output
+
+        project.join('sub', 'b.md').write('```python\nprint(2 + 2)\n```\n')
+        result = CliRunner().invoke(B.main, [str(project)])
+        assert result.exit_code == 0, result.output
+        assert 'rendered 1 of 1' in result.output and '2 up to date' in result.output
+        assert outputs(project.join('sub', 'b.html')) == ['4\n']
+
+        result = CliRunner().invoke(B.main, [str(project), '--force'])
+        assert 'rendered 3 of 3' in result.output
+
+    def test_failed(self, project):
+        project.join('sub', 'b.md').write('```{.python session="a b"}\nprint(1)\n```\n')
+        result = CliRunner().invoke(B.main, [str(project), '-j', '1'])
+        assert result.exit_code == 1
+        assert 'FAILED {}'.format(p.join('sub', 'b.html')) in result.output
+        assert 'rendered 2 of 3' in result.output and '1 failed' in result.output
+        # failed documents are rendered next time:
+        result = CliRunner().invoke(B.main, [str(project), '-j', '1'])
+        assert 'rendered 0 of 1' in result.output and '2 up to date' in result.output
+
+    def test_same_names(self, project):
+        project.join('sub', 'b.py').write('# %%\nprint(1)\n')
+        result = CliRunner().invoke(B.main, [str(project)])
+        assert result.exit_code == 1
+        assert 'different names' in result.output
@@ -0,0 +1,119 @@
+import os
+import os.path as p
+import json
+import socket
+import tempfile
+import threading
+from textwrap import dedent
+
+import pytest
+import panflute as pf
+
+from knitty.api import knitty_preprosess
+import knitty.stitch.stitch as R
+from knitty.stitch.pool import KernelPool
+from knitty import daemon as D
+from knitty.tools import KnittyError
+
+
+def pre_stitch_json(source: str) -> str:
+    return pf.convert_text(knitty_preprosess(source), input_format='markdown', output_format='json')
+
+
+@pytest.fixture
+def pool():
+    pool = KernelPool()
+    yield pool
+    pool.shutdown()
+
+
+class TestKernelPool:
+
+    def test_reset(self, pool):
+        kp = pool.acquire('python')
+        R.run_code('x = 1', kp)
+        pool.release(kp)
+        assert pool.acquire('python') is kp
+        messages = R.run_code("print('x' in globals())", kp)
+        assert messages[-1]['content']['text'] == 'False\n'
+
+    def test_recycle(self, pool):
+        pool.max_documents = 1
+        kp = pool.acquire('python')
+        pool.release(kp)
+        kp2 = pool.acquire('python')
+        assert kp2 is not kp
+        assert not kp.km.is_alive()
+
+
+class TestDaemon:
+
+    def test_filter(self, pool, tmpdir):
+        path = p.join(str(tmpdir), 'knitty.sock')
+        server = D.KnittyDaemon(path, pool)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            assert D.request(dict(cmd='status'), path)['busy'] == 0
+            code = dedent('''\
+            ```{python}
+            print(21 * 2)
+            ```
+            ''')
+            with tmpdir.as_cwd():
+                out = D.daemon_pandoc_filter(pre_stitch_json(code), path, name='foo', filter_to='html')
+            blocks = json.loads(out)['blocks']
+            assert blocks[-1]['c'][1][0]['c'][1] == '42\n'
+            assert pool.status()['idle'] == {'python': 1}
+        finally:
+            D.request(dict(cmd='stop'), path)
+            thread.join()
+            server.server_close()
+        assert D.request(dict(cmd='status'), path) is None
+
+    def test_untrusted(self, pool, tmpdir, monkeypatch):
+        path = p.join(str(tmpdir), 'knitty.sock')
+        server = D.KnittyDaemon(path, pool)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            monkeypatch.setattr(D, 'peer_uid', lambda sock, path_: os.getuid() + 1)
+            with pytest.raises(KnittyError):
+                D.request(dict(cmd='status'), path)
+            assert D.daemon_pandoc_filter(pre_stitch_json('Text'), path, name='foo', filter_to='html') is None
+            monkeypatch.undo()
+        finally:
+            D.request(dict(cmd='stop'), path)
+            thread.join()
+            server.server_close()
+
+    def test_died(self, tmpdir):
+        path = p.join(str(tmpdir), 'knitty.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+
+        def die():
+            conn, _ = listener.accept()
+            D.recv_msg(conn)
+            conn.close()
+
+        thread = threading.Thread(target=die)
+        thread.start()
+        try:
+            assert D.daemon_pandoc_filter(pre_stitch_json('Text'), path, name='foo', filter_to='html') is None
+        finally:
+            thread.join()
+            listener.close()
+
+
+def test_private_dir(tmpdir, monkeypatch):
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.delenv(D.SOCKET_ENV, raising=False)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    path = D.default_socket_path()
+    assert p.dirname(path) == p.join(str(tmpdir), 'knitty-{}'.format(os.getuid()))
+    assert os.stat(p.dirname(path)).st_mode & 0o777 == 0o700
+    os.chmod(p.dirname(path), 0o777)
+    with pytest.raises(KnittyError):
+        D.default_socket_path()
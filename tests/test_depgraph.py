@@ -0,0 +1,84 @@
+"""
+Static def-use analysis of Python chunks.
+"""
+import pytest
+
+from knitty.stitch.depgraph import DefUseGraph, chunk_names, is_python_kernel
+
+
+@pytest.mark.parametrize('code, defines, uses', [
+    ('x = 1', {'x'}, set()),
+    ('y = x + 1\nprint(y)', {'y'}, {'x', 'y', 'print'}),
+    ('x += 1', {'x'}, {'x'}),
+    ('import numpy as np\nimport os.path', {'np', 'os'}, set()),
+    ('df.dropna(inplace=True)', {'df'}, {'df'}),
+    ('a[0].b = c', {'a'}, {'a', 'c'}),
+    ('[i * k for i in range(n)]', set(), {'k', 'n', 'range'}),
+    ('for _ in range(3):\n    pass', {'_'}, {'range'}),
+    ('try:\n    pass\nexcept E as e:\n    pass', {'e'}, {'E'}),
+    ('def f(a=d):\n    return a + g', {'f'}, {'d'}),
+    ('class A(B):\n    z = w', {'A'}, {'B', 'w'}),
+])
+def test_chunk_names(code, defines, uses):
+    names = chunk_names(code)
+    assert names.defines == defines
+    assert names.uses == uses
+
+
+@pytest.mark.parametrize('code', [
+    '%matplotlib inline',
+    '!ls',
+    'from m import *',
+    'print(_)',
+    'exec("x = 1")',
+    'globals()["x"] = 1',
+    'def (',
+])
+def test_barrier(code):
+    assert chunk_names(code) is None
+
+
+def test_graph():
+    graph = DefUseGraph('python')
+    nodes = [graph.add(code, {}) for code in [
+        'a = 1',
+        'b = 2',
+        'def f():\n    global c\n    c = a',
+        'f()',
+        'print(b, c)',
+        '%time x = 1',
+        'print(a)',
+    ]]
+    assert graph.parents == [set(), set(), set(), {0, 2}, {1, 3}, set(range(5)), {5}]
+    assert graph.ancestors(nodes[4]) == {0, 1, 2, 3}
+    assert graph.add('a = 1', {}, barrier=True) == 7
+    assert graph.parents[7] == set(range(7))
+
+
+def test_restore():
+    graph = DefUseGraph('python')
+    for code in ['x = 1', 'y = x', 'x = 7', 'print(y)', 'z = x', 'x = 8', 'print(z)']:
+        graph.add(code, {})
+    # 0 and 1 are cached, 2 is executed, replayed 0 overwrites x of 2:
+    graph.run(2)
+    assert graph.restore(3, {0, 1}) == [0, 1, 2]
+    assert graph.state == {'x': 2, 'y': 1}
+    # 4 is cached, 5 is executed, replayed 4 needs x of 2 (anti-dependency):
+    graph.run(5)
+    assert graph.restore(6, {4}) == [2, 4, 5]
+    assert graph.state == {'x': 5, 'y': 1, 'z': 4}
+
+
+def test_keys():
+    codes = ['a = 1', 'b = 2', 'print(a)']
+    graph = DefUseGraph('python')
+    keys = [graph.keys[graph.add(code, {})] for code in codes]
+    graph = DefUseGraph('python')
+    new_keys = [graph.keys[graph.add(code, {})] for code in ['a = 1', 'b = 3', 'print(a)']]
+    assert [k == n for k, n in zip(keys, new_keys)] == [True, False, True]
+
+
+def test_is_python_kernel():
+    assert is_python_kernel('python')
+    assert is_python_kernel('python3')
+    assert not is_python_kernel('ir')
@@ -0,0 +1,120 @@
+"""
+Conformance of the in-process markdown fast path with Pandoc.
+"""
+import json
+
+import pytest
+import panflute as pf
+
+from knitty.stitch.fastmd import fast_tokenize
+
+if hasattr(pf.tools, 'which'):
+    from shutilwhich_cwdpatch import which
+    pf.tools.which = which
+else:
+    from knitty.tools import KnittyError
+    raise KnittyError('panflute patch failed')
+
+
+def pandoc(source: str) -> dict:
+    return json.loads(pf.convert_text(source, input_format='markdown', output_format='json', standalone=True))
+
+
+SUPPORTED = [
+    '',
+    'Hello',
+    'Hello world, 12 (x)!\nnext line: 1.5 + 2/3 = 100%',
+    'a  b   c',
+    'a\n\n\nb',
+    'Привет, мир',
+    '1.5 is not a list',
+    'a - b',
+    'well-known',
+    '- a b\n- c',
+    '* a\n* b',
+    '+ one',
+    '- a\n- b\n\nfoo',
+    'x\n\n- a\n- b',
+    '| a | b |\n|---|---|\n| 1 | 2 |',
+    '| a | b |\n|:--|--:|\n| 1 | |\n',
+    '|   |   |\n|---|---|\n| 1 | 2 |',
+    '| a |   |\n|---|---|\n|   | 2 |',
+    'a | b\n---|:-:\n1 | 2\n3 | 4',
+    '| x | y | z |\n|:-:|---|:--|\n| 1 | 2 | 3 |\n\nTotal: 3',
+    '\n'.join(['| n | square |', '|--:|--:|'] + ['| {} | {} |'.format(i, i * i) for i in range(20)]),
+    'Table: not a caption\n\nText',
+    '| a | b |\n|---|---|\n| 1 | 2 |\n\nText\n\nTable: too far',
+]
+
+UNSUPPORTED = [
+    '*emph*',
+    '# Header',
+    'Header\n======',
+    "it's",
+    '"quoted"',
+    'a -- b',
+    'wait...',
+    'e.g. this',
+    'x  \ny',
+    ' lead',
+    '\tcode',
+    '    code',
+    '1. one',
+    '2) two',
+    'A.  x',
+    '(1) x',
+    '- a\n\n- b',
+    '- a\n\n* b',
+    '- +',
+    'x\n- not a list',
+    '- a\n  continued',
+    '> quote',
+    'term\n:   definition',
+    '`code`',
+    '$x$',
+    '<b>x</b>',
+    'a & b',
+    '[link](url)',
+    '@cite',
+    'H~2~O',
+    'x^2^',
+    'a | b',
+    '| a | b |\n|---|---|\n| 1 |',
+    '| a | b |\n|---|---|\n| {} | 2 |'.format('x' * 80),
+    '---',
+    'a\\b',
+    '| a | b |\n|---|---|\n| 1 | 2 |\n\nTable: caption',
+    'Table: caption\n\n| a | b |\n|---|---|\n| 1 | 2 |',
+    '| a | b |\n|---|---|\n| 1 | 2 |\n\ntable: caption',
+    '| a | b |\n|---|---|\n| 1 | 2 |\n\nTable:caption',
+    '| a | b |\n|---|---|\n| 1 | 2 |\n\n: caption',
+    ': caption\n\n| a | b |\n|---|---|\n| 1 | 2 |',
+]
+
+
+@pytest.mark.parametrize('source', SUPPORTED)
+def test_conformance(source):
+    expected = pandoc(source)
+    result = fast_tokenize(source, api_version=expected['pandoc-api-version'])
+    assert result is not None
+    assert result == expected['blocks']
+
+
+@pytest.mark.parametrize('source', UNSUPPORTED)
+def test_fallback(source):
+    assert fast_tokenize(source, api_version=(1, 23)) is None
+
+
+@pytest.mark.parametrize('fmt, args, api', [
+    ('gfm', None, (1, 23)),
+    ('markdown-smart', None, (1, 23)),
+    ('markdown', ['--columns=20'], (1, 23)),
+    ('markdown', ['--filter', 'foo'], (1, 23)),
+])
+def test_options_fallback(fmt, args, api):
+    assert fast_tokenize('a', fmt, args, api) is None
+
+
+def test_old_api_tables():
+    assert fast_tokenize('| a |\n|---|\n| 1 |', api_version=(1, 17)) is None
+    assert fast_tokenize('- a', api_version=(1, 17)) is not None
@@ -0,0 +1,77 @@
+import os
+import json
+import os.path as p
+import importlib
+
+import pytest
+from shutilwhich_cwdpatch import which
+
+from knitty.pandoc_filter_arg import pandoc_filter_arg, resolve_filter_arg
+
+# ``knitty.pandoc_filter_arg.cli`` attribute is the click command:
+C = importlib.import_module('knitty.pandoc_filter_arg.cli')
+
+
+def probe(output, to):
+    return C.probe_filter_arg(which('pandoc'), which('panfl'), output, to)
+
+
+@pytest.fixture
+def cache_path(tmpdir, monkeypatch):
+    path = str(tmpdir.join('filter-arg.json'))
+    monkeypatch.setenv(C.CACHE_ENV, path)
+    return path
+
+
+class TestResolve:
+
+    @pytest.mark.parametrize('output, to', [(None, None), ('-', None), (None, 'html5'), (None, 'gfm+smart'),
+                                            ('doc.pdf', 'beamer'), ('doc.html', 'latex-smart+raw_tex')] +
+                             [('doc.' + ext, None) for ext in sorted(C.EXT_WRITERS)] + [('DOC.HTML', None)])
+    def test_same_as_pandoc(self, output, to):
+        assert resolve_filter_arg(output, to) == probe(output, to)
+
+    @pytest.mark.parametrize('output, to', [('doc.unknown', None), (None, 'writer.lua'), (None, 'HTML')])
+    def test_unknown(self, output, to):
+        assert resolve_filter_arg(output, to) is None
+
+
+class TestCache:
+
+    def test_cache(self, cache_path, monkeypatch):
+        expected = probe('doc.txt', None)
+        assert pandoc_filter_arg('doc.txt') == expected
+        assert pandoc_filter_arg('doc.html') == 'html'  # resolved, not cached
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        assert len(cache) == 1 and json.loads(next(iter(cache)))[3:] == [None, '.txt']
+
+        def fail(*args):
+            raise AssertionError('probed')
+
+        monkeypatch.setattr(C, 'probe_filter_arg', fail)
+        assert pandoc_filter_arg('other.TXT') == expected
+        with pytest.raises(AssertionError):
+            pandoc_filter_arg('doc.rtf')
+
+    def test_other_user(self, cache_path, monkeypatch):
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump({'key': 'value'}, f)
+        assert C.load_cache(cache_path) == {'key': 'value'}
+        uid = os.getuid()
+        monkeypatch.setattr(C.os, 'getuid', lambda: uid + 1)
+        assert C.load_cache(cache_path) == {}
+
+    def test_default_path(self, tmpdir, monkeypatch):
+        monkeypatch.delenv(C.CACHE_ENV, raising=False)
+        monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+        path = C.default_cache_path()
+        assert path == p.join(str(tmpdir), 'knitty', 'filter-arg.json')
+        C.save_cache(path, 'key', 'value')
+        assert C.load_cache(path) == {'key': 'value'}
+
+    def test_broken_cache(self, cache_path):
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            f.write('[1, 2')
+        assert pandoc_filter_arg('doc.rtf') == probe('doc.rtf', None)
+        assert len(C.load_cache(cache_path)) == 1
@@ -0,0 +1,122 @@
+import time
+
+import psutil
+import pytest
+
+import knitty.stitch.stitch as R
+from knitty.stitch.warmup import KernelProfile
+from knitty.stitch.fork import fork_supported, shutdown_fork_servers
+from knitty.stitch.pool import KernelPool, kernel_rss, shutdown
+from knitty.tools import KnittyError
+
+CHECK = "import sys, os; print('fractions' in sys.modules, 'fractions' in dir(), os.getcwd())"
+
+
+def printed(messages) -> str:
+    return ''.join(m['content']['text'] for m in messages if m['msg_type'] == 'stream')
+
+
+def wait_exit(pid: int, timeout: float=10) -> bool:
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            if psutil.Process(pid).status() == psutil.STATUS_ZOMBIE:
+                time.sleep(0.05)
+                continue
+        except psutil.NoSuchProcess:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture
+def profile():
+    yield KernelProfile({'python': {'preimport': ['fractions'], 'fork': True}})
+    shutdown_fork_servers()
+
+
+class TestKernelProfile:
+
+    @pytest.mark.parametrize('kernels', [
+        ['python'],
+        {'python': ['numpy']},
+        {'python': {'preimport': 'numpy'}},
+        {'python': {'preimport': ['numpy; import os']}},
+        {'python': {'fork': 'yes'}},
+        {'python': {'forks': True}},
+    ])
+    def test_invalid(self, kernels):
+        with pytest.raises(KnittyError):
+            KernelProfile(kernels)
+
+    def test_load(self, tmpdir):
+        path = tmpdir.join('profile.yml')
+        path.write('python:\n  preimport: [numpy, matplotlib.pyplot]\n  fork: true\n')
+        profile = KernelProfile.load(str(path))
+        assert profile.preimport('python') == ['numpy', 'matplotlib.pyplot']
+        assert profile.fork('python')
+        assert profile.preimport('ir') == [] and not profile.fork('ir')
+
+    def test_preimport_code(self):
+        profile = KernelProfile({'python': {'preimport': ['fractions']}, 'foo': {'preimport': ['bar']}})
+        assert "'fractions'" in profile.preimport_code('python')
+        assert profile.preimport_code('foo') == ''  # no such kernel
+        assert R.kernel_init_code('python', KernelProfile()) == R.PYTHON_INIT_CODE
+
+    def test_preimport(self, tmpdir):
+        profile = KernelProfile({'python': {'preimport': ['fractions']}})
+        kp = R.kernel_factory('python', profile=profile, cwd=str(tmpdir))
+        try:
+            R.initialize_kernel('python', kp, profile=profile)
+            # imported but the name is not bound:
+            assert printed(R.run_code(CHECK, kp)) == 'True False {}\n'.format(tmpdir)
+        finally:
+            shutdown(kp)
+
+
+@pytest.mark.skipif(not fork_supported(), reason='fork server is Linux only')
+class TestFork:
+
+    def test_fork(self, profile, tmpdir):
+        kp = R.kernel_factory('python', profile=profile, cwd=str(tmpdir))
+        pid = kp.km.forked_pid
+        try:
+            assert pid is not None and pid != kp.km.provisioner.pid
+            assert printed(R.run_code(CHECK, kp)) == 'True False {}\n'.format(tmpdir)
+            # interrupts are forwarded to the forked kernel:
+            msg_id = kp.kc.execute('import time; time.sleep(60)')
+            time.sleep(1)
+            kp.km.interrupt_kernel()
+            reply = kp.kc.get_shell_msg(timeout=10)
+            assert reply['parent_header']['msg_id'] == msg_id
+            assert reply['content']['ename'] == 'KeyboardInterrupt'
+        finally:
+            kp.kc.stop_channels()
+            kp.km.shutdown_kernel()
+        assert not kp.km.is_alive()
+        assert wait_exit(pid)
+
+    def test_kill(self, profile):
+        kp = R.kernel_factory('python', profile=profile)
+        pid = kp.km.forked_pid
+        kp2 = R.kernel_factory('python', profile=profile)
+        try:
+            assert kp2.km.forked_pid not in (None, pid)
+            shutdown(kp)  # proxy is killed
+            assert wait_exit(pid)
+            assert printed(R.run_code('print(42)', kp2)) == '42\n'
+        finally:
+            shutdown(kp2)
+
+    def test_pool(self, profile):
+        pool = KernelPool(profile=profile)
+        try:
+            kp = pool.acquire('python')
+            assert kernel_rss(kp.km) > 0
+            R.run_code('x = 1', kp)
+            pool.release(kp)
+            assert pool.acquire('python') is kp
+            assert printed(R.run_code("import sys; print('x' in globals(), 'fractions' in sys.modules)", kp)) == (
+                'False True\n')
+        finally:
+            pool.shutdown()
@@ -0,0 +1,18 @@
+"""
+CLI entry points don't import heavy modules at startup.
+"""
+import sys
+import subprocess
+
+import pytest
+
+HEAVY = ['jupyter_client', 'nbconvert', 'IPython', 'zmq', 'psutil', 'panflute']
+
+
+@pytest.mark.parametrize('module', ['knitty.knitty', 'knitty.pre_knitty', 'knitty.pandoc_filter_arg.cli',
+                                    'knitty.daemon', 'knitty.api', 'knitty.batch',
+                                    'knitty.build', 'knitty.pipeline'])
+def test_lazy_imports(module):
+    code = 'import sys, {}; print(" ".join(m for m in {!r} if m in sys.modules))'.format(module, HEAVY)
+    out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    assert out.stdout.split() == []
@@ -0,0 +1,46 @@
+"""
+JSON backends of the filter stdin/stdout path.
+"""
+import gc
+import json
+
+import pytest
+
+from knitty.json_backend import BACKENDS, get_backend
+from knitty.tools import KnittyError
+
+AST = {'pandoc-api-version': [1, 23, 1], 'meta': {},
+       'blocks': [{'t': 'Para', 'c': [{'t': 'Str', 'c': 'Привет'}, {'t': 'Space'}, {'t': 'Str', 'c': '"1"'}]},
+                  {'t': 'CodeBlock', 'c': [['', [], [['k', 'v']]], 'x\n\ty']}]}
+
+
+@pytest.mark.parametrize('name', sorted(BACKENDS))
+def test_roundtrip(name):
+    loads, dumps = get_backend(name)
+    out = dumps(AST)
+    assert isinstance(out, bytes)
+    assert b': ' not in out and b', ' not in out
+    assert loads(out) == loads(out.decode('utf-8')) == json.loads(out) == AST
+    assert gc.isenabled()
+
+
+@pytest.mark.parametrize('name', sorted(BACKENDS))
+def test_surrogates(name):
+    _, dumps = get_backend(name)
+    assert json.loads(dumps({'c': '\ud800'})) == {'c': '\ud800'}
+
+
+def test_unknown():
+    with pytest.raises(KnittyError):
+        get_backend('simdjson')
+
+
+def test_filter_types():
+    from knitty.ast_filter import knitty_pandoc_filter
+
+    kwargs = dict(name='foo', filter_to='html', standalone=False, self_contained=True,
+                  pandoc_format='markdown', pandoc_extra_args=[])
+    out = knitty_pandoc_filter(json.dumps(AST).encode('utf-8'), **kwargs)
+    assert isinstance(out, bytes) and json.loads(out) == AST
+    out = knitty_pandoc_filter(json.dumps(AST), **kwargs)
+    assert isinstance(out, str) and json.loads(out) == AST
@@ -0,0 +1,69 @@
+"""
+Incremental reading and writing of Pandoc JSON AST.
+"""
+import io
+import json
+
+import pytest
+import panflute as pf
+
+from knitty.json_stream import JSONStreamReader, PandocASTWriter, read_pandoc_ast
+from knitty.tools import KnittyError
+
+
+@pytest.fixture(scope='module')
+def ast():
+    source = '---\ntitle: T\n...\n\n# Header\n\nfoo *bar* 12345\n\n```{python}\nx = 1.25e3\n```\n\n- a\n- b\n'
+    return json.loads(pf.convert_text(source, input_format='markdown', output_format='json', standalone=True))
+
+
+def roundtrip(text: str, chunk_size: int) -> dict:
+    version, meta, blocks = read_pandoc_ast(io.StringIO(text), chunk_size=chunk_size)
+    out = io.StringIO()
+    writer = PandocASTWriter(out)
+    writer.start(version, meta)
+    for block in blocks:
+        writer.write(block)
+    writer.end()
+    return json.loads(out.getvalue())
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 2**16])
+def test_roundtrip(ast, chunk_size):
+    assert roundtrip(json.dumps(ast, indent=1), chunk_size) == ast
+
+
+@pytest.mark.parametrize('doc', [
+    {'blocks': [{'t': 'HorizontalRule'}], 'pandoc-api-version': [1, 23, 1], 'meta': {}},
+    {'pandoc-api-version': [1, 23, 1], 'meta': {}, 'blocks': []},
+    {'meta': {}, 'blocks': [], 'pandoc-api-version': [1, 23, 1]},
+])
+def test_key_order(doc):
+    assert roundtrip(json.dumps(doc), 2) == doc
+
+
+def test_lazy_blocks():
+    text = '{"pandoc-api-version":[1,23],"meta":{},"blocks":[{"t":"Null"},{"t":"Null"},'
+    version, meta, blocks = read_pandoc_ast(io.StringIO(text), chunk_size=4)
+    assert (version, meta) == ([1, 23], {})
+    assert next(blocks) == next(blocks) == {'t': 'Null'}
+    with pytest.raises(ValueError):
+        next(blocks)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('12345 ', [12345]),
+    ('12345', [12345]),
+    ('[1,2] -0.5e10 true null "ab\\"c"', [[1, 2], -0.5e10, True, None, 'ab"c']),
+])
+def test_values(text, expected):
+    reader = JSONStreamReader(io.StringIO(text), chunk_size=2)
+    assert [reader.value() for _ in expected] == expected
+    assert reader.peek() == ''
+
+
+def test_expect():
+    reader = JSONStreamReader(io.StringIO('  [1]'))
+    with pytest.raises(KnittyError):
+        reader.expect('{')
+    assert reader.expect('[') == '['
@@ -0,0 +1,145 @@
+import io
+import json
+from textwrap import dedent
+
+import pytest
+import nbformat
+import panflute as pf
+from click.testing import CliRunner
+
+from knitty import pipeline as P
+from knitty.api import knitty_preprosess
+from knitty.consts import PANDOC_CODECELL_CLASSES
+from knitty.tools import KnittyError
+import knitty.stitch.stitch as R
+import knitty.stitch.notebook as N
+
+BLOCKS = [
+    pf.CodeBlock('a'),
+    pf.CodeBlock('b', attributes={'input': 'True'}),
+    pf.CodeBlock('c', attributes={'input': 'TRUE'}, classes=['py', 'cell']),
+    pf.CodeBlock('d', attributes={'input': 'False'}),
+    pf.BlockQuote(pf.CodeBlock('e', classes=['code', 'cell'])),
+    pf.BulletList(pf.ListItem(pf.CodeBlock('f'))),
+    pf.Para(pf.Str('text')),
+]
+META = [
+    {},
+    {'input': pf.MetaBool(True)},
+    {'input': pf.MetaBool(False)},
+    {'input': pf.MetaString('true')},
+    {'input': pf.MetaInlines(pf.Emph(pf.Str('True')))},
+    {'input': pf.MetaBool(True), 'other': pf.MetaBlocks(pf.CodeBlock('g'))},
+]
+
+
+def action(elem, doc):
+    """
+    Panflute filter that was used before ``notebook.ipynb_ast``.
+    """
+    if elem.tag == 'CodeBlock':
+        input_ = elem.attributes.get('input', doc.get_metadata('input'))
+        if str(input_).lower() == 'true':
+            for clss in PANDOC_CODECELL_CLASSES:
+                if clss not in elem.classes:
+                    elem.classes.append(clss)
+
+
+def panflute_ipynb(doc: pf.Doc) -> dict:
+    """
+    Classes added by the panflute filter.
+    """
+    with io.StringIO() as f:
+        pf.dump(doc, f)
+        doc = pf.load(io.StringIO(f.getvalue()))
+    pf.run_filter(action, doc=doc)
+    return json.loads(json.dumps(doc.to_json()))
+
+
+def stitch_notebook(source: str, **kwargs) -> dict:
+    ast = json.loads(pf.convert_text(knitty_preprosess(source), input_format='markdown', output_format='json'))
+    return R.Stitch('foo', 'ipynb', **kwargs).stitch_notebook(ast)
+
+
+class TestCodeCellClasses:
+
+    @pytest.mark.parametrize('meta', META)
+    def test_same_as_panflute(self, meta):
+        doc = pf.Doc(*BLOCKS, metadata=meta)
+        ast = json.loads(json.dumps(doc.to_json()))
+        copy = json.loads(json.dumps(ast))
+        assert N.ipynb_ast(ast) == panflute_ipynb(doc)
+        assert ast == copy  # not changed in place
+
+    def test_stitch_ast(self):
+        ast = R.Stitch('foo', 'ipynb').stitch_ast(pf.Doc(pf.CodeBlock('x', attributes={'input': 'True'})).to_json())
+        assert ast['blocks'][0]['c'][0][1] == ['code', 'cell']
+
+
+class TestNotebook:
+
+    code = dedent('''\
+    # Title
+
+    Text *emph*.
+
+    ```{python}
+    from IPython.display import HTML, display
+    print('out')
+    display(HTML('<b>x</b>'))
+    1 + 1
+    ```
+
+    ```
+    not executed
+    ```
+
+    ```{python, echo=False}
+    print('hidden')
+    ```
+
+    ```{python, results='hide'}
+    print('no output')
+    ```
+    ''')
+
+    @pytest.mark.parametrize('async_depth', [0, 1])
+    def test_notebook(self, async_depth):
+        nb = stitch_notebook('---\nasync_depth: {}\n...\n'.format(async_depth) + self.code)
+        nbformat.validate(nbformat.from_dict(nb))
+        cells = nb['cells']
+        assert [cell['cell_type'] for cell in cells] == ['markdown', 'code', 'markdown', 'code', 'code']
+        assert cells[0]['source'] == '# Title\n\nText *emph*.'
+        assert cells[2]['source'] == '    not executed'
+        outputs = cells[1]['outputs']
+        assert [out['output_type'] for out in outputs] == ['stream', 'display_data', 'execute_result']
+        assert outputs[0]['text'] == 'out\n'
+        assert outputs[1]['data']['text/html'] == '<b>x</b>'
+        assert outputs[2]['data'] == {'text/plain': '2'}
+        assert outputs[2]['execution_count'] == cells[1]['execution_count']
+        assert cells[3]['metadata'] == {'jupyter': {'source_hidden': True}}
+        assert cells[3]['outputs'][0]['text'] == 'hidden\n'
+        assert cells[4]['outputs'] == []
+        assert nb['metadata']['kernelspec']['language'] == 'python'
+
+    def test_error(self):
+        code = '```{python}\n1 / 0\n```\n'
+        outputs = stitch_notebook(code)['cells'][0]['outputs']
+        assert outputs[0]['output_type'] == 'error' and outputs[0]['ename'] == 'ZeroDivisionError'
+        with pytest.raises(KnittyError):
+            stitch_notebook(code, error='raise')
+
+    def test_jupyter_meta(self):
+        code = '---\njupyter:\n  kernelspec:\n    name: custom\n---\n\n```{python}\n1\n```\n'
+        assert stitch_notebook(code)['metadata'] == {'kernelspec': {'name': 'custom'}}
+
+    def test_pipeline(self, tmpdir):
+        tmpdir.join('doc.md').write('Text.\n\n```python\nprint(1 + 1)\n```\n')
+        with tmpdir.as_cwd():
+            assert all(run for _, run in P.render('doc.md', 'doc.ipynb', direct_ipynb=True))
+            nb = nbformat.read(str(tmpdir.join('doc.ipynb')), 4)
+            assert nb.cells[1].outputs[0].text == '2\n'
+            result = CliRunner().invoke(P.main, ['doc.md', '-o', 'doc.ipynb', '--direct-ipynb'])
+            assert 'knitty: skipped, pandoc writer: skipped' in result.output
+            with pytest.raises(KnittyError):
+                P.render('doc.md', 'doc.html', direct_ipynb=True)
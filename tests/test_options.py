@@ -69,6 +69,16 @@ class TestOptions:
         assert s.error == 'raise'
         assert getattr(s, 'abstract', None) is None
 
+    def test_int(self):
+        doc = dedent('''\
+        ---
+        async_depth: 3
+        ---
+        ''')
+        s = Stitch('', 'html')
+        s.stitch_ast(pre_stitch_ast(doc))
+        assert s.async_depth == 3
+
     @pytest.mark.parametrize('key', [
         'title', 'author', 'date', 'self_contained', 'standalone'
     ])
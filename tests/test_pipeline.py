@@ -0,0 +1,84 @@
+import re
+import shutil
+from textwrap import dedent
+
+from click.testing import CliRunner
+
+from knitty import pipeline as P
+
+
+DOC = dedent('''\
+```python
+print(1 + 1)
+```
+''')
+
+FIGURE = dedent('''\
+```python
+%matplotlib inline
+import matplotlib.pyplot as plt
+plt.plot(range(4))
+```
+''')
+
+ALL = ['pre-knitty', 'pandoc reader', 'knitty', 'pandoc writer']
+
+
+def outputs(path) -> list:
+    return re.findall(r'<pre><code>(.*?)</code></pre>', path.read(), re.S)
+
+
+def run(stages) -> list:
+    return [stage for stage, run_ in stages if run_]
+
+
+class TestPipeline:
+
+    def test_memo(self, tmpdir):
+        doc = tmpdir.join('doc.md')
+        doc.write(DOC)
+        with tmpdir.as_cwd():
+            assert run(P.render('doc.md', 'doc.html')) == ALL
+            assert outputs(tmpdir.join('doc.html')) == ['2\n']
+            assert run(P.render('doc.md', 'doc.html')) == []
+            tmpdir.join('doc.html').write('changed')
+            assert run(P.render('doc.md', 'doc.html')) == ['pandoc writer']
+            assert outputs(tmpdir.join('doc.html')) == ['2\n']
+            assert run(P.render('doc.md', 'doc.html', standalone=True)) == ['knitty', 'pandoc writer']
+            doc.write(DOC + '\nText.\n')
+            assert run(P.render('doc.md', 'doc.html', standalone=True)) == ALL
+            # knitty stage is memoized only with the cache:
+            assert run(P.render('doc.md', 'doc.html', standalone=True, cache=False)) == ['knitty']
+            assert run(P.render('doc.md', 'doc.html', standalone=True, memo=False)) == ALL
+
+    def test_uncached(self, tmpdir):
+        tmpdir.join('doc.md').write(dedent('''\
+        ```{python, cache=False}
+        with open('runs.txt', 'a') as f:
+            print(f.write('run\\n'))
+        ```
+        '''))
+        with tmpdir.as_cwd():
+            assert run(P.render('doc.md', 'doc.html')) == ALL
+            assert run(P.render('doc.md', 'doc.html')) == ['knitty']
+            assert tmpdir.join('runs.txt').read() == 'run\nrun\n'
+
+    def test_resources(self, tmpdir):
+        tmpdir.join('doc.md').write(FIGURE)
+        with tmpdir.as_cwd():
+            assert run(P.render('doc.md', 'doc.html')) == ALL
+            assert tmpdir.join('doc_html_files').listdir()
+            assert run(P.render('doc.md', 'doc.html')) == []
+            shutil.rmtree('doc_html_files')
+            assert run(P.render('doc.md', 'doc.html')) == ['knitty']
+            assert tmpdir.join('doc_html_files').listdir()
+
+    def test_cli(self, tmpdir):
+        tmpdir.join('doc.py').write("# %% {python}\nprint('py')\n")
+        with tmpdir.as_cwd():
+            result = CliRunner().invoke(P.main, ['doc.py', '-o', 'out/doc.html', '--standalone'])
+            assert result.exit_code == 0, result.output
+            assert 'knitty: run' in result.output
+            assert outputs(tmpdir.join('out', 'doc.html')) == ['py\n']
+            result = CliRunner().invoke(P.main, ['doc.py', '-o', 'out/doc.html', '--standalone'])
+            assert 'knitty: skipped, pandoc writer: skipped' in result.output
@@ -0,0 +1,80 @@
+import os.path as p
+import random
+
+import pytest
+from click.testing import CliRunner
+
+from knitty.preprocess_filter import knitty_preprosess, knitty_preprosess_stream, regex_preprosess
+from knitty.pre_knitty import main
+
+LINES = ['# %%\n', '# %% {r}\n', '# %% {markdown} text\n', '# %%{x}\n', '#%% text\n', '# %%  {py, chunk=a}\n',
+         '# %% {r}\r\n', '# %%\r\n', '//%% \n', '# comment\n', '"""\n', "'''\n", '"""x\n', 'x"""\n', '"""x"""\n',
+         '"""\r\n', '""" \n', '""', '"""', '\n', '\r\n', '  \n', '\t\n', '\r', 'code\n', 'x = 1\r\n', '    y\n', 'text',
+         '```{r, echo=False}\n', '```{r}\n', '```{r, a=1}\r\n', '```{.py}\n', '```\n', '```python\n', '@{r, a=1}\n',
+         '@{echo=False}\n', '@{r}\r\n', '---\n']
+METADATA = ['', '---\nknitty-lang: r\n...\n', '---\ncomments-map:\n  py: ["#"]\n...\n',
+            '---\ncomments-map:\n  py: ["#", "\\"\\"\\"", "\\"\\"\\"", "\'\'\'", "\'\'\'"]\n...\n']
+YAML_META = [None, '---\ncomments-map:\n  py: ["#", "\\"\\"\\"", "\\"\\"\\""]\n...\n',
+             '---\ncomments-map:\n  py: ["#", "\\"", "x\\"", "\\"\\"\\"", "\\"\\"\\""]\n  r: ["//", "/*", "*/"]\n...\n']
+
+
+def documents(seed: int, n: int):
+    rnd = random.Random(seed)
+    for _ in range(n):
+        source = ''.join(rnd.choice(LINES) for _ in range(rnd.randint(0, 30)))
+        metadata = rnd.choice(METADATA)
+        i = source.rfind('\n', 0, rnd.randint(0, len(source))) + 1
+        yield source[:i] + metadata + source[i:], rnd.choice([None, 'py', 'r']), rnd.choice(YAML_META)
+
+
+def preprosess(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return type(e)
+
+
+def chunks(source: str, size: int) -> list:
+    return [source[i:i + size] for i in range(0, len(source), size)]
+
+
+class TestTokenizer:
+
+    @pytest.mark.parametrize('seed', range(4))
+    def test_same_as_regex(self, seed):
+        for source, lang, yaml_meta in documents(seed, 2000):
+            expected = preprosess(regex_preprosess, source, lang, yaml_meta)
+            assert preprosess(knitty_preprosess, source, lang, yaml_meta) == expected, source
+
+    @pytest.mark.parametrize('size', [1, 3, 64])
+    def test_stream(self, size):
+        for source, lang, yaml_meta in documents(size, 500):
+            expected = preprosess(regex_preprosess, source, lang, yaml_meta)
+            assert preprosess(lambda: ''.join(knitty_preprosess_stream(chunks(source, size), lang, yaml_meta))
+                              ) == expected, source
+
+    def test_doc(self):
+        with open(p.join(p.dirname(__file__), 'doc.py'), 'r', encoding='utf-8') as f:
+            source = f.read()
+        assert knitty_preprosess(source, 'py') == regex_preprosess(source, 'py')
+
+    def test_incremental(self):
+        def lines():
+            for i in range(3):
+                yield '# %%\n'
+                yield 'x = {}\n'.format(i)
+            raise AssertionError('read too far')
+
+        converted = knitty_preprosess_stream(lines(), 'py', meta_lines=0)
+        assert next(converted) == '```{.py}\nx = 0\n```\n\n'
+
+    def test_cli(self):
+        source = '# %% {echo=False}\r\nprint(1)\r\n\r\n# %%\r\n"""\r\nText\r\n"""\r\n'
+        yaml_meta = '---\ncomments-map:\n  py: ["#", "\\"\\"\\"", "\\"\\"\\""]\n...\n'
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open('meta.yaml', 'w', encoding='utf-8') as f:
+                f.write(yaml_meta)
+            result = runner.invoke(main, ['doc.py', '--yaml', 'meta.yaml'], input=source.encode('utf-8'))
+        assert result.exit_code == 0, result.output
+        assert result.output == regex_preprosess(source.replace('\r\n', '\n'), 'py', yaml_meta)
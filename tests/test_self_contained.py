@@ -0,0 +1,81 @@
+import io
+import json
+import base64
+
+import pytest
+import panflute as pf
+
+from knitty import self_contained_raw_html_img as S
+
+# 1x1 png:
+PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4z8AAAAMBAQDJ/pLvAAAAAElFTkSuQmCC')
+SVG = '<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"><rect width="1" height="1"/></svg>'
+
+pandoc3 = pytest.mark.skipif(S.pandoc_major() < 3, reason='in-process embedding needs Pandoc 3')
+
+
+@pytest.fixture
+def images(tmpdir):
+    tmpdir.join('a.png').write_binary(PNG)
+    tmpdir.join('a b.JPG').write_binary(PNG)
+    tmpdir.join('b.svg').write(SVG)
+    tmpdir.join('c.bmp').write_binary(PNG)
+    with tmpdir.as_cwd():
+        yield tmpdir
+
+
+def image(*alt, attributes=None, **kwargs):
+    elem = pf.Image(*alt, **kwargs)
+    if attributes:
+        elem.attributes = attributes
+    return elem
+
+
+EMBEDDED = [
+    lambda: image(url='a.png'),
+    lambda: image(pf.Str('cap'), url='a.png', title='fig: t'),
+    lambda: image(pf.Str("it's"), pf.Space, pf.Emph(pf.Str('<b>')), pf.LineBreak, pf.Code('x&y'),
+                  url='a.png', title='T "q"', identifier='id1', classes=['c', 'd'],
+                  attributes={'height': '5px', 'width': '6'}),
+    lambda: image(url='a%20b.JPG'),
+    lambda: image(url='b.svg'),
+    lambda: image(url='data:image/png;base64,' + base64.b64encode(PNG).decode('ascii')),
+]
+
+FALLBACK = [
+    lambda: image(url='c.bmp'),
+    lambda: image(url='missing.png'),
+    lambda: image(url='a.png', attributes={'width': '50%'}),
+    lambda: image(url='a.png', attributes={'data-x': 'y'}),
+    lambda: image(pf.Quoted(pf.Str('q')), url='a.png'),
+]
+
+
+@pandoc3
+class TestEmbedding:
+
+    @pytest.mark.parametrize('make', EMBEDDED)
+    def test_same_as_pandoc(self, images, make):
+        html = S.raw_html(make(), {})
+        assert html is not None
+        assert html == S.pandoc_raw_html(make())
+
+    @pytest.mark.parametrize('make', FALLBACK)
+    def test_fallback(self, images, make):
+        assert S.raw_html(make(), {}) is None
+
+    def test_filter(self, images, monkeypatch):
+        encoded = []
+        data_uri = S.data_uri
+        monkeypatch.setattr(S, 'data_uri', lambda path: encoded.append(path) or data_uri(path))
+        doc = pf.Doc(*[pf.Para(image(url=url)) for url in ['a.png', 'b.svg', 'a.png', 'c.bmp', 'a.png']])
+        with io.StringIO() as f:
+            pf.dump(doc, f)
+            doc = pf.load(io.StringIO(f.getvalue()))
+        doc = S.main(doc)
+        assert sorted(encoded) == ['a.png', 'b.svg']  # each file is encoded once
+        raw = [para.content[0] for para in doc.content]
+        assert all(isinstance(elem, pf.RawInline) for elem in raw)
+        assert raw[0].text == raw[2].text == raw[4].text == S.pandoc_raw_html(image(url='a.png'))
+        assert raw[3].text == S.pandoc_raw_html(image(url='c.bmp'))  # by Pandoc
+        json.dumps(doc.to_json())
@@ -12,6 +12,7 @@ from traitlets import TraitError
 
 from knitty.api import knitty_preprosess
 import knitty.stitch.stitch as R
+from knitty.stitch.cache import KEY
 
 if hasattr(pf.tools, 'which'):
     from shutilwhich_cwdpatch import which
@@ -98,6 +99,26 @@ def python_kp():
     return R.kernel_factory('python')
 
 
+@pytest.fixture(autouse=True)
+def shutdown_kernels(monkeypatch):
+    """
+    Shuts down kernels started by ``Stitch`` during the test (they are
+    only stopped at exit otherwise and pile up during the test run).
+    """
+    started = []
+
+    def kernel_factory(*args, **kwargs):
+        started.append(factory(*args, **kwargs))
+        return started[-1]
+
+    factory = R.kernel_factory
+    monkeypatch.setattr(R, 'kernel_factory', kernel_factory)
+    yield
+    for kp in started:
+        kp.kc.stop_channels()
+        kp.km.shutdown_kernel(now=True)
+
+
 class TestTesters:
 
     @pytest.mark.parametrize('block, expected', [
@@ -277,6 +298,33 @@ class TestFormatters:
     def test_extract_execution_count(self, messages, expected):
         assert R.extract_execution_count(messages) == expected
 
+    def test_coalesce_streams(self):
+        def stream(name, text):
+            return {'msg_type': 'stream', 'header': {'msg_type': 'stream'}, 'content': {'name': name, 'text': text}}
+
+        display = {'msg_type': 'display_data', 'header': {'msg_type': 'display_data'},
+                   'content': {'data': {'text/plain': 'x'}}}
+        messages = [stream('stdout', 'a'), stream('stdout', 'b'), stream('stderr', 'c'), stream('stderr', 'd'),
+                    stream('stdout', 'e'), display, stream('stdout', 'f'), stream('stdout', 'g')]
+        result = R.coalesce_streams(messages)
+        assert [(m['content'].get('name'), m['content'].get('text')) for m in result] == [
+            ('stdout', 'ab'), ('stderr', 'cd'), ('stdout', 'e'), (None, None), ('stdout', 'fg')]
+        assert result[0]['header'] == {'msg_type': 'stream'} and result[3] is display
+        assert messages[0]['content']['text'] == 'a'
+
+    @pytest.mark.parametrize('warning, expected', [
+        (True, [('stdout', 'ab'), ('stderr', 'cd'), ('stdout', 'e')]),
+        (False, [('stdout', 'ab'), ('stdout', 'e')]),  # hidden stderr still separates the blocks
+    ])
+    def test_coalesce_streams_warning(self, warning, expected):
+        def stream(name, text):
+            return {'msg_type': 'stream', 'header': {'msg_type': 'stream'}, 'content': {'name': name, 'text': text}}
+
+        messages = [stream('stdout', 'a'), stream('stdout', 'b'), stream('stderr', 'c'), stream('stderr', 'd'),
+                    stream('stdout', 'e')]
+        blocks = R.Stitch('foo', 'html', warning=warning).wrap_output('chunk', messages, {})
+        assert [block['c'][1][0]['c'][1] for block in blocks] == [text for _, text in expected]
+
     @pytest.mark.parametrize('output, message, expected', [
         ([{'text/plain': '2'}],
          {'content': {'execution_count': '1'}},
@@ -383,6 +431,33 @@ class TestIntegration:
                           'unnamed_chunk_0.' + fmt)
         assert p.exists(expected)
 
+    def test_resource_dir_replaced(self, clean_python_kernel, clean_name):
+        code = dedent('''\
+        ```{python}
+        %matplotlib inline
+        import matplotlib.pyplot as plt
+        plt.plot(range(4))
+        ```
+        ''')
+        os.makedirs(clean_name + '_files')
+        with open(p.join(clean_name + '_files', 'stale.png'), 'wb'):
+            pass
+        s = R.Stitch(clean_name, 'html', self_contained=False)
+        s._kernel_pairs['python'] = clean_python_kernel
+        s.stitch_ast(pre_stitch_ast(code))
+        assert [p.splitext(f)[0] for f in os.listdir(clean_name + '_files')] == ['unnamed_chunk_0']
+        assert [f for f in os.listdir('.') if f.startswith(clean_name)] == [clean_name + '_files']
+
+    def test_resource_dir_failed(self, clean_name):
+        s = R.Stitch(clean_name, 'html', self_contained=False)
+        os.makedirs(s.resource_dir)
+        with open(p.join(s.staging_dir, 'a.png'), 'wb'):
+            pass
+        s.commit_resources(ok=False)
+        assert os.listdir(s.resource_dir) == []
+        assert not p.exists(p.join(s.staging_dir, 'a.png'))
+        os.rmdir(s.staging_dir)
+
     @pytest.mark.parametrize('warning, length', [
         (True, 3),
         (False, 2),
@@ -400,6 +475,26 @@ class TestIntegration:
         result = r.stitch_ast(pre_stitch_ast(code))
         assert len(result['blocks']) == length
 
+    @pytest.mark.parametrize('results', ['default', 'pandoc'])
+    def test_coalesce_streams(self, clean_python_kernel, results):
+        code = dedent('''\
+        ```{{python, results={}}}
+        import sys
+        for i in range(200):
+            print('line', i, flush=True)
+        print('err', file=sys.stderr, flush=True)
+        print('more', flush=True)
+        ```
+        '''.format(results))
+        r = R.Stitch('foo', 'html')
+        r._kernel_pairs['python'] = clean_python_kernel
+        result = r.stitch_ast(pre_stitch_ast(code))
+        blocks = result['blocks']
+        ast = dict(result, blocks=[blocks[1]])
+        text = pf.convert_text(json.dumps(ast), input_format='json', output_format='plain')
+        assert len(blocks) == 4
+        assert text.split() == [w for i in range(200) for w in ('line', str(i))]
+
     @pytest.mark.parametrize('to', ['latex', 'beamer'])
     def test_rich_output(self, to, clean_python_kernel):
         code = dedent('''\
@@ -444,6 +539,630 @@ class TestIntegration:
         assert wrapped['c'][0]['c'][0]['t'] == 'InlineMath'
 
 
+class TestCache:
+
+    code = dedent('''\
+    ```{python}
+    x = 21
+    ```
+
+    ```{python}
+    print(x * 2)
+    ```
+    ''')
+
+    def test_chunk_key(self):
+        key = R.chunk_key('python', 'x = 1', {'eval': True})
+        assert key == R.chunk_key('python', 'x = 1', {'eval': True})
+        assert key != R.chunk_key('python', 'x = 2', {'eval': True})
+        assert key != R.chunk_key('python', 'x = 1', {'eval': True}, [key])
+
+    def test_replay(self, tmpdir):
+        with tmpdir.as_cwd():
+            s = R.Stitch('foo', 'html', cache=True)
+            expected = s.stitch_ast(pre_stitch_ast(self.code))
+            assert (s.cache.hits, s.cache.misses) == (0, 2)
+
+            s = R.Stitch('foo', 'html', cache=True)
+            result = s.stitch_ast(pre_stitch_ast(self.code))
+            assert (s.cache.hits, s.cache.misses) == (2, 0)
+            assert s.kernel_managers == {}
+            assert result == expected
+
+    def test_restore_state(self, tmpdir):
+        with tmpdir.as_cwd():
+            R.Stitch('foo', 'html', cache=True).stitch_ast(pre_stitch_ast(self.code))
+
+            s = R.Stitch('foo', 'html', cache=True)
+            result = s.stitch_ast(pre_stitch_ast(self.code.replace('x * 2', 'x * 3')))
+            assert (s.cache.hits, s.cache.misses) == (1, 1)
+            assert result['blocks'][-1]['c'][1][0]['c'][1] == '63\n'
+
+    def test_prune(self, tmpdir):
+        def stored():
+            return sorted(f for f in os.listdir(R.Stitch.name_cache_dir('foo')) if KEY.match(f[:-len('.json')]))
+
+        with tmpdir.as_cwd():
+            R.Stitch('foo', 'html', cache=True).stitch_ast(pre_stitch_ast(self.code))
+            before = stored()
+            assert len(before) == 2
+
+            R.Stitch('foo', 'html', cache=True).stitch_ast(pre_stitch_ast(self.code.replace('x * 2', 'x * 3')))
+            after = stored()
+            assert len(after) == 2
+            assert len(set(before) & set(after)) == 1
+
+            with pytest.raises(R.KnittyError):
+                R.Stitch('foo', 'html', cache=True, error='raise').stitch_ast(pre_stitch_ast(
+                    self.code.replace('x * 2', 'x * 4') + '\n```{python}\nraise ValueError\n```\n'))
+            assert set(after) < set(stored())
+
+    def test_refresh(self, tmpdir):
+        with tmpdir.as_cwd():
+            R.Stitch('foo', 'html', cache=True).stitch_ast(pre_stitch_ast(self.code))
+
+            s = R.Stitch('foo', 'html', cache=True, refresh_cache=True)
+            s.stitch_ast(pre_stitch_ast(self.code))
+            assert (s.cache.hits, s.cache.misses) == (0, 2)
+
+
+class TestIncremental:
+
+    code = dedent('''\
+    ---
+    incremental: True
+    ...
+
+    ```{python}
+    a = 1
+    ```
+
+    ```{python}
+    b = 2
+    ```
+
+    ```{python}
+    print(a)
+    ```
+
+    ```{python}
+    print(a + b)
+    ```
+    ''')
+
+    def test_downstream_only(self, tmpdir):
+        with tmpdir.as_cwd():
+            R.Stitch('foo', 'html', cache=True).stitch_ast(pre_stitch_ast(self.code))
+
+            s = R.Stitch('foo', 'html', cache=True)
+            result = s.stitch_ast(pre_stitch_ast(self.code.replace('b = 2', 'b = 3')))
+            assert (s.cache.hits, s.cache.misses) == (2, 2)
+            outputs = [b['c'][1][0]['c'][1] for b in result['blocks'] if b['t'] == 'Div']
+            assert outputs == ['1\n', '4\n']
+
+    def test_overwritten(self, tmpdir):
+        # replaying `x = 1` for `print(y, ...)` must not leave x = 1 for the next chunks:
+        code = dedent('''\
+        ---
+        incremental: True
+        ...
+
+        ```{python}
+        x = 1
+        ```
+
+        ```{python}
+        y = x
+        ```
+
+        ```{python}
+        x = 7
+        ```
+
+        ```{python}
+        print(y, 0)
+        ```
+
+        ```{python}
+        print(x, 0)
+        ```
+        ''')
+        with tmpdir.as_cwd():
+            R.Stitch('foo', 'html', cache=True).stitch_ast(pre_stitch_ast(code))
+
+            s = R.Stitch('foo', 'html', cache=True)
+            result = s.stitch_ast(pre_stitch_ast(code.replace('print(y, 0)', 'print(y, 1)')))
+            outputs = [b['c'][1][0]['c'][1] for b in result['blocks'] if b['t'] == 'Div']
+            assert outputs == ['1 1\n', '7 0\n']
+
+            code = code.replace('x = 7', 'x = 8').replace(', 0)', ', 2)')
+            s = R.Stitch('foo', 'html', cache=True)
+            result = s.stitch_ast(pre_stitch_ast(code))
+            assert (s.cache.hits, s.cache.misses) == (2, 3)
+            outputs = [b['c'][1][0]['c'][1] for b in result['blocks'] if b['t'] == 'Div']
+            assert outputs == ['1 2\n', '8 2\n']
+
+    def test_opt_out(self, tmpdir):
+        code = self.code.replace('```{python}\nb = 2', '```{python, incremental=False}\nb = 2')
+        with tmpdir.as_cwd():
+            R.Stitch('foo', 'html', cache=True).stitch_ast(pre_stitch_ast(code))
+
+            s = R.Stitch('foo', 'html', cache=True)
+            s.stitch_ast(pre_stitch_ast(code.replace('b = 2', 'b = 3')))
+            assert (s.cache.hits, s.cache.misses) == (1, 3)
+
+
+class TestCheckpoint:
+
+    code = dedent('''\
+    ```{python, checkpoint=True}
+    with open('runs.txt', 'a') as f:
+        f.write('run\\n')
+    data = list(range(5))
+    inc = lambda x: x + 1
+    ```
+
+    ```{python}
+    print(inc(sum(data)), get_ipython().execution_count)
+    ```
+    ''')
+
+    @staticmethod
+    def outputs(result):
+        return [b['c'][1][0]['c'][1] for b in result['blocks'] if b['t'] == 'Div']
+
+    def test_resume(self, tmpdir):
+        with tmpdir.as_cwd():
+            s = R.Stitch('foo', 'html', cache=True)
+            assert self.outputs(s.stitch_ast(pre_stitch_ast(self.code))) == ['11 2\n']
+            assert len(os.listdir(s.checkpoint_dir)) == 1
+
+            s = R.Stitch('foo', 'html', cache=True)
+            result = s.stitch_ast(pre_stitch_ast(self.code.replace('inc(sum', '2 * inc(sum')))
+            assert (s.cache.hits, s.cache.misses) == (1, 1)
+            assert self.outputs(result) == ['22 2\n']
+            assert tmpdir.join('runs.txt').read() == 'run\n'
+
+    def test_stale(self, tmpdir):
+        with tmpdir.as_cwd():
+            s = R.Stitch('foo', 'html', cache=True)
+            s.stitch_ast(pre_stitch_ast(self.code))
+            old = os.listdir(s.checkpoint_dir)
+            s.stitch_ast(pre_stitch_ast(self.code.replace('range(5)', 'range(6)')))
+            new = os.listdir(s.checkpoint_dir)
+            assert len(new) == 1 and new != old
+
+    def test_unpicklable(self, tmpdir, capsys):
+        code = self.code.replace('inc = lambda', 'gen = (i for i in data)\ninc = lambda')
+        with tmpdir.as_cwd():
+            s = R.Stitch('foo', 'html', cache=True)
+            assert self.outputs(s.stitch_ast(pre_stitch_ast(code))) == ['11 2\n']
+            assert len(os.listdir(s.checkpoint_dir)) == 1
+        assert 'skipped unpicklable variables: f, gen' in capsys.readouterr().err
+
+    def test_failure(self, tmpdir, capsys):
+        with tmpdir.as_cwd():
+            s = R.Stitch('foo', 'html', cache=True)
+            tmpdir.join(s.checkpoint_dir).write('not a dir', ensure=True)
+            assert self.outputs(s.stitch_ast(pre_stitch_ast(self.code))) == ['11 2\n']
+        assert 'snapshot after chunk unnamed_chunk_0 failed: FileExistsError' in capsys.readouterr().err
+
+
+class TestParallel:
+
+    def test_parallel_kernels(self):
+        code = dedent('''\
+        ---
+        parallel_kernels: True
+        ---
+
+        ```{python}
+        x = 'a'
+        ```
+
+        ```{python3}
+        x = 'b'
+        ```
+
+        ```{python}
+        print(x)
+        ```
+
+        ```{python3}
+        print(x)
+        ```
+        ''')
+        s = R.Stitch('foo', 'html')
+        blocks = s.stitch_ast(pre_stitch_ast(code))['blocks']
+        assert s.parallel_kernels
+        assert set(s.kernel_managers) == {'python', 'python3'}
+        outputs = [b['c'][1][0]['c'][1] for b in blocks if b['t'] == 'Div']
+        assert outputs == ['a\n', 'b\n']
+
+
+class TestSessions:
+
+    # each session waits for the flag of the other one:
+    code = dedent('''\
+    ```{python}
+    x = 'default'
+    ```
+
+    ```{.python session=a}
+    import os, time
+    open('a.flag', 'w').close()
+    for _ in range(200):
+        if os.path.exists('b.flag'):
+            break
+        time.sleep(0.1)
+    x = 'a'
+    ```
+
+    ```{.python session=b}
+    import os, time
+    open('b.flag', 'w').close()
+    for _ in range(200):
+        if os.path.exists('a.flag'):
+            break
+        time.sleep(0.1)
+    x = 'b'
+    ```
+
+    ```{.python session=a}
+    print(x, os.path.exists('b.flag'))
+    ```
+
+    ```{python}
+    print(x)
+    ```
+
+    ```{.python session=b}
+    print(x, os.path.exists('a.flag'))
+    ```
+    ''')
+
+    def test_sessions(self, tmpdir):
+        with tmpdir.as_cwd():
+            s = R.Stitch('foo', 'html', cache=True)
+            blocks = s.stitch_ast(pre_stitch_ast(self.code))['blocks']
+            assert set(s.kernel_managers) == {'python', 'python:a', 'python:b'}
+            outputs = [b['c'][1][0]['c'][1] for b in blocks if b['t'] == 'Div']
+            assert outputs == ['a True\n', 'default\n', 'b True\n']
+
+            s = R.Stitch('foo', 'html', cache=True)
+            plan = s.plan(pre_stitch_ast(self.code.replace("x = 'b'", "x = 'B'")))
+            assert [(k, v['cached'], v['executed']) for k, v in plan['kernels'].items()] == [
+                ('python', 2, 0), ('python:a', 2, 0), ('python:b', 0, 2)]
+
+    def test_sequential(self, tmpdir):
+        code = dedent('''\
+        ---
+        parallel_sessions: False
+        ---
+
+        ```{.python session=a}
+        x = 1
+        ```
+
+        ```{.python session=b}
+        print('x' in globals())
+        ```
+        ''')
+        s = R.Stitch('foo', 'html')
+        blocks = s.stitch_ast(pre_stitch_ast(code))['blocks']
+        assert not s.parallel_sessions
+        assert set(s.kernel_managers) == {'python:a', 'python:b'}
+        assert blocks[-1]['c'][1][0]['c'][1] == 'False\n'
+
+    def test_invalid(self):
+        s = R.Stitch('foo', 'html')
+        plan = s.plan(pre_stitch_ast('```{.python session=true}\n1\n```\n'))
+        assert plan['errors'] == ["chunk unnamed_chunk_0: Invalid session option True: "
+                                  "expected a name (letters, digits, _, ., -)"]
+
+
+class TestPrestart:
+
+    code = dedent('''\
+    ```{python}
+    x = 'a'
+    ```
+
+    ```{python3}
+    print('b')
+    ```
+
+    ```{python}
+    print(x)
+    ```
+
+    ```{python2 eval=False}
+    unknown kernel that is not evaluated
+    ```
+    ''')
+
+    def chunks(self, s, code):
+        ast = pre_stitch_ast(code)
+        lm = s.start_document(ast['pandoc-api-version'], ast['meta'])
+        return [s.parse_chunk(i, block, lm) for i, block in enumerate(ast['blocks']) if R.is_code_block(block)]
+
+    def test_needed_kernels(self, tmpdir):
+        with tmpdir.as_cwd():
+            s = R.Stitch('foo', 'html', cache=True)
+            assert s.needed_kernels(self.chunks(s, self.code)) == ['python', 'python3']
+            s.stitch_ast(pre_stitch_ast(self.code))
+
+            s = R.Stitch('foo', 'html', cache=True)
+            assert s.needed_kernels(self.chunks(s, self.code)) == []
+            s = R.Stitch('foo', 'html', cache=True)
+            assert s.needed_kernels(self.chunks(s, self.code.replace("'b'", "'c'"))) == ['python3']
+
+    def test_prestart(self):
+        s = R.Stitch('foo', 'html')
+        blocks = s.stitch_ast(pre_stitch_ast(self.code))['blocks']
+        assert set(s.kernel_managers) == {'python', 'python3'}
+        assert s._starting == {}
+        outputs = [b['c'][1][0]['c'][1] for b in blocks if b['t'] == 'Div']
+        assert outputs == ['b\n', 'a\n']
+
+    def test_unused(self):
+        s = R.Stitch('foo', 'html')
+        s.prestart(['python'])
+        s.stitch_ast(pre_stitch_ast('text'))
+        assert set(s.kernel_managers) == {'python'}
+
+
+
+class TestPlan:
+
+    def test_validate(self):
+        code = dedent('''\
+        ```{.python error=foo results=bar}
+        x = (
+        ```
+
+        ```{.python error=raise results="pandoc -f gfm"}
+        def f(:
+        ```
+
+        ```{.python eval=maybe}
+        %time await f()
+        ```
+
+        ```{.nokernel}
+        1
+        ```
+        ''')
+        s = R.Stitch('foo', 'html')
+        plan = s.plan(pre_stitch_ast(code))
+        assert not plan['ok']
+        assert [e.split(':')[0] for e in plan['errors']] == [
+            'chunk unnamed_chunk_0', 'chunk unnamed_chunk_0', 'chunk unnamed_chunk_1', 'chunk unnamed_chunk_2',
+            "kernel 'nokernel' is not installed"]
+        assert plan['warnings'] == ["chunk unnamed_chunk_0: SyntaxError: '(' was never closed (line 1)"]
+        with pytest.raises(R.KnittyError):
+            s.stitch_ast(pre_stitch_ast(code))
+        assert s.kernel_managers == {} and s._starting == {}
+
+    def test_plan(self, tmpdir):
+        code = TestCache.code + '\n```{python}\nimport time; time.sleep(0.3)\n```\n'
+        with tmpdir.as_cwd():
+            s = R.Stitch('foo', 'html', cache=True)
+            plan = s.plan(pre_stitch_ast(code))
+            assert plan['ok'] and (plan['chunks'], plan['executable']) == (3, 3)
+            assert plan['cache'] == {'hits': 0, 'misses': 3}
+            assert plan['unknown_timings'] == 4  # kernel and chunks
+            s.stitch_ast(pre_stitch_ast(code))
+            assert s._timings['chunks']['unnamed_chunk_2'] >= 0.3
+
+            s = R.Stitch('foo', 'html', cache=True)
+            plan = s.plan(pre_stitch_ast(code.replace('x * 2', 'x * 3')))
+            assert plan['cache'] == {'hits': 1, 'misses': 2}
+            assert plan['kernels']['python'] == {'chunks': 3, 'cached': 1, 'executed': 2, 'replayed': 1,
+                                                 'start': True, 'seconds': plan['estimated_seconds']}
+            assert plan['estimated_seconds'] >= 0.3 and plan['unknown_timings'] == 0
+            assert s.kernel_managers == {}
+
+
+class TestAsyncEngine:
+
+    code = dedent('''\
+    ```{python}
+    x = 1
+    print(x)
+    ```
+
+    Text.
+
+    ```{python}
+    from IPython.display import Markdown
+    Markdown('*{}*'.format(x + 1))
+    ```
+
+    ```{python}
+    1 / 0
+    ```
+    ''')
+
+    def test_same_output(self):
+        expected = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast(self.code))
+        s = R.Stitch('foo', 'html')
+        result = s.stitch_ast(pre_stitch_ast('---\nasync_depth: 2\n...\n' + self.code))
+        assert s.async_depth == 2
+        assert s.kernel_managers == {}
+        assert result['blocks'] == expected['blocks']
+
+    def test_async_run_code(self):
+        import asyncio
+        from knitty.stitch.engine import AsyncEngine, async_run_code
+
+        async def run():
+            engine = AsyncEngine(R.Stitch('foo', 'html'))
+            kp = await engine.get_kernel('python')
+            try:
+                return await async_run_code('print(42)', kp)
+            finally:
+                await engine.shutdown()
+
+        loop = asyncio.new_event_loop()
+        messages = loop.run_until_complete(run())
+        loop.close()
+        assert messages[-1]['content']['text'] == '42\n'
+
+
+class TestPipeline:
+
+    code = TestAsyncEngine.code + dedent('''\
+
+    ```{python}
+    print(x + 2)
+    ```
+    ''')
+
+    def test_same_output(self):
+        expected = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast(self.code))
+        s = R.Stitch('foo', 'html')
+        result = s.stitch_ast(pre_stitch_ast('---\npipeline_depth: 8\n...\n' + self.code))
+        assert s.pipeline_depth == 8
+        assert result['blocks'] == expected['blocks']
+        assert result['blocks'][-1]['c'][1][0]['c'][1] == '3\n'
+
+    def test_same_output_print(self):
+        # sleep: kernel sends the output printed before it in a separate message
+        code = ''.join(dedent('''\
+        ```{{python}}
+        import time
+        for j in range(3):
+            print({0}, j)
+        time.sleep(0.3)
+        print('{0}\\n{0}', end='')
+        print()
+        ```
+
+        ''').format(i) for i in range(4))
+        expected = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast(code))
+        result = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast('---\npipeline_depth: 8\n...\n' + code))
+        assert result['blocks'] == expected['blocks']
+        assert result['blocks'][-1]['c'][1][0]['c'][1] == '3 0\n3 1\n3 2\n3\n3\n'
+
+    def test_router(self):
+        from knitty.stitch.router import MessageRouter
+
+        kp = R.kernel_factory('python')
+        R.initialize_kernel('python', kp)
+        try:
+            router = MessageRouter(kp)
+            ids = [router.submit('print({})'.format(i)) for i in range(3)]
+            assert router.pending == 3
+            results = [router.wait(msg_id) for msg_id in reversed(ids)]
+            assert [m[-1]['content']['text'] for m in results] == ['2\n', '1\n', '0\n']
+            assert router.pending == 0
+            assert router.run('1 / 0')[-1]['msg_type'] == 'error'
+            assert router.run('print(5)')[-1]['content']['text'] == '5\n'
+            # messages of requests sent past the router are dropped:
+            kp.kc.execute('print(6)')
+            assert router.run('print(7)')[-1]['content']['text'] == '7\n'
+            assert (router.collectors, router.replies) == ({}, {})
+        finally:
+            kp.kc.stop_channels()
+            kp.km.shutdown_kernel(now=True)
+
+    def test_cache_replay(self, tmpdir):
+        code = '---\npipeline_depth: 2\n...\n' + TestCache.code
+        with tmpdir.as_cwd():
+            R.Stitch('foo', 'html', cache=True).stitch_ast(pre_stitch_ast(code))
+            s = R.Stitch('foo', 'html', cache=True)
+            result = s.stitch_ast(pre_stitch_ast(code.replace('x * 2', 'x * 3')))
+            assert (s.cache.hits, s.cache.misses) == (1, 1)
+            assert result['blocks'][-1]['c'][1][0]['c'][1] == '63\n'
+
+
+class TestStream:
+
+    def test_same_output(self):
+        code = '---\nbatch_pandoc: False\n...\n' + TestPipeline.code
+        expected = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast(code))
+        ast = pre_stitch_ast(code)
+        blocks = iter(ast['blocks'])
+        result = R.Stitch('foo', 'html').stitch_blocks(ast['pandoc-api-version'], ast['meta'], blocks)
+        assert next(result) == expected['blocks'][0]
+        assert list(result) == expected['blocks'][1:]
+
+    def test_filter(self):
+        from io import StringIO
+        from knitty.ast_filter import knitty_pandoc_filter_stream
+
+        ast = pre_stitch_ast(TestAsyncEngine.code + '\n```{python}\nx\n```\n')
+        out = StringIO()
+        knitty_pandoc_filter_stream(StringIO(json.dumps(ast)), out, name='foo', filter_to='html', standalone=False,
+                                    self_contained=True, pandoc_format='markdown', pandoc_extra_args=[])
+        result = json.loads(out.getvalue())
+        assert result['meta'] == ast['meta']
+        assert result['blocks'][-1]['c'][1][0]['c'][1] == '1'
+
+
+class TestBatch:
+
+    sources = ['- a\n- b', 'foo *bar*', '| a | b |\n|---|---|\n| 1 | 2 |',
+               '1. x\n2. y\n', '    code', 'last line  ', '# Header']
+
+    @pytest.mark.parametrize('fmt', ['markdown', 'gfm', 'commonmark'])
+    def test_flush(self, fmt):
+        calls = []
+
+        def tokenize(*args):
+            calls.append(args)
+            return R.tokenize_block(*args)
+
+        batch = R.TokenizeBatch()
+        result = batch.flush([batch.add(source, fmt) for source in self.sources], tokenize)
+        expected = [b for source in self.sources for b in R.tokenize_block(source, fmt)]
+        assert result == expected
+        assert len(calls) == 2  # header is not batchable
+
+    def test_fallback(self):
+        sources = ['```\nunclosed', 'text']
+        batch = R.TokenizeBatch()
+        result = batch.flush([batch.add(source) for source in sources], R.tokenize_block)
+        assert result == [b for source in sources for b in R.tokenize_block(source)]
+
+    def test_stitch(self):
+        code = dedent('''\
+        ```{python, results=pandoc}
+        for i in range(3):
+            print('*{}*'.format(i))
+        ```
+        ''')
+        result = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast(code))
+        expected = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast('---\nbatch_pandoc: False\n...\n' + code))
+        assert result['blocks'] == expected['blocks']
+        assert result['blocks'][-1]['c'][0]['t'] == 'Emph'
+
+    def test_fast_markdown(self, monkeypatch):
+        code = dedent('''\
+        ```{python, results=pandoc}
+        print('| a | b |\\n|---|---|\\n| 1 | 2 |')
+        ```
+
+        ```{python, results=pandoc}
+        print('- *x*')
+        ```
+        ''')
+        expected = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast(code))
+        calls = []
+        tokenize_block = R.tokenize_block
+
+        def tokenize(*args):
+            calls.append(args[0])
+            return tokenize_block(*args)
+
+        monkeypatch.setattr(R, 'tokenize_block', tokenize)
+        result = R.Stitch('foo', 'html').stitch_ast(pre_stitch_ast('---\nfast_markdown: True\n...\n' + code))
+        assert result['blocks'] == expected['blocks']
+        assert [b['t'] for b in result['blocks'] if b['t'] in ('Table', 'BulletList')] == ['Table', 'BulletList']
+        assert calls == ['- *x*\n']
+
+
 class TestStitcher:
     def test_error(self):
         s = R.Stitch('stdout', 'html')
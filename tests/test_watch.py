@@ -0,0 +1,113 @@
+import re
+import time
+import threading
+from textwrap import dedent
+
+import pytest
+from click.testing import CliRunner
+
+from knitty import watch as W
+from knitty.tools import KnittyError
+
+
+DOC = dedent('''\
+---
+title: Watch
+...
+
+```python
+x = 1
+```
+
+```python
+y = 2
+```
+
+```python
+print(x + y)
+```
+''')
+
+
+def outputs(path) -> list:
+    return re.findall(r'<pre><code>(.*?)</code></pre>', path.read(), re.S)
+
+
+@pytest.fixture
+def session(tmpdir):
+    tmpdir.join('doc.md').write(DOC)
+    with tmpdir.as_cwd():
+        session = W.WatchSession('doc.md', 'doc.html', standalone=True)
+        yield session
+        session.shutdown()
+
+
+class TestWatchSession:
+
+    def test_incremental(self, session, tmpdir):
+        doc = tmpdir.join('doc.md')
+        assert session.render() == '0 reused, 3 executed'
+        kp = session.kernels['python']
+        assert outputs(tmpdir.join('doc.html')) == ['3\n']
+
+        doc.write(DOC.replace('y = 2', 'y = 5'))
+        assert session.render() == '1 reused, 2 executed'
+        assert session.kernels['python'] is kp
+        assert outputs(tmpdir.join('doc.html')) == ['6\n']
+
+        doc.write(DOC.replace('y = 2', 'y = 5') + '\nText.\n')
+        assert session.render() == '3 reused, 0 executed'
+
+    def test_failed(self, session, tmpdir):
+        doc = tmpdir.join('doc.md')
+        session.render()
+        doc.write(DOC + '\n```{python, error=raise}\nx = (\n```\n')
+        with pytest.raises(KnittyError):
+            session.render()
+        doc.write(DOC + '\nText.\n')
+        assert session.render() == '3 reused, 0 executed'
+        assert outputs(tmpdir.join('doc.html')) == ['3\n']
+
+    def test_no_incremental(self, session, tmpdir):
+        session.incremental = False
+        session.render()
+        tmpdir.join('doc.md').write(DOC.replace('x = 1', 'x = 2'))
+        assert session.render() == '0 reused, 3 executed'
+
+    def test_undo(self, session, tmpdir):
+        doc = tmpdir.join('doc.md')
+        session.render()
+        doc.write(DOC.replace('x = 1', 'x = 2'))
+        session.render()
+        doc.write(DOC)
+        # outputs of the render before the previous one are not reused: kernel state has changed
+        assert session.render() == '1 reused, 2 executed'
+        assert outputs(tmpdir.join('doc.html')) == ['3\n']
+
+
+def test_wait_for_change(tmpdir):
+    doc = tmpdir.join('doc.md')
+    doc.write('a')
+    last = W.stamp([str(doc)])
+
+    def edit():
+        for text in ('ab', 'abc'):
+            time.sleep(0.15)
+            doc.write(text)
+
+    thread = threading.Thread(target=edit)
+    thread.start()
+    new = W.wait_for_change([str(doc)], last, interval=0.05, debounce=0.3)
+    thread.join()
+    assert new != last
+    assert new == W.stamp([str(doc)])
+    assert doc.read() == 'abc'
+
+
+def test_cli_once(tmpdir):
+    tmpdir.join('doc.md').write(DOC)
+    with tmpdir.as_cwd():
+        result = CliRunner().invoke(W.main, ['doc.md', '-o', 'doc.html', '--standalone', '--once'])
+    assert result.exit_code == 0
+    assert 'rendered doc.html' in result.output
+    assert outputs(tmpdir.join('doc.html')) == ['3\n']